@@ -1,12 +1,13 @@
 # app.py
 
-from flask import Flask, request, render_template, redirect, url_for, flash, jsonify, session, send_file
+from flask import Flask, request, render_template, redirect, url_for, flash, jsonify, session, send_file, Response
 import os
 import logging
 import pandas as pd
 from datetime import datetime, timedelta
 import io
 import csv
+import json
 from google_auth_oauthlib.flow import Flow
 from google.oauth2 import id_token
 from google.auth.transport import requests
@@ -19,16 +20,24 @@ os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 from data import (
     init_data_store,
     fetch_all_products_with_sales,
+    fetch_all_products_with_sales_stream,
     load_orders_from_file,
-    save_orders_to_file,
     create_new_delivery,
     cancel_delivery,
     handle_delivery_completion,
+    reactivate_delivery,
+    flush_orders,
+    get_order_persistence_status,
     get_active_deliveries_summary,
     get_completed_deliveries_summary,
     get_delivery_details,
+    get_all_orders_df,
     verify_active_delivery,
+    calculate_delivery_avg_costs,
     get_current_stock_from_centra,
+    get_current_stock_bulk,
+    lookup_stock,
+    StockFetchError,
     test_stock_query,
     get_price_lists,
     save_price_list,
@@ -36,9 +45,19 @@ from data import (
     delete_price_list,
     PRICE_LISTS_FILE,
     fetch_all_suppliers,
-    fetch_collections_and_products
+    fetch_collections_and_products,
+    get_catalog_products,
+    search_catalog_products,
+    build_scenario_grid,
+    calculate_reorder_scenarios,
+    get_sales_cube,
+    sales_days_to_fetch,
+    SALES_CUBE_MAX_SYNC_DAYS,
+    CATALOG_CACHE
 )
 from sheets import push_to_google_sheets
+from jobs import JOB_RUNNER, FAILED
+import sales_cache
 
 # Konfigurera loggning
 logging.basicConfig(
@@ -56,6 +75,13 @@ SCOPES = ['https://www.googleapis.com/auth/userinfo.profile',
           'https://www.googleapis.com/auth/userinfo.email',
           'openid']
 
+# Antal rader som visas i scenariojämförelsen på /stats
+SCENARIO_PREVIEW_ROWS = int(os.environ.get('SCENARIO_PREVIEW_ROWS', 200))
+
+# Gränser för /stats/sales_windows: antal fönster och längsta intervall i dagar
+SALES_WINDOWS_MAX = int(os.environ.get('SALES_WINDOWS_MAX', 10))
+SALES_WINDOW_MAX_DAYS = int(os.environ.get('SALES_WINDOW_MAX_DAYS', 730))
+
 # Flask-Login konfiguration
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -84,6 +110,25 @@ def login_required_custom(f):
         return f(*args, **kwargs)
     return decorated_function
 
+@app.context_processor
+def inject_catalog_age():
+    """
+    Gör katalog-snapshotens ålder tillgänglig i alla templates.
+    """
+    age = CATALOG_CACHE.age_seconds()
+    if age is None:
+        catalog_age = None
+    elif age < 60:
+        catalog_age = "nyss"
+    elif age < 3600:
+        catalog_age = f"{int(age // 60)} min sedan"
+    else:
+        catalog_age = f"{age / 3600:.1f} h sedan"
+    return {
+        'catalog_age': catalog_age,
+        'catalog_refreshing': CATALOG_CACHE.is_refreshing()
+    }
+
 def initialize_app():
     init_data_store()
     load_orders_from_file()
@@ -182,16 +227,10 @@ def logout():
 # --------------------------------------------
 # Statistik & Översikt
 # --------------------------------------------
-@app.route('/stats', methods=['GET', 'POST'])
-@login_required_custom
-def stats():
-    today = datetime.today()
-    default_from_date = (today - timedelta(days=30)).strftime('%Y-%m-%d')
-    default_to_date = today.strftime('%Y-%m-%d')
-
-    api_endpoint = os.environ.get('YOUR_API_ENDPOINT')
-    api_token = os.environ.get('CENTRA_API_TOKEN')
-
+def _load_stats_filter_options(api_endpoint, api_token):
+    """
+    Hämtar aktiva leverantörer och collection-namn till filtren på /stats.
+    """
     all_suppliers = []
     all_collections = []
 
@@ -206,111 +245,300 @@ def stats():
             if supplier_list:
                 all_suppliers = [s['name'] for s in supplier_list if s.get('status') == 'ACTIVE']
 
-            # 2) Hämta collections => plocka ut unika collection-namn
-            product_map = fetch_collections_and_products(api_endpoint, headers) or {}
+            # 2) Hämta collections => plocka ut unika collection-namn.
+            #    Finns en katalog-snapshot räcker den, annars frågas Centra.
             unique_coll = set()
-            for cset in product_map.values():
-                for c in cset:
-                    unique_coll.add(c)
+            snapshot = CATALOG_CACHE.peek()
+            if snapshot is not None and 'Collections' in snapshot.columns:
+                for clist in snapshot['Collections']:
+                    unique_coll.update(clist)
+            else:
+                product_map = fetch_collections_and_products(api_endpoint, headers) or {}
+                for cset in product_map.values():
+                    for c in cset:
+                        unique_coll.add(c)
             all_collections = sorted(list(unique_coll))
 
         except Exception as e:
             logging.error(f"Fel vid hämtning av suppliers/collections: {str(e)}")
             flash("Kunde inte hämta leverantörer eller collections. Kontrollera API-inställningar.", "error")
 
-    if request.method == 'POST':
-        from_date_str = request.form.get("from_date", default_from_date)
-        to_date_str = request.form.get("to_date", default_to_date)
-        active_filter = (request.form.get("active_filter") == "on")
-        bundle_filter = (request.form.get("bundle_filter") == "on")
-        shipped_filter = (request.form.get("shipped_filter") == "on")
-        lead_time = int(request.form.get("lead_time", 7))
-        safety_stock = int(request.form.get("safety_stock", 10))
+    return all_suppliers, all_collections
 
-        selected_suppliers = request.form.getlist("suppliers")
-        selected_collections = request.form.getlist("collections")
 
+def _default_stats_params():
+    today = datetime.today()
+    return {
+        "from_date": (today - timedelta(days=30)).strftime('%Y-%m-%d'),
+        "to_date": today.strftime('%Y-%m-%d'),
+        "active_filter": True,
+        "bundle_filter": True,
+        "shipped_filter": True,
+        "refresh_sales": False,
+        "lead_time": 7,
+        "safety_stock": 10,
+        "suppliers": [],
+        "collections": []
+    }
+
+
+def _read_stats_params(form):
+    defaults = _default_stats_params()
+    return {
+        "from_date": form.get("from_date", defaults["from_date"]),
+        "to_date": form.get("to_date", defaults["to_date"]),
+        "active_filter": (form.get("active_filter") == "on"),
+        "bundle_filter": (form.get("bundle_filter") == "on"),
+        "shipped_filter": (form.get("shipped_filter") == "on"),
+        "refresh_sales": (form.get("refresh_sales") == "on"),
+        "lead_time": int(form.get("lead_time", 7)),
+        "safety_stock": int(form.get("safety_stock", 10)),
+        "suppliers": sorted(form.getlist("suppliers")),
+        "collections": sorted(form.getlist("collections"))
+    }
+
+
+def _filter_stats_df(df, params):
+    if params["active_filter"] and 'Status' in df.columns:
+        df = df[df['Status'] == "ACTIVE"]
+    if params["bundle_filter"] and 'Is Bundle' in df.columns:
+        df = df[df['Is Bundle'] == False]
+
+    selected_suppliers = params["suppliers"]
+    if selected_suppliers and 'Supplier' in df.columns:
+        df = df[df['Supplier'].isin(selected_suppliers)]
+
+    selected_collections = params["collections"]
+    if selected_collections and 'Collections' in df.columns:
+        def has_overlap(collection_list):
+            return bool(set(collection_list).intersection(selected_collections))
+        df = df[df['Collections'].apply(has_overlap)]
+
+    return df
+
+
+def _quote_product_numbers(df):
+    # Lägg på apostrof framför product number för Excel
+    if 'Product Number' in df.columns:
+        df = df.copy()
+        df['Product Number'] = "'" + df['Product Number'].astype(str)
+    return df
+
+
+def _run_stats_job(api_endpoint, api_token, params, report):
+    """
+    Själva /stats-körningen. Körs som bakgrundsjobb i JOB_RUNNER.
+    """
+    df = fetch_all_products_with_sales(
+        api_endpoint=api_endpoint,
+        api_token=api_token,
+        from_date_str=params["from_date"],
+        to_date_str=params["to_date"],
+        lead_time=params["lead_time"],
+        safety_stock=params["safety_stock"],
+        only_shipped=params["shipped_filter"],
+        refresh_sales_cache=params["refresh_sales"],
+        progress_callback=report
+    )
+    if df is None or df.empty:
+        raise Exception("Ingen data hittades eller fel vid hämtning.")
+
+    df = _quote_product_numbers(_filter_stats_df(df, params))
+    report(f"{len(df)} rader efter filtrering.")
+    return df
+
+
+def _submit_stats_job(params):
+    api_endpoint = os.environ.get('YOUR_API_ENDPOINT')
+    api_token = os.environ.get('CENTRA_API_TOKEN')
+    key = json.dumps(params, sort_keys=True)
+    return JOB_RUNNER.submit(
+        key,
+        lambda report: _run_stats_job(api_endpoint, api_token, params, report),
+        params=params
+    )
+
+
+def _render_stats(params, all_suppliers, all_collections, df=None, job=None):
+    preview_table = None
+    if df is not None:
+        preview_table = df.head(3).to_html(classes="table table-striped", index=False)
+
+    return render_template(
+        "stats.html",
+        df_table=df is not None,
+        preview_table=preview_table,
+        total_rows=len(df) if df is not None else 0,
+        job=job.to_dict() if job is not None else None,
+        active_orders=get_active_deliveries_summary(),
+        from_date=params["from_date"],
+        to_date=params["to_date"],
+        active_filter=params["active_filter"],
+        bundle_filter=params["bundle_filter"],
+        shipped_filter=params["shipped_filter"],
+        lead_time=params["lead_time"],
+        safety_stock=params["safety_stock"],
+        suppliers=all_suppliers,
+        selected_suppliers=params["suppliers"],
+        collections=all_collections,
+        selected_collections=params["collections"]
+    )
+
+
+@app.route('/stats', methods=['GET', 'POST'])
+@login_required_custom
+def stats():
+    api_endpoint = os.environ.get('YOUR_API_ENDPOINT')
+    api_token = os.environ.get('CENTRA_API_TOKEN')
+
+    if request.method == 'POST':
         if not api_endpoint or not api_token:
             flash("API-endpoint och/eller token saknas. Sätt miljövariabler!", "error")
             return redirect(url_for("stats"))
 
-        active_orders = get_active_deliveries_summary()
+        job, _ = _submit_stats_job(_read_stats_params(request.form))
+        return redirect(url_for("stats", job_id=job.id))
 
-        df = fetch_all_products_with_sales(
-            api_endpoint=api_endpoint,
-            api_token=api_token,
-            from_date_str=from_date_str,
-            to_date_str=to_date_str,
-            lead_time=lead_time,
-            safety_stock=safety_stock,
-            only_shipped=shipped_filter
-        )
-        if df is None or df.empty:
-            flash("Ingen data hittades eller fel vid hämtning.", "warning")
-            return redirect(url_for("stats"))
+    all_suppliers, all_collections = _load_stats_filter_options(api_endpoint, api_token)
 
-        if active_filter and 'Status' in df.columns:
-            df = df[df['Status'] == "ACTIVE"]
-        if bundle_filter and 'Is Bundle' in df.columns:
-            df = df[df['Is Bundle'] == False]
+    job_id = request.args.get("job_id")
+    job = JOB_RUNNER.get(job_id) if job_id else None
+    if job_id and job is None:
+        flash("Jobbet finns inte längre, kör hämtningen igen.", "warning")
 
-        if selected_suppliers and 'Supplier' in df.columns:
-            df = df[df['Supplier'].isin(selected_suppliers)]
+    params = job.params if job is not None else _default_stats_params()
+    return _render_stats(params, all_suppliers, all_collections, job=job)
 
-        if selected_collections and 'Collections' in df.columns:
-            def has_overlap(collection_list):
-                return bool(set(collection_list).intersection(selected_collections))
-            df = df[df['Collections'].apply(has_overlap)]
 
-        if df.empty:
-            flash("Inga produkter matchade dina filterval.", "warning")
-            return redirect(url_for("stats"))
+@app.route('/stats/stream', methods=['GET'])
+@login_required_custom
+def stats_stream():
+    """
+    Server-Sent Events för /stats: progress, produktrader direkt efter
+    katalogen, försäljning per chunk och till sist de beräknade kolumnerna.
+    Parametrarna skickas som query string (EventSource kan bara göra GET).
+    """
+    api_endpoint = os.environ.get('YOUR_API_ENDPOINT')
+    api_token = os.environ.get('CENTRA_API_TOKEN')
+    if not api_endpoint or not api_token:
+        return jsonify({'error': 'API-endpoint och/eller token saknas'}), 400
 
-        # Lägg på apostrof framför product number för Excel
-        if 'Product Number' in df.columns:
-            df['Product Number'] = "'" + df['Product Number'].astype(str)
+    params = _read_stats_params(request.args)
 
+    def store_result(df):
         from data import DATAFRAME_CACHE
-        DATAFRAME_CACHE["stats_df"] = df.copy()
+        DATAFRAME_CACHE["stats_df"] = _quote_product_numbers(df)
 
-        preview_df = df.head(3)
+    def generate():
+        try:
+            yield from fetch_all_products_with_sales_stream(
+                api_endpoint=api_endpoint,
+                api_token=api_token,
+                from_date_str=params["from_date"],
+                to_date_str=params["to_date"],
+                lead_time=params["lead_time"],
+                safety_stock=params["safety_stock"],
+                only_shipped=params["shipped_filter"],
+                refresh_sales_cache=params["refresh_sales"],
+                product_filter=lambda df: _filter_stats_df(df, params),
+                on_complete=store_result
+            )
+        except Exception as e:
+            logging.error(f"Fel i stats-stream: {str(e)}")
+            yield f"data: Fel: {str(e)}\n\n"
+        # Talar om för klienten att stänga, annars återansluter EventSource
+        yield "event: end\ndata: {}\n\n"
 
-        return render_template(
-            "stats.html",
-            df_table=df.to_html(classes="table table-striped", index=False),
-            preview_table=preview_df.to_html(classes="table table-striped", index=False),
-            total_rows=len(df),
-            active_orders=active_orders,
-            from_date=from_date_str,
-            to_date=to_date_str,
-            active_filter=active_filter,
-            bundle_filter=bundle_filter,
-            shipped_filter=shipped_filter,
-            lead_time=lead_time,
-            safety_stock=safety_stock,
-            suppliers=all_suppliers,
-            selected_suppliers=selected_suppliers,
-            collections=all_collections,
-            selected_collections=selected_collections
-        )
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/stats/jobs', methods=['POST'])
+@login_required_custom
+def stats_submit_job():
+    if not os.environ.get('YOUR_API_ENDPOINT') or not os.environ.get('CENTRA_API_TOKEN'):
+        return jsonify({'error': 'API-endpoint och/eller token saknas'}), 400
+
+    job, created = _submit_stats_job(_read_stats_params(request.form))
+    return jsonify({'job_id': job.id, 'created': created, 'status': job.status})
+
+
+@app.route('/stats/jobs/<job_id>', methods=['GET'])
+@login_required_custom
+def stats_job_status(job_id):
+    job = JOB_RUNNER.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Jobbet hittades inte'}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/stats/jobs/<job_id>/result', methods=['GET'])
+@login_required_custom
+def stats_job_result(job_id):
+    job = JOB_RUNNER.get(job_id)
+    if job is None:
+        flash("Jobbet finns inte längre, kör hämtningen igen.", "warning")
+        return redirect(url_for("stats"))
+    if not job.finished:
+        return redirect(url_for("stats", job_id=job_id))
+    if job.status == FAILED:
+        flash(job.error or "Ingen data hittades eller fel vid hämtning.", "warning")
+        return redirect(url_for("stats"))
+
+    df = job.result
+    if df is None:
+        # Jobbet kördes av en annan worker och resultatet är rensat eller kunde inte sparas
+        flash("Resultatet finns inte längre, kör hämtningen igen.", "warning")
+        return redirect(url_for("stats"))
+    if request.args.get("format") == "csv":
+        buffer = io.BytesIO(df.to_csv(index=False).encode('utf-8'))
+        return send_file(buffer, mimetype='text/csv', as_attachment=True,
+                         download_name=f"stats_{job.params['from_date']}_{job.params['to_date']}.csv")
+
+    if df.empty:
+        flash("Inga produkter matchade dina filterval.", "warning")
+        return redirect(url_for("stats"))
+
+    from data import DATAFRAME_CACHE
+    DATAFRAME_CACHE["stats_df"] = df.copy()
+
+    all_suppliers, all_collections = _load_stats_filter_options(
+        os.environ.get('YOUR_API_ENDPOINT'),
+        os.environ.get('CENTRA_API_TOKEN')
+    )
+    return _render_stats(job.params, all_suppliers, all_collections, df=df)
+
+
+@app.route('/stats/sales_cache', methods=['GET'])
+@login_required_custom
+def stats_sales_cache_info():
+    """
+    Antal cachade dagar, storlek och datumintervall per läge i säljcachen.
+    """
+    return jsonify(sales_cache.cache_info())
+
+
+@app.route('/stats/sales_cache/clear', methods=['POST'])
+@login_required_custom
+def stats_clear_sales_cache():
+    from_date_str = request.form.get("from_date") or None
+    to_date_str = request.form.get("to_date") or None
+    removed = sales_cache.invalidate(from_date_str=from_date_str, to_date_str=to_date_str)
+    flash(f"Säljcachen tömd ({removed} dagar borttagna).", "success")
+    return redirect(url_for("stats"))
+
+
+@app.route('/catalog/refresh', methods=['POST'])
+@login_required_custom
+def catalog_refresh():
+    api_endpoint = os.environ.get('YOUR_API_ENDPOINT')
+    api_token = os.environ.get('CENTRA_API_TOKEN')
+    if not api_endpoint or not api_token:
+        flash("API-endpoint och/eller token saknas. Sätt miljövariabler!", "error")
     else:
-        active_orders = get_active_deliveries_summary()
-        return render_template(
-            "stats.html",
-            df_table=None,
-            active_orders=active_orders,
-            from_date=default_from_date,
-            to_date=default_to_date,
-            active_filter=True,
-            bundle_filter=True,
-            shipped_filter=True,
-            lead_time=7,
-            safety_stock=10,
-            suppliers=all_suppliers,
-            selected_suppliers=[],
-            collections=all_collections,
-            selected_collections=[]
-        )
+        CATALOG_CACHE.refresh_in_background(api_endpoint, api_token)
+        flash("Produktdata uppdateras i bakgrunden.", "info")
+    return redirect(request.referrer or url_for("stats"))
 
 
 @app.route('/stats/push_to_sheets', methods=['POST'])
@@ -329,6 +557,151 @@ def stats_push_to_sheets():
         return jsonify({'error': 'Kunde inte skapa Google Sheet'}), 500
 
 
+def _parse_number_list(value):
+    return [float(v) for v in str(value).replace(';', ',').split(',') if v.strip()]
+
+
+def _parse_sales_windows(value):
+    """
+    Fönsterlängderna i dagar ur windows=7,30,90, sorterade och utan dubletter.
+    Kastar ValueError om de är för många, inte heltal eller för långa.
+    """
+    windows = sorted(set(_parse_number_list(value)))
+    if not windows:
+        raise ValueError("ange minst ett fönster")
+    if len(windows) > SALES_WINDOWS_MAX:
+        raise ValueError(f"högst {SALES_WINDOWS_MAX} fönster")
+    for window in windows:
+        if not 1 <= window <= SALES_WINDOW_MAX_DAYS or window != int(window):
+            raise ValueError(f"fönster {window:g} ska vara 1-{SALES_WINDOW_MAX_DAYS} hela dagar")
+    return [int(window) for window in windows]
+
+
+@app.route('/stats/scenarios', methods=['POST'])
+@login_required_custom
+def stats_scenarios():
+    """
+    Jämför Quantity to Order för flera (leveranstid, säkerhetslager) på den
+    senast hämtade statistiken, utan ny hämtning från Centra.
+    Tar lead_times och safety_stocks som kommaseparerade listor (form eller
+    JSON). ?format=csv ger hela tabellen som fil, annars JSON med
+    sammanfattning och de rader som skiljer mest.
+    """
+    from data import DATAFRAME_CACHE
+    df = DATAFRAME_CACHE.get("stats_df")
+    if df is None or df.empty:
+        return jsonify({'error': 'Ingen statistik hämtad ännu, kör /stats först'}), 400
+
+    values = request.get_json(silent=True) or request.form
+    try:
+        scenarios = build_scenario_grid(
+            _parse_number_list(values.get('lead_times', '')),
+            _parse_number_list(values.get('safety_stocks', ''))
+        )
+    except ValueError as e:
+        return jsonify({'error': f"Ogiltiga scenarier: {str(e)}"}), 400
+    if not scenarios:
+        return jsonify({'error': 'Ange minst en leveranstid och ett säkerhetslager'}), 400
+
+    result_df, summary = calculate_reorder_scenarios(df, scenarios)
+
+    if request.args.get('format') == 'csv':
+        buffer = io.BytesIO(result_df.to_csv(index=False).encode('utf-8'))
+        return send_file(buffer, mimetype='text/csv', as_attachment=True,
+                         download_name=f"scenarier_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+
+    columns = [item['column'] for item in summary]
+    spread = result_df[columns].max(axis=1) - result_df[columns].min(axis=1)
+    preview = result_df.loc[spread.sort_values(ascending=False).index[:SCENARIO_PREVIEW_ROWS]]
+    preview = preview[preview[columns].max(axis=1) > 0]
+
+    return jsonify({
+        'scenarios': summary,
+        'columns': list(preview.columns),
+        'rows': preview.astype(object).where(preview.notna(), None).values.tolist(),
+        'total_rows': len(result_df)
+    })
+
+
+@app.route('/stats/sales_windows', methods=['GET'])
+@login_required_custom
+def stats_sales_windows():
+    """
+    Försäljning per SKU för valfria intervall ur säljkuben, utan ny
+    hämtning från Centra för dagar som redan finns i säljcachen.
+    - from_date/to_date: ett intervall (Quantity Sold, Avg Daily Sales)
+    - windows=7,30,90 (och ev. end_date): jämför de senaste N dagarna
+    Högst SALES_WINDOWS_MAX fönster och SALES_WINDOW_MAX_DAYS dagar.
+    ?format=csv ger en fil, annars JSON.
+    Saknas fler än SALES_CUBE_MAX_SYNC_DAYS dagar i säljcachen hämtas de av
+    ett bakgrundsjobb och svaret blir 202 med job_id; anropa igen när
+    /stats/jobs/<job_id> är klart.
+    """
+    api_endpoint = os.environ.get('YOUR_API_ENDPOINT')
+    api_token = os.environ.get('CENTRA_API_TOKEN')
+    if not api_endpoint or not api_token:
+        return jsonify({'error': 'API-endpoint och/eller token saknas'}), 400
+
+    only_shipped = request.args.get('shipped_filter', 'on') == 'on'
+    try:
+        windows = None
+        if request.args.get('windows'):
+            windows = _parse_sales_windows(request.args['windows'])
+            to_date = request.args.get('end_date') or (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
+            from_date = (datetime.fromisoformat(to_date) - timedelta(days=max(windows) - 1)).strftime('%Y-%m-%d')
+        else:
+            from_date = request.args['from_date']
+            to_date = request.args['to_date']
+            days = (datetime.fromisoformat(to_date) - datetime.fromisoformat(from_date)).days + 1
+            if not 1 <= days <= SALES_WINDOW_MAX_DAYS:
+                raise ValueError(f"intervallet ska vara 1-{SALES_WINDOW_MAX_DAYS} dagar")
+        missing = sales_days_to_fetch(from_date, to_date, only_shipped=only_shipped)
+    except (KeyError, ValueError) as e:
+        return jsonify({'error': f"Ogiltiga parametrar: {str(e)}"}), 400
+
+    if missing > SALES_CUBE_MAX_SYNC_DAYS:
+        def fill_sales_cache(report):
+            if get_sales_cube(api_endpoint, api_token, from_date, to_date, only_shipped=only_shipped,
+                              progress_callback=report) is None:
+                raise RuntimeError("Kunde inte hämta försäljning")
+            report("Försäljningen är hämtad")
+
+        job, _ = JOB_RUNNER.submit(('sales_cube', from_date, to_date, only_shipped), fill_sales_cache,
+                                   params={'from_date': from_date, 'to_date': to_date,
+                                           'shipped_filter': only_shipped})
+        return jsonify({
+            'job_id': job.id,
+            'status': job.status,
+            'message': f"{missing} dagar hämtas från Centra i bakgrunden, försök igen när jobbet är klart"
+        }), 202
+
+    cube = get_sales_cube(api_endpoint, api_token, from_date, to_date, only_shipped=only_shipped)
+    if cube is not None:
+        df = cube.trailing_df(windows, to_date) if windows else cube.window_df(from_date, to_date)
+    else:
+        df = None
+
+    if df is None:
+        return jsonify({'error': 'Kunde inte hämta försäljning'}), 500
+
+    snapshot = CATALOG_CACHE.peek()
+    if snapshot is not None:
+        names = snapshot[['ProductID', 'Size', 'Product Name']].drop_duplicates(['ProductID', 'Size'])
+        df = df.merge(names, on=['ProductID', 'Size'], how='left')
+
+    if request.args.get('format') == 'csv':
+        buffer = io.BytesIO(df.to_csv(index=False).encode('utf-8'))
+        return send_file(buffer, mimetype='text/csv', as_attachment=True,
+                         download_name=f"forsaljning_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+
+    return jsonify({
+        'first_day': cube.first_day.isoformat(),
+        'last_day': cube.last_day.isoformat(),
+        'columns': list(df.columns),
+        'rows': df.astype(object).where(df.notna(), None).values.tolist()
+    })
+
+
 # --------------------------------------------
 # Leveranser
 # --------------------------------------------
@@ -415,12 +788,15 @@ def deliveries_process(order_name):
                     'Exchange rate': float(request.form.get(f'exchange_rate_{i}', 0)),
                     'Shipping': float(request.form.get(f'shipping_{i}', 0)),
                     'Customs': float(request.form.get(f'customs_{i}', 0)),
-                    'new_avg_cost': float(request.form.get(f'new_avg_cost_{i}', 0)),
+                    'Current Stock': request.form.get(f'current_stock_{i}'),
+                    'PurchasePrice': request.form.get(f'purchase_price_{i}'),
                     'OrderName': order_name
                 }
                 delivery_data.append(row_data)
 
-            delivery_df = pd.DataFrame(delivery_data)
+            # Snitten räknas om här i stället för att tas från formuläret.
+            # Lager och inköpspris behövs för snittet per produkt.
+            delivery_df = calculate_delivery_avg_costs(pd.DataFrame(delivery_data))
             handle_delivery_completion(delivery_df)
             flash("Leverans mottagen och arkiverad!", "success")
             return redirect(url_for("deliveries_view", order_name=order_name))
@@ -430,19 +806,16 @@ def deliveries_process(order_name):
             flash(f"Ingen aktiv leverans hittades för namnet: '{order_name}'.", "error")
             return redirect(url_for("deliveries"))
 
-        updated_details = []
-        for _, row in details_df.iterrows():
-            current_stock = get_current_stock_from_centra(
-                api_endpoint, 
-                api_token, 
-                row['ProductID'], 
-                row['Size']
-            )
-            logger.info(f"Hämtat lagersaldo för {row['ProductID']} {row['Size']}: {current_stock}")
-
-            row_dict = row.to_dict()
-            row_dict['Current Stock'] = current_stock
-            updated_details.append(row_dict)
+        try:
+            stock_map = get_current_stock_bulk(api_endpoint, api_token, details_df['ProductID'].tolist())
+        except StockFetchError as e:
+            # Utan lagersaldo blir snittkostnaden fel, så leveransen kan inte tas emot nu
+            flash(f"Kunde inte hämta lagersaldo från Centra ({str(e)}). Försök igen.", "error")
+            return redirect(url_for("deliveries"))
+        updated_details = details_df.to_dict(orient="records")
+        for row_dict in updated_details:
+            row_dict['Current Stock'] = lookup_stock(stock_map, row_dict['ProductID'], row_dict['Size'])
+        logger.info(f"Hämtat lagersaldo för {len(updated_details)} rader")
 
         cache_key = f"delivery_details_{order_name}"
         DATAFRAME_CACHE[cache_key] = updated_details
@@ -461,6 +834,43 @@ def deliveries_process(order_name):
         return redirect(url_for("deliveries"))
 
 
+# Fält i förhandsgranskningen -> kolumner i calculate_delivery_avg_costs
+AVG_COST_PREVIEW_FIELDS = {
+    'received_qty': 'Mottagen mängd',
+    'price': 'Price',
+    'exchange_rate': 'Exchange rate',
+    'shipping': 'Shipping',
+    'customs': 'Customs',
+    'current_stock': 'Current Stock',
+    'purchase_price': 'PurchasePrice'
+}
+
+
+@app.route('/deliveries/process/<order_name>/preview', methods=['POST'])
+@login_required_custom
+def deliveries_preview_avg_costs(order_name):
+    """
+    Räknar nytt pris i SEK och nytt snitt för alla rader i leveransen.
+    Tar emot {"rows": [{"received_qty": ..., "price": ..., "exchange_rate": ...,
+    "shipping": ..., "customs": ..., "current_stock": ..., "purchase_price": ...}]}
+    och svarar med new_price_sek och new_avg_cost per rad i samma ordning.
+    """
+    payload = request.get_json(silent=True) or {}
+    rows = payload.get('rows')
+    if not isinstance(rows, list):
+        return jsonify({'error': 'rows saknas'}), 400
+
+    df = pd.DataFrame(
+        [{column: row.get(field) for field, column in AVG_COST_PREVIEW_FIELDS.items()} for row in rows],
+        columns=list(AVG_COST_PREVIEW_FIELDS.values())
+    )
+    result = calculate_delivery_avg_costs(df)
+    return jsonify({
+        'order_name': order_name,
+        'rows': result[['new_price_sek', 'new_avg_cost']].to_dict(orient='records')
+    })
+
+
 @app.route('/deliveries/update_stock/<order_name>', methods=['POST'])
 @login_required_custom
 def update_current_stock(order_name):
@@ -484,26 +894,21 @@ def update_current_stock(order_name):
             flash("Kunde inte hitta leveransen.", "error")
             return redirect(url_for('deliveries'))
 
-        updated_details = []
-        for _, row in details_df.iterrows():
-            current_stock = get_current_stock_from_centra(
-                api_endpoint, 
-                api_token, 
-                row['ProductID'], 
-                row['Size']
-            )
-            logger.info(f"Hämtat lagersaldo för {row['ProductID']} {row['Size']}: {current_stock}")
-
-            row_dict = row.to_dict()
-            row_dict['Current Stock'] = current_stock
-            updated_details.append(row_dict)
+        stock_map = get_current_stock_bulk(api_endpoint, api_token, details_df['ProductID'].tolist())
+        updated_details = details_df.to_dict(orient="records")
+        for row_dict in updated_details:
+            row_dict['Current Stock'] = lookup_stock(stock_map, row_dict['ProductID'], row_dict['Size'])
+        logger.info(f"Hämtat lagersaldo för {len(updated_details)} rader")
 
         from data import DATAFRAME_CACHE
         cache_key = f"delivery_details_{order_name}"
         DATAFRAME_CACHE[cache_key] = updated_details
 
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-            return jsonify({'success': True})
+            return jsonify({
+                'success': True,
+                'stocks': [row_dict['Current Stock'] for row_dict in updated_details]
+            })
 
         flash(f"Lagersaldo uppdaterat från Centra! Totalt {len(updated_details)} produkter.", "success")
 
@@ -532,23 +937,13 @@ def test_stock(product_id, size):
 @app.route('/deliveries/reactivate/<order_name>', methods=['POST'])
 @login_required_custom
 def deliveries_reactivate(order_name):
-    from data import logger, ALL_ORDERS_DF
     logger.info(f"Försöker återaktivera leverans: {order_name}")
 
     try:
-        order_mask = ALL_ORDERS_DF['OrderName'].astype(str) == str(order_name)
-        if not any(order_mask):
+        if reactivate_delivery(order_name):
+            flash(f"Leverans {order_name} återaktiverad!", "success")
+        else:
             flash(f"Kunde inte hitta leverans: {order_name}", "error")
-            return redirect(url_for("deliveries"))
-
-        ALL_ORDERS_DF.loc[order_mask, 'IsActive'] = True
-        ALL_ORDERS_DF['IsActive'] = ALL_ORDERS_DF['IsActive'].astype(bool)
-
-        from data import save_orders_to_file
-        save_orders_to_file()
-
-        logger.info(f"Leverans {order_name} återaktiverad")
-        flash(f"Leverans {order_name} återaktiverad!", "success")
 
     except Exception as e:
         logger.error(f"Fel vid återaktivering av leverans: {str(e)}")
@@ -852,23 +1247,7 @@ def search_products():
         if not api_endpoint or not api_token:
             return jsonify({'products': []})
 
-        # Hämta produkter från Centra som matchar sökningen
-        products_df = fetch_all_products(api_endpoint, api_token)
-        if products_df is None or products_df.empty:
-            return jsonify({'products': []})
-
-        # Filtrera baserat på ProductID eller Product Name
-        mask = (products_df['ProductID'].astype(str).str.contains(query, case=False)) | \
-               (products_df['Product Name'].astype(str).str.contains(query, case=False))
-
-        filtered_df = products_df[mask].head(10)  # Begränsa till 10 resultat
-
-        results = filtered_df.apply(lambda row: {
-            'ProductID': str(row['ProductID']),
-            'Product_Name': str(row['Product Name']),
-            'Size': str(row['Size'])
-        }, axis=1).tolist()
-
+        results = search_catalog_products(api_endpoint, api_token, query, limit=10)
         return jsonify({'products': results})
 
     except Exception as e:
@@ -880,8 +1259,8 @@ def search_products():
 @login_required_custom
 def dashboard():
     try:
-        # Hämta data för leveranser per månad
-        all_orders_df = pd.read_csv('active_orders.csv') if os.path.exists('active_orders.csv') else pd.DataFrame()
+        # Hämta data för leveranser per månad (inklusive arkiverade)
+        all_orders_df = get_all_orders_df()
 
         if not all_orders_df.empty:
             all_orders_df['OrderDate'] = pd.to_datetime(all_orders_df['OrderDate'])
@@ -904,7 +1283,9 @@ def dashboard():
         products_df = pd.DataFrame()  # Initiera tom DataFrame
         if api_endpoint and api_token:
             try:
-                products_df = fetch_all_products(api_endpoint, api_token)
+                products_df = get_catalog_products(api_endpoint, api_token)
+                if products_df is None:
+                    products_df = pd.DataFrame()
             except Exception as api_error:
                 logger.error(f"Kunde inte hämta produkter från API: {str(api_error)}")
                 flash("Kunde inte hämta produktdata från API", "warning")
@@ -993,6 +1374,28 @@ def dashboard():
         return redirect(url_for('index'))
 
 
+
+@app.route('/persistence/status', methods=['GET'])
+@login_required_custom
+def persistence_status():
+    """
+    Kölängd för orderändringar som ännu inte sparats i Firebase.
+    """
+    return jsonify(get_order_persistence_status())
+
+
+@app.route('/persistence/flush', methods=['POST'])
+@login_required_custom
+def persistence_flush():
+    """
+    Väntar tills alla köade orderändringar är sparade.
+    """
+    timeout = float(request.args.get('timeout', 30))
+    flushed = flush_orders(timeout=timeout)
+    status = get_order_persistence_status()
+    status['flushed'] = flushed
+    return jsonify(status), (200 if flushed else 504)
+
 if __name__ == "__main__":
     initialize_app()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,121 @@
+# catalog_cache.py
+#
+# Processgemensam ögonblicksbild av produktkatalogen (fetch_all_products).
+# Alla routes delar samma snapshot; bara en hämtning körs åt gången och en
+# utgången snapshot returneras direkt medan en ny hämtas i bakgrunden.
+
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Hur länge en snapshot räknas som färsk (sekunder)
+CATALOG_TTL_SECONDS = int(os.environ.get('CATALOG_TTL_SECONDS', 900))
+
+
+class CatalogCache:
+    """
+    loader är en funktion (api_endpoint, api_token) -> DataFrame som gör
+    själva crawlen mot Centra.
+    """
+
+    def __init__(self, loader, ttl=CATALOG_TTL_SECONDS):
+        self.loader = loader
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._df = None
+        self._fetched_at = None
+        self._refresh_done = None
+        self._listeners = []
+
+    def add_listener(self, fn):
+        """
+        Registrerar en funktion som anropas med den nya DataFramen
+        varje gång katalogen har hämtats om.
+        """
+        self._listeners.append(fn)
+
+    def get(self, api_endpoint, api_token, force_refresh=False, copy=True):
+        """
+        Returnerar en kopia av katalogen (copy=False ger den delade
+        DataFramen, som då inte får ändras).
+        - Färsk snapshot: returneras direkt.
+        - Utgången snapshot: returneras direkt, ny hämtning startas i bakgrunden.
+        - Ingen snapshot (eller force_refresh): väntar på hämtningen. Pågår
+          redan en hämtning väntar anroparen på den i stället för att starta en ny.
+        """
+        with self._lock:
+            if self._df is not None and not force_refresh:
+                if self._age() >= self.ttl:
+                    self._start_refresh(api_endpoint, api_token)
+                return self._df.copy() if copy else self._df
+            done = self._start_refresh(api_endpoint, api_token)
+
+        done.wait()
+        with self._lock:
+            if self._df is None:
+                return None
+            return self._df.copy() if copy else self._df
+
+    def refresh_in_background(self, api_endpoint, api_token):
+        with self._lock:
+            self._start_refresh(api_endpoint, api_token)
+
+    def peek(self):
+        """
+        Returnerar nuvarande snapshot (utan kopia) eller None, utan att hämta.
+        """
+        return self._df
+
+    def age_seconds(self):
+        with self._lock:
+            return self._age() if self._df is not None else None
+
+    def is_refreshing(self):
+        return self._refresh_done is not None
+
+    def invalidate(self):
+        with self._lock:
+            self._df = None
+            self._fetched_at = None
+
+    def _age(self):
+        return time.time() - self._fetched_at
+
+    def _start_refresh(self, api_endpoint, api_token):
+        # Anropas med self._lock tagen
+        if self._refresh_done is None:
+            self._refresh_done = threading.Event()
+            threading.Thread(
+                target=self._refresh,
+                args=(api_endpoint, api_token, self._refresh_done),
+                daemon=True
+            ).start()
+        return self._refresh_done
+
+    def _refresh(self, api_endpoint, api_token, done):
+        start = time.perf_counter()
+        try:
+            df = self.loader(api_endpoint, api_token)
+            if df is None:
+                logger.error("Kunde inte hämta produktkatalogen, behåller tidigare snapshot")
+                return
+
+            with self._lock:
+                self._df = df
+                self._fetched_at = time.time()
+            logger.info(f"Produktkatalog hämtad: {len(df)} rader på {time.perf_counter() - start:.1f} s")
+
+            for fn in self._listeners:
+                try:
+                    fn(df)
+                except Exception as e:
+                    logger.error(f"Fel i lyssnare för produktkatalog: {str(e)}")
+        except Exception as e:
+            logger.error(f"Fel vid hämtning av produktkatalog: {str(e)}")
+        finally:
+            with self._lock:
+                self._refresh_done = None
+            done.set()
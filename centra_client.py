@@ -0,0 +1,232 @@
+# centra_client.py
+#
+# Delad HTTP-klient för Centras GraphQL-API. En enda requests.Session med
+# connection pool och keep-alive återanvänds av alla hämtfunktioner i data.py.
+# Klienten schemalägger också anropen: token bucket för att hålla nere
+# anropstakten, tak för samtidiga anrop per operation och omförsök med
+# exponentiell backoff + jitter vid tillfälliga fel.
+
+import os
+import re
+import time
+import random
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Antal samtidiga anslutningar som poolen håller öppna mot Centra
+CENTRA_POOL_SIZE = int(os.environ.get('CENTRA_POOL_SIZE', 20))
+
+# Token bucket: genomsnittligt antal anrop per sekund och max burst
+CENTRA_RATE_LIMIT = float(os.environ.get('CENTRA_RATE_LIMIT', 10))
+CENTRA_RATE_BURST = int(os.environ.get('CENTRA_RATE_BURST', 20))
+
+# Omförsök för queries (inte mutations) vid 429, 5xx och timeouts
+CENTRA_MAX_RETRIES = int(os.environ.get('CENTRA_MAX_RETRIES', 4))
+CENTRA_BACKOFF_BASE = float(os.environ.get('CENTRA_BACKOFF_BASE', 0.5))
+CENTRA_BACKOFF_MAX = float(os.environ.get('CENTRA_BACKOFF_MAX', 30))
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Tak för samtidiga anrop per operation, t.ex. "Orders=6,ProductStocks=2".
+# Operationer som inte nämns begränsas bara av poolstorleken.
+CENTRA_OPERATION_CONCURRENCY = os.environ.get('CENTRA_OPERATION_CONCURRENCY', 'Orders=6')
+
+_OPERATION_RE = re.compile(r'\b(query|mutation)\s+(\w+)')
+
+
+def _parse_concurrency(spec):
+    limits = {}
+    for part in spec.split(','):
+        if '=' not in part:
+            continue
+        name, value = part.split('=', 1)
+        try:
+            limits[name.strip()] = int(value)
+        except ValueError:
+            logger.error(f"Ogiltigt värde i CENTRA_OPERATION_CONCURRENCY: {part}")
+    return limits
+
+
+def _is_idempotent(payload):
+    """
+    GraphQL-queries är säkra att skicka om, mutations är det inte.
+    """
+    if not payload:
+        return False
+    return not payload.get("query", "").lstrip().startswith("mutation")
+
+
+class TokenBucket:
+    """
+    Enkel trådsäker token bucket. acquire() blockerar tills en token finns.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _operation_name(payload):
+    """
+    Plockar ut operationsnamnet (t.ex. "Orders") ur en GraphQL-payload
+    så att latensen kan loggas per query-typ.
+    """
+    if not payload:
+        return "unknown"
+    match = _OPERATION_RE.search(payload.get("query", ""))
+    return match.group(2) if match else "anonymous"
+
+
+class CentraClient:
+    """
+    Wrapper runt requests.Session med gzip, keep-alive, anropsschemaläggning
+    (rate limit, samtidighetstak, omförsök) och latensstatistik per operation.
+    """
+
+    def __init__(self, pool_size=CENTRA_POOL_SIZE,
+                 rate_limit=CENTRA_RATE_LIMIT,
+                 rate_burst=CENTRA_RATE_BURST,
+                 max_retries=CENTRA_MAX_RETRIES,
+                 operation_concurrency=None):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate_limit, rate_burst)
+        if operation_concurrency is None:
+            operation_concurrency = _parse_concurrency(CENTRA_OPERATION_CONCURRENCY)
+        self._semaphores = {
+            op: threading.BoundedSemaphore(max(limit, 1))
+            for op, limit in operation_concurrency.items()
+        }
+        self._default_semaphore = threading.BoundedSemaphore(max(pool_size, 1))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive"
+        })
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+
+    def post(self, url, json=None, headers=None, timeout=None):
+        """
+        Samma signatur som requests.post, men går via den delade sessionen.
+        Varje försök väntar på token bucket och operationens samtidighetstak;
+        queries skickas om med backoff vid 429, 5xx, timeout och anslutningsfel.
+        """
+        operation = _operation_name(json)
+        retryable = _is_idempotent(json)
+        semaphore = self._semaphores.get(operation, self._default_semaphore)
+
+        attempt = 0
+        while True:
+            resp = None
+            error = None
+            with semaphore:
+                self._bucket.acquire()
+                start = time.perf_counter()
+                try:
+                    resp = self.session.post(url, json=json, headers=headers, timeout=timeout)
+                except (requests.Timeout, requests.ConnectionError) as e:
+                    error = e
+                finally:
+                    elapsed = time.perf_counter() - start
+                    self._record(operation, elapsed)
+                    logger.debug(f"Centra {operation}: {elapsed * 1000:.0f} ms")
+
+            transient = error is not None or resp.status_code in RETRY_STATUS_CODES
+            if not transient:
+                return resp
+            if not retryable or attempt >= self.max_retries:
+                if error is not None:
+                    raise error
+                return resp
+
+            delay = self._backoff_delay(attempt, resp)
+            reason = str(error) if error is not None else f"status {resp.status_code}"
+            logger.warning(f"Centra {operation}: {reason}, försök {attempt + 1}/{self.max_retries}, "
+                           f"väntar {delay:.1f} s")
+            self._record_retry(operation)
+            time.sleep(delay)
+            attempt += 1
+
+    def _backoff_delay(self, attempt, resp):
+        # Exponentiell backoff med "full jitter", men aldrig kortare än Retry-After
+        delay = random.uniform(0, min(CENTRA_BACKOFF_MAX, CENTRA_BACKOFF_BASE * (2 ** attempt)))
+        if resp is not None:
+            try:
+                delay = max(delay, float(resp.headers.get('Retry-After', 0)))
+            except (TypeError, ValueError):
+                pass
+        return min(delay, CENTRA_BACKOFF_MAX)
+
+    def _record(self, operation, elapsed):
+        with self._stats_lock:
+            s = self._stats.setdefault(operation, {"calls": 0, "total": 0.0, "max": 0.0, "retries": 0})
+            s["calls"] += 1
+            s["total"] += elapsed
+            s["max"] = max(s["max"], elapsed)
+
+    def _record_retry(self, operation):
+        with self._stats_lock:
+            if operation in self._stats:
+                self._stats[operation]["retries"] += 1
+
+    def get_stats(self):
+        """
+        Returnerar latensstatistik per operation:
+        {"Orders": {"calls": 12, "avg_ms": 230.0, "max_ms": 810.0, "retries": 1}, ...}
+        """
+        with self._stats_lock:
+            return {
+                op: {
+                    "calls": s["calls"],
+                    "avg_ms": round(s["total"] / s["calls"] * 1000, 1),
+                    "max_ms": round(s["max"] * 1000, 1),
+                    "retries": s["retries"]
+                }
+                for op, s in self._stats.items()
+            }
+
+    def log_stats(self):
+        for op, s in sorted(self.get_stats().items()):
+            logger.info(f"Centra {op}: {s['calls']} anrop, snitt {s['avg_ms']} ms, "
+                        f"max {s['max_ms']} ms, {s['retries']} omförsök")
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_centra_client():
+    """
+    Returnerar den processgemensamma klienten (skapas vid första anropet).
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = CentraClient()
+    return _client
@@ -1,33 +1,49 @@
 import os
-import requests
 import json
 import pandas as pd
 import numpy as np
+import time
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
 import logging
+import uuid
 
 ##############################
 # Om du använder firebase_storage
 # (annars ta bort om du inte har den filen)
 ##############################
 from firebase_storage import (
+    BlobReadError,
+    GenerationConflict,
+    ORDER_SCHEMA,
+    apply_schema,
     save_active_orders,
-    load_active_orders,
+    load_active_orders_snapshot,
+    active_orders_generation,
+    get_active_orders_state,
     backup_orders,
-    save_product_costs,
+    save_product_costs as firebase_save_product_costs,
     load_product_costs as firebase_load_product_costs
 )
+from centra_client import get_centra_client
+import sales_cache
+from catalog_cache import CatalogCache
+from search_index import ProductSearchIndex
+from sales_cube import SalesCube
+from order_store import OrderStore, ReadWriteLock, CREATE, CANCEL, COMPLETE, REACTIVATE
+from order_archive import OrderArchive
+from product_costs import ProductCostTable
+from delivery_costs import avg_costs_by_product, calculate_delivery_avg_costs
+from order_journal import (
+    OrderJournal,
+    JournalWriter,
+    WRITE_BEHIND_SHUTDOWN_TIMEOUT,
+    records_for_event
+)
 
 
 # Globala variabler
-ALL_ORDERS_DF = pd.DataFrame(columns=[
-    'OrderDate',
-    'OrderName',
-    'ProductID',
-    'Size',
-    'Quantity ordered',
-    'IsActive'
-])
 DATAFRAME_CACHE = {}  # t.ex. {"stats_df": df}
 
 logging.basicConfig(
@@ -39,46 +55,62 @@ logger = logging.getLogger(__name__)
 # Filnamn för ordrar och kostnader
 ACTIVE_ORDERS_FILE = "active_orders.csv"
 PRODUCT_COSTS_FILE = "product_costs.csv"
+
+# Snittkostnader i minnet, läses om när filen i Firebase ändrats
+PRODUCT_COSTS = ProductCostTable()
 PRICE_LISTS_FILE = "price_lists.json"
+REORDER_OVERRIDES_FILE = "reorder_overrides.csv"
 
 # Timeout för requests
 REQUESTS_TIMEOUT = 300
 
+# Antal datumchunkar som hämtas parallellt från Centra
+SALES_CHUNK_WORKERS = int(os.environ.get('SALES_CHUNK_WORKERS', 4))
+
+# Antal leverantörer vars varianter hämtas parallellt
+SUPPLIER_FETCH_WORKERS = int(os.environ.get('SUPPLIER_FETCH_WORKERS', 6))
+
+# Antal collections som packas ihop i en GraphQL-request (via alias)
+# och antal sådana requests som körs parallellt
+COLLECTIONS_PER_REQUEST = int(os.environ.get('COLLECTIONS_PER_REQUEST', 10))
+COLLECTION_FETCH_WORKERS = int(os.environ.get('COLLECTION_FETCH_WORKERS', 4))
+
+# Antal produkt-ID:n per lagerfråga vid bulkhämtning av lagersaldo
+STOCK_BATCH_SIZE = int(os.environ.get('STOCK_BATCH_SIZE', 50))
+STOCK_FETCH_WORKERS = int(os.environ.get('STOCK_FETCH_WORKERS', 4))
+
 
 # -----------------------------------------------------------
 # 1) Snittkostnader (product_costs.csv)
 # -----------------------------------------------------------
 def init_data_store():
     """
-    Initierar product_costs.csv om den inte finns
+    Initierar product_costs om den inte finns. Kan den inte läsas, eller
+    har en annan process hunnit skapa den, lämnas den orörd.
     """
     try:
-        df = firebase_load_product_costs()
+        df = firebase_load_product_costs(raise_on_error=True)
         if df is None:
             df = pd.DataFrame(columns=["ProductID", "AvgCost", "LastUpdated"])
-            save_product_costs(df)
-            logger.info("Skapade tom product_costs i Firebase.")
+            try:
+                if firebase_save_product_costs(df, if_generation_match=0):
+                    logger.info("Skapade tom product_costs i Firebase.")
+            except GenerationConflict:
+                logger.info("product_costs skapades av en annan process.")
         else:
             logger.info("product_costs finns redan i Firebase.")
+        PRODUCT_COSTS.invalidate()
     except Exception as e:
         logger.error(f"Fel vid initiering av product_costs: {str(e)}")
 
 
-def load_product_costs():
+def load_product_costs(columns=None):
     """
-    Läser in product costs från Firebase
+    Returnerar en kopia av snittkostnaderna ur PRODUCT_COSTS (hämtas från
+    Firebase bara första gången och när filen ändrats).
     """
     try:
-        df = firebase_load_product_costs()
-        if df is None:
-            df = pd.DataFrame(columns=["ProductID", "AvgCost", "LastUpdated"])
-
-        if "AvgCost" not in df.columns:
-            df["AvgCost"] = 0.0
-        if "LastUpdated" not in df.columns:
-            df["LastUpdated"] = ""
-
-        return df
+        return PRODUCT_COSTS.frame(columns=columns)
     except Exception as e:
         logger.error(f"Fel vid laddning av product costs: {str(e)}")
         return pd.DataFrame(columns=["ProductID", "AvgCost", "LastUpdated"])
@@ -97,108 +129,305 @@ def save_product_costs(df):
 
 
 def get_current_avg_cost(product_id):
-    cost_df = load_product_costs()
-    row = cost_df[cost_df["ProductID"] == product_id]
-    if row.empty:
+    try:
+        return PRODUCT_COSTS.get(product_id)
+    except Exception as e:
+        logger.error(f"Fel vid hämtning av snittkostnad: {str(e)}")
         return 0.0
-    return float(row["AvgCost"].iloc[0])
 
 
-def update_avg_cost(product_id, new_cost):
-    cost_df = load_product_costs()
-    idx = cost_df[cost_df["ProductID"] == product_id].index
-    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    if len(idx) == 0:
-        new_row = pd.DataFrame([{
-            "ProductID": product_id,
-            "AvgCost": new_cost,
-            "LastUpdated": now_str
-        }])
-        cost_df = pd.concat([cost_df, new_row], ignore_index=True)
-    else:
-        cost_df.loc[idx, "AvgCost"] = new_cost
-        cost_df.loc[idx, "LastUpdated"] = now_str
+def update_avg_costs(mapping):
+    """
+    Uppdaterar snittkostnaden för flera produkter ({ProductID: kostnad})
+    och sparar product_costs en gång. Returnerar True om det sparades.
+    """
+    try:
+        return PRODUCT_COSTS.update_many(mapping)
+    except Exception as e:
+        logger.error(f"Fel vid uppdatering av snittkostnader: {str(e)}")
+        return False
 
-    save_product_costs(cost_df)
+
+def update_avg_cost(product_id, new_cost):
+    return update_avg_costs({product_id: new_cost})
 
 
 # -----------------------------------------------------------
 # 2) Funktioner för att hantera ordrar
 # -----------------------------------------------------------
-def load_orders_from_file():
-    global ALL_ORDERS_DF
+ORDER_COLUMNS = [
+    "OrderDate",
+    "OrderName",
+    "ProductID",
+    "Size",
+    "Quantity ordered",
+    "Mottagen mängd",
+    "PurchasePrice",
+    "Price",
+    "Currency",
+    "Exchange rate",
+    "Shipping",
+    "Customs",
+    "Kommentar",
+    "IsActive"
+]
+
+# Aktiva leveranser och de som färdigställts sedan senaste komprimeringen,
+# med index per leverans. Äldre färdigställda ligger i ORDER_ARCHIVE.
+ORDER_STORE = OrderStore(ORDER_COLUMNS)
+ORDER_ARCHIVE = OrderArchive()
+ORDER_JOURNAL = OrderJournal()
+
+# Läs-/skrivlås för ORDER_STORE inom processen. Mellan processer (flera
+# WSGI-workers) skyddas ordrarna av generationsvillkor i Firebase, se
+# sync_orders och _reload_orders.
+ORDERS_LOCK = ReadWriteLock()
+
+# Hur ofta läsningar kontrollerar om en annan process ändrat ordrarna
+ORDER_SYNC_INTERVAL_SECONDS = float(os.environ.get('ORDER_SYNC_INTERVAL_SECONDS', 5))
+_last_order_sync = 0.0
+
+# True när ögonblicksbild och journal senast lästes in utan fel. Annars kan
+# ORDER_STORE sakna ordrar och får inte sparas som ny ögonblicksbild.
+_orders_loaded = False
+
+
+def _normalize_orders_df(df):
+    if 'IsActive' in df.columns:
+        df['IsActive'] = df['IsActive'].astype(bool)
+    else:
+        df['IsActive'] = True
+
+    for col in ORDER_COLUMNS:
+        if col not in df.columns:
+            if col in ["Price", "Exchange rate", "Shipping", "Customs"]:
+                df[col] = 0.0
+            elif col == "Currency":
+                df[col] = "SEK"
+            elif col == "Kommentar":
+                df[col] = ""
+            elif col == "IsActive":
+                df[col] = True
+            elif col == "Mottagen mängd":
+                df[col] = df["Quantity ordered"]
+    return df
 
-    required_columns = [
-        "OrderDate",
-        "OrderName",
-        "ProductID",
-        "Size",
-        "Quantity ordered",
-        "Mottagen mängd",
-        "PurchasePrice",
-        "Price",
-        "Currency",
-        "Exchange rate",
-        "Shipping",
-        "Customs",
-        "Kommentar",
-        "IsActive"
-    ]
 
+def _reload_orders():
+    """
+    Läser in ögonblicksbilden och spelar upp journalen efter den, och
+    applicerar sedan ändringar som ännu inte är skrivna ovanpå. Anropas
+    med ORDERS_LOCK.write() tagen. Kastar BlobReadError om ögonblicksbilden
+    eller journalen inte kunde läsas.
+    """
+    global _orders_loaded
+    _orders_loaded = False
+    df, snapshot_seq = load_active_orders_snapshot()
+    if df is None:
+        logger.info("Ingen ögonblicksbild av ordrar i Firebase, utgår från tom.")
+        df = pd.DataFrame(columns=ORDER_COLUMNS)
+
+    # En batch kan hinna skrivas medan vi läser in; den ska inte
+    # appliceras två gånger
+    replayed_ids = set()
+
+    def apply_replayed(event):
+        replayed_ids.add(event.get('id'))
+        ORDER_STORE.apply_event(event)
+
+    ORDER_STORE.load(df)
+    ORDER_ARCHIVE.invalidate()
+    ORDER_JOURNAL.replay(snapshot_seq, apply_replayed)
+    for event in ORDER_WRITER.unwritten_events():
+        if event['id'] not in replayed_ids:
+            ORDER_STORE.apply_event(event)
+
+    if len(ORDER_STORE) == 0 and ORDER_JOURNAL.last_seq == 0:
+        logger.info("Inga ordrar hittades i Firebase.")
+        ORDER_STORE.load(pd.DataFrame(columns=ORDER_COLUMNS))
+    else:
+        ORDER_STORE.load(_normalize_orders_df(ORDER_STORE.snapshot()))
+    _orders_loaded = True
+
+
+def load_orders_from_file():
+    """
+    Läser senaste ögonblicksbilden (active_orders) och spelar upp
+    orderjournalen efter den.
+    """
+    global _last_order_sync
     try:
-        df = load_active_orders()
+        with ORDERS_LOCK.write():
+            _reload_orders()
+            _last_order_sync = time.monotonic()
 
-        if df is not None:
-            if 'IsActive' in df.columns:
-                df['IsActive'] = df['IsActive'].astype(bool)
-            else:
-                df['IsActive'] = True
-
-            for col in required_columns:
-                if col not in df.columns:
-                    if col in ["Price", "Exchange rate", "Shipping", "Customs"]:
-                        df[col] = 0.0
-                    elif col == "Currency":
-                        df[col] = "SEK"
-                    elif col == "Kommentar":
-                        df[col] = ""
-                    elif col == "IsActive":
-                        df[col] = True
-                    elif col == "Mottagen mängd":
-                        df[col] = df["Quantity ordered"]
-
-            ALL_ORDERS_DF = df
-            logger.info(f"Laddade ordrar från Firebase. Antal rader: {len(df)}")
-            logger.info(f"Aktiva ordrar: {df[df['IsActive'] == True]['OrderName'].unique().tolist()}")
-            logger.info(f"Inaktiva ordrar: {df[df['IsActive'] == False]['OrderName'].unique().tolist()}")
-        else:
-            logger.info("Inga ordrar hittades i Firebase. ALL_ORDERS_DF blir tom.")
-            ALL_ORDERS_DF = pd.DataFrame(columns=required_columns)
+        logger.info(f"Laddade ordrar från Firebase. Antal rader: {len(ORDER_STORE)}, "
+                    f"leveranser: {len(ORDER_STORE.order_names())}")
+
+        # Färdigställda leveranser flyttas till arkivet vid komprimering,
+        # även de som ligger kvar i en äldre ögonblicksbild
+        if ORDER_JOURNAL.should_compact() or ORDER_STORE.summaries(active=False):
+            save_orders_to_file()
 
     except Exception as e:
         logger.error(f"Fel vid läsning från Firebase: {str(e)}")
-        ALL_ORDERS_DF = pd.DataFrame(columns=required_columns)
+        ORDER_STORE.load(pd.DataFrame(columns=ORDER_COLUMNS))
 
 
-def save_orders_to_file():
-    global ALL_ORDERS_DF
+def sync_orders(force=False):
+    """
+    Hämtar ändringar som andra processer gjort. Körs högst en gång per
+    ORDER_SYNC_INTERVAL_SECONDS (om inte force) och kostar då två
+    metadataanrop. Ny ögonblicksbild ger full omläsning. Nya händelser i
+    journalen spelas upp, eller ger full omläsning om egna ändringar
+    väntar på att skrivas (de ska ligga efter de andras).
+    """
+    global _last_order_sync
+    if not force and time.monotonic() - _last_order_sync < ORDER_SYNC_INTERVAL_SECONDS:
+        return
     try:
-        numeric_cols = ['Mottagen mängd', 'new_price_sek', 'new_avg_cost']
-        for col in numeric_cols:
-            if col in ALL_ORDERS_DF.columns:
-                ALL_ORDERS_DF[col] = pd.to_numeric(ALL_ORDERS_DF[col], errors='coerce').fillna(0)
-
-        if save_active_orders(ALL_ORDERS_DF):
-            logger.info(f"Sparade {len(ALL_ORDERS_DF)} rader till Firebase Storage")
-            if backup_orders():
-                logger.info("Skapade backup av ordrar")
-            else:
-                logger.warning("Kunde inte skapa backup av ordrar")
-        else:
-            logger.error("Kunde inte spara ordrar till Firebase Storage")
+        with ORDERS_LOCK.write():
+            if not force and time.monotonic() - _last_order_sync < ORDER_SYNC_INTERVAL_SECONDS:
+                return
+            _last_order_sync = time.monotonic()
+
+            if not _orders_loaded:
+                logger.info("Ordrarna kunde inte läsas in tidigare, försöker igen")
+                _reload_orders()
+                return
+
+            generation, snapshot_seq = get_active_orders_state()
+            if generation != active_orders_generation():
+                logger.info(f"En annan process har sparat ordrar t.o.m. {snapshot_seq}, läser in på nytt")
+                _reload_orders()
+                return
+
+            seqs = ORDER_JOURNAL.seqs_after(ORDER_JOURNAL.last_seq)
+            if not seqs:
+                return
+            if ORDER_WRITER.queue_depth():
+                _reload_orders()
+            elif ORDER_JOURNAL.catch_up(ORDER_STORE.apply_event, seqs):
+                ORDER_STORE.load(_normalize_orders_df(ORDER_STORE.snapshot()))
+    except Exception as e:
+        logger.error(f"Fel vid synkning av ordrar: {str(e)}")
+
+
+def _reload_orders_after_conflict():
+    """
+    conflict_fn för skrivaren: en annan process har skrivit till journalen
+    eller sparat en ny ögonblicksbild.
+    """
+    global _last_order_sync
+    with ORDERS_LOCK.write():
+        _reload_orders()
+        _last_order_sync = time.monotonic()
+
+
+def _save_orders_snapshot():
+    """
+    Komprimerar journalen: flyttar färdigställda leveranser till arkivet,
+    sparar de aktiva som ny ögonblicksbild och tar en backup. Hoppar över
+    om det finns ändringar som ännu inte skrivits till journalen.
+    Returnerar True om sparad.
+    """
+    with ORDERS_LOCK.write():
+        if not _orders_loaded:
+            logger.error("Ordrarna är inte fullständigt inlästa, sparar ingen ögonblicksbild")
+            return False
+        if ORDER_WRITER.queue_depth():
+            logger.info("Ändringar väntar i skrivarkön, skjuter upp ögonblicksbilden")
+            return False
+
+        ORDER_STORE.coerce_numeric(['Mottagen mängd', 'new_price_sek', 'new_avg_cost'])
+        snapshot = ORDER_STORE.snapshot()
+        journal_seq = ORDER_JOURNAL.last_seq
+        generation = active_orders_generation()
+        completed = snapshot[snapshot['IsActive'] == False]
+        completed_names = completed['OrderName'].astype(str).unique().tolist()
+        completed_summaries = {name: ORDER_STORE.summary(name) for name in completed_names}
+        active = snapshot[snapshot['IsActive'] == True]
+
+    try:
+        # Återaktiverade leveranser finns både här och i arkivet
+        reactivated = [name for name in active['OrderName'].astype(str).unique()
+                       if ORDER_ARCHIVE.has_order(name)]
+        if completed_names or reactivated:
+            for summary in completed_summaries.values():
+                summary['OrderDate'] = str(summary['OrderDate'])
+            if not ORDER_ARCHIVE.archive(completed, completed_summaries, remove=reactivated):
+                logger.error("Kunde inte arkivera färdigställda leveranser")
+                return False
+        saved = save_active_orders(active, journal_seq=journal_seq, if_generation_match=generation)
+    except GenerationConflict:
+        logger.warning("En annan process har sparat ordrarna, läser in på nytt i stället")
+        sync_orders(force=True)
+        return False
+    except BlobReadError as e:
+        logger.error(f"Fel vid läsning av orderarkivet, sparar ingen ögonblicksbild: {str(e)}")
+        return False
+
+    if not saved:
+        logger.error("Kunde inte spara ordrar till Firebase Storage")
+        return False
+
+    logger.info(f"Sparade {len(active)} rader till Firebase Storage, "
+                f"arkiverade {len(completed_names)} leveranser")
+    with ORDERS_LOCK.write():
+        for name in completed_names:
+            # Kan ha återaktiverats medan vi sparade
+            if not ORDER_STORE.is_order_active(name):
+                ORDER_STORE.remove_order(name)
+    ORDER_JOURNAL.mark_compacted(journal_seq)
+    if backup_orders():
+        logger.info("Skapade backup av ordrar")
+    else:
+        logger.warning("Kunde inte skapa backup av ordrar")
+    return True
+
 
+def save_orders_to_file():
+    """
+    Väntar in skrivarkön och sparar sedan en ny ögonblicksbild.
+    """
+    try:
+        if not ORDER_WRITER.flush(timeout=WRITE_BEHIND_SHUTDOWN_TIMEOUT):
+            logger.warning("Skrivarkön blev inte tom, sparar ingen ögonblicksbild nu")
+            return False
+        return _save_orders_snapshot()
     except Exception as e:
         logger.error(f"Fel vid sparning till Firebase: {str(e)}")
+        return False
+
+
+ORDER_WRITER = JournalWriter(ORDER_JOURNAL, compact_fn=_save_orders_snapshot,
+                             conflict_fn=_reload_orders_after_conflict)
+
+
+def _record_order_event(event):
+    """
+    Applicerar händelsen på ORDER_STORE och köar den för journalen
+    (write-behind). Returnerar ett nummer som kan ges till flush_orders.
+    """
+    event['id'] = uuid.uuid4().hex
+    with ORDERS_LOCK.write():
+        ORDER_STORE.apply_event(event)
+        return ORDER_WRITER.submit(event)
+
+
+def flush_orders(timeout=None, ticket=None):
+    """
+    Väntar tills köade orderändringar är sparade i Firebase. För anropare
+    som behöver veta att ändringen är beständig. False vid timeout.
+    """
+    return ORDER_WRITER.flush(timeout=timeout, ticket=ticket)
+
+
+def get_order_persistence_status():
+    """
+    Kölängd och senaste skrivning/fel för orderjournalen.
+    """
+    return ORDER_WRITER.status()
 
 
 # -----------------------------------------------------------
@@ -215,7 +444,7 @@ def fetch_all_suppliers(api_endpoint, headers):
     }
     '''
     try:
-        resp = requests.post(
+        resp = get_centra_client().post(
             api_endpoint,
             json={"query": q},
             headers=headers,
@@ -231,7 +460,47 @@ def fetch_all_suppliers(api_endpoint, headers):
         return None
 
 
-def fetch_collections_and_products(api_endpoint, headers):
+def _fetch_collection_products_batch(api_endpoint, headers, batch, limit):
+    """
+    Hämtar en sida produkter för flera collections i en och samma request.
+    batch är en lista med (collection_id, collection_name, page); varje post
+    blir ett eget alias (c0, c1, ...) i queryn.
+    Returnerar en lista med produktlistor i samma ordning som batch
+    (None om en collection saknas eller gav fel).
+    """
+    var_defs = ["$limit:Int!"]
+    fields = []
+    variables = {"limit": limit}
+    for n, (c_id, _, page) in enumerate(batch):
+        var_defs.append(f"$id{n}:Int!")
+        var_defs.append(f"$page{n}:Int!")
+        fields.append(f"c{n}: collection(id:$id{n}) {{ id products(limit:$limit, page:$page{n}) {{ id }} }}")
+        variables[f"id{n}"] = c_id
+        variables[f"page{n}"] = page
+
+    q = f"query CollectionProductsBatch({', '.join(var_defs)}) {{ {' '.join(fields)} }}"
+    r = get_centra_client().post(
+        api_endpoint,
+        json={"query": q, "variables": variables},
+        headers=headers,
+        timeout=REQUESTS_TIMEOUT
+    )
+    r.raise_for_status()
+    d = r.json()
+    if "errors" in d:
+        logger.error(f"Fel i sub-query för collections {[c[0] for c in batch]}: {d['errors']}")
+
+    result_data = d.get('data') or {}
+    results = []
+    for n in range(len(batch)):
+        the_coll = result_data.get(f"c{n}")
+        results.append(the_coll['products'] if the_coll else None)
+    return results
+
+
+def fetch_collections_and_products(api_endpoint, headers,
+                                   per_request=COLLECTIONS_PER_REQUEST,
+                                   max_workers=COLLECTION_FETCH_WORKERS):
     coll_query = '''
     query Collections {
         collections {
@@ -243,7 +512,7 @@ def fetch_collections_and_products(api_endpoint, headers):
     '''
     product_map = {}
     try:
-        r = requests.post(
+        r = get_centra_client().post(
             api_endpoint,
             json={"query": coll_query},
             headers=headers,
@@ -258,53 +527,34 @@ def fetch_collections_and_products(api_endpoint, headers):
         if not all_cols:
             return {}
 
-        coll_products_query = '''
-        query CollectionProducts($id:Int!, $limit:Int!, $page:Int!){
-          collection(id:$id){
-            id
-            name
-            products(limit:$limit, page:$page) {
-              id
-            }
-          }
-        }
-        '''
-        for c in all_cols:
-            c_id = c['id']
-            c_name = c['name']
-            page = 1
-            limit = 100
-            while True:
-                vars_ = {"id": int(c_id), "limit": limit, "page": page}
-                r2 = requests.post(
-                    api_endpoint,
-                    json={"query": coll_products_query, "variables": vars_},
-                    headers=headers,
-                    timeout=REQUESTS_TIMEOUT
-                )
-                r2.raise_for_status()
-                d2 = r2.json()
-                if "errors" in d2:
-                    logger.error(f"Fel i sub-query for collection {c_id}: {d2['errors']}")
-                    break
-
-                the_coll = d2['data']['collection']
-                if not the_coll or not the_coll['products']:
-                    break
-
-                products_list = the_coll['products']
-                if len(products_list) == 0:
-                    break
-
-                for p in products_list:
-                    pid = str(p['id']).strip().upper()
-                    if pid not in product_map:
-                        product_map[pid] = set()
-                    product_map[pid].add(c_name)
-
-                if len(products_list) < limit:
-                    break
-                page += 1
+        limit = 100
+        # Varje runda hämtar nästa sida för alla collections som inte är klara,
+        # packade i batchar om per_request collections som körs parallellt.
+        pending = [(int(c['id']), c['name'], 1) for c in all_cols]
+        rounds = 0
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            while pending:
+                rounds += 1
+                batches = [pending[i:i + per_request] for i in range(0, len(pending), per_request)]
+                next_pending = []
+                for batch, results in zip(batches, executor.map(
+                        lambda b: _fetch_collection_products_batch(api_endpoint, headers, b, limit),
+                        batches)):
+                    for (c_id, c_name, page), products_list in zip(batch, results):
+                        if not products_list:
+                            continue
+
+                        for p in products_list:
+                            pid = str(p['id']).strip().upper()
+                            if pid not in product_map:
+                                product_map[pid] = set()
+                            product_map[pid].add(c_name)
+
+                        if len(products_list) >= limit:
+                            next_pending.append((c_id, c_name, page + 1))
+                pending = next_pending
+
+        logger.info(f"Hämtade collections för {len(all_cols)} collections på {rounds} rundor")
 
     except Exception as e:
         logger.error(f"Fel vid hämtning av collections: {str(e)}")
@@ -344,7 +594,7 @@ def fetch_supplied_product_variants(api_endpoint, headers, supplier_id, products
     while True:
         vars_ = {"id": supplier_id, "limit": products_limit, "page": page}
         try:
-            r = requests.post(
+            r = get_centra_client().post(
                 api_endpoint,
                 json={"query": q, "variables": vars_},
                 headers=headers,
@@ -371,12 +621,19 @@ def fetch_supplied_product_variants(api_endpoint, headers, supplier_id, products
     return variants
 
 
-def fetch_all_suppliers_and_variants(api_endpoint, headers, products_limit=100):
+def _fetch_supplier_variants_timed(api_endpoint, headers, supplier_id, products_limit):
+    start = time.perf_counter()
+    variants = fetch_supplied_product_variants(api_endpoint, headers, supplier_id, products_limit)
+    return variants, time.perf_counter() - start
+
+
+def fetch_all_suppliers_and_variants(api_endpoint, headers, products_limit=100,
+                                     max_workers=SUPPLIER_FETCH_WORKERS):
     suppliers = fetch_all_suppliers(api_endpoint, headers)
     if suppliers is None:
         return None
 
-    suppliers_data = {}
+    valid_suppliers = []
     for sup in suppliers:
         supplier_id = sup['id']
         try:
@@ -384,9 +641,32 @@ def fetch_all_suppliers_and_variants(api_endpoint, headers, products_limit=100):
         except ValueError:
             logger.error(f"Ogiltigt supplier ID: {supplier_id}")
             continue
+        valid_suppliers.append((supplier_id, sup['name']))
+
+    # Hämta varianterna parallellt, men slå ihop dem i leverantörsordning nedan
+    # så att resultatet blir detsamma som vid sekventiell hämtning.
+    results = [None] * len(valid_suppliers)
+    timings = [0.0] * len(valid_suppliers)
+    if valid_suppliers:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(valid_suppliers)))) as executor:
+            futures = {
+                executor.submit(_fetch_supplier_variants_timed, api_endpoint, headers,
+                                supplier_id, products_limit): i
+                for i, (supplier_id, _) in enumerate(valid_suppliers)
+            }
+            for fut in as_completed(futures):
+                i = futures[fut]
+                variants, elapsed = fut.result()
+                results[i] = variants
+                timings[i] = elapsed
+                logger.info(f"Hämtade {len(variants)} varianter för leverantör "
+                            f"{valid_suppliers[i][1]} på {elapsed:.2f} s")
 
-        supplier_name = sup['name']
-        variants = fetch_supplied_product_variants(api_endpoint, headers, supplier_id, products_limit)
+        slowest = max(range(len(timings)), key=timings.__getitem__)
+        logger.info(f"Långsammast leverantör: {valid_suppliers[slowest][1]} ({timings[slowest]:.2f} s)")
+
+    suppliers_data = {}
+    for (supplier_id, supplier_name), variants in zip(valid_suppliers, results):
         if not variants:
             logger.info(f"Inga varianter för leverantör: {supplier_name}")
             continue
@@ -457,7 +737,7 @@ def fetch_all_product_costs(api_endpoint, headers, limit=100):
     while True:
         vars_ = {"limit": limit, "page": page}
         try:
-            r = requests.post(
+            r = get_centra_client().post(
                 api_endpoint,
                 json={"query": q, "variables": vars_},
                 headers=headers,
@@ -529,7 +809,7 @@ def fetch_all_products(api_endpoint, api_token, limit=200):
     while True:
         variables = {"limit": limit, "page": page}
         try:
-            r = requests.post(
+            r = get_centra_client().post(
                 api_endpoint,
                 json={"query": product_query_template, "variables": variables},
                 headers=headers,
@@ -607,6 +887,46 @@ def fetch_all_products(api_endpoint, api_token, limit=200):
     return df
 
 
+# Delad snapshot av produktkatalogen för alla routes (se catalog_cache.py)
+CATALOG_CACHE = CatalogCache(fetch_all_products)
+
+
+def get_catalog_products(api_endpoint, api_token, force_refresh=False):
+    """
+    Som fetch_all_products, men svarar från den delade katalog-snapshoten.
+    """
+    return CATALOG_CACHE.get(api_endpoint, api_token, force_refresh=force_refresh)
+
+
+# Sökindex som byggs om varje gång katalogen hämtas om
+SEARCH_INDEX = None
+
+
+def _rebuild_search_index(products_df):
+    global SEARCH_INDEX
+    if products_df.empty:
+        SEARCH_INDEX = None
+        return
+    SEARCH_INDEX = ProductSearchIndex(products_df)
+    logger.info(f"Byggde sökindex över {len(SEARCH_INDEX)} produkter")
+
+
+CATALOG_CACHE.add_listener(_rebuild_search_index)
+
+
+def search_catalog_products(api_endpoint, api_token, query, limit=10):
+    """
+    Söker i ProductID, Product Name och Product Number via sökindexet.
+    Första anropet väntar in katalogen; därefter svarar indexet direkt medan
+    en utgången katalog hämtas om i bakgrunden.
+    """
+    CATALOG_CACHE.get(api_endpoint, api_token, copy=False)
+    index = SEARCH_INDEX
+    if index is None:
+        return []
+    return index.search(query, limit=limit)
+
+
 # -----------------------------------------------------------
 # 3b) Dela upp datum i mindre chunkar
 # -----------------------------------------------------------
@@ -627,8 +947,16 @@ def _split_date_range(from_date_str, to_date_str, chunk_days=7):
 
 def fetch_sales_data_single_range(api_endpoint, headers,
                                   from_date_str, to_date_str,
-                                  only_shipped=False, limit=100):
-    sales_data = []
+                                  only_shipped=False, limit=100,
+                                  abort_event=None,
+                                  aggregate=False):
+    """
+    Hämtar orderrader för ett datumintervall. Som standard returneras en
+    lista med en dict per orderrad. Med aggregate=True summeras varje sida
+    direkt till {(ProductID, Size): quantity} så att minnet växer med antal
+    SKU:er i stället för antal orderrader.
+    """
+    sales_data = {} if aggregate else []
     page = 1
 
     if only_shipped:
@@ -669,6 +997,9 @@ def fetch_sales_data_single_range(api_endpoint, headers,
         '''
 
     while True:
+        if abort_event is not None and abort_event.is_set():
+            logger.info(f"Avbryter hämtning av {from_date_str} - {to_date_str}")
+            return None
         vars_ = {
             "limit": limit,
             "page": page,
@@ -676,7 +1007,7 @@ def fetch_sales_data_single_range(api_endpoint, headers,
             "to": f"{to_date_str}T23:59:59Z"
         }
         try:
-            r = requests.post(
+            r = get_centra_client().post(
                 api_endpoint,
                 json={"query": orders_query, "variables": vars_},
                 headers=headers,
@@ -706,11 +1037,15 @@ def fetch_sales_data_single_range(api_endpoint, headers,
                     product_id = str(product['id']).strip().upper()
                     size = line['size'] if line['size'] else "N/A"
                     quantity = line.get('quantity', 1)
-                    sales_data.append({
-                        "ProductID": product_id,
-                        "Size": size,
-                        "Quantity Sold": quantity
-                    })
+                    if aggregate:
+                        key = (product_id, size)
+                        sales_data[key] = sales_data.get(key, 0) + quantity
+                    else:
+                        sales_data.append({
+                            "ProductID": product_id,
+                            "Size": size,
+                            "Quantity Sold": quantity
+                        })
 
             if len(orders) < limit:
                 break
@@ -723,37 +1058,259 @@ def fetch_sales_data_single_range(api_endpoint, headers,
     return sales_data
 
 
+def _iter_sales_chunks(api_endpoint, headers, date_ranges,
+                       only_shipped=False, limit=100,
+                       max_workers=SALES_CHUNK_WORKERS,
+                       aggregate=False):
+    """
+    Hämtar datumchunkar parallellt och yield:ar (index, start_str, end_str, chunk_data)
+    i den ordning chunkarna blir klara. Misslyckas en chunk yield:as den med
+    chunk_data=None, övriga chunkar avbryts och generatorn avslutas.
+    """
+    if not date_ranges:
+        return
+
+    abort = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(date_ranges))))
+    try:
+        futures = {
+            executor.submit(
+                fetch_sales_data_single_range,
+                api_endpoint,
+                headers,
+                start_str,
+                end_str,
+                only_shipped=only_shipped,
+                limit=limit,
+                abort_event=abort,
+                aggregate=aggregate
+            ): (i, start_str, end_str)
+            for i, (start_str, end_str) in enumerate(date_ranges)
+        }
+        for fut in as_completed(futures):
+            i, start_str, end_str = futures[fut]
+            try:
+                chunk_data = fut.result()
+            except Exception as e:
+                logger.error(f"Fel i chunk {start_str} - {end_str}: {str(e)}")
+                chunk_data = None
+
+            if chunk_data is None:
+                abort.set()
+            yield i, start_str, end_str, chunk_data
+            if chunk_data is None:
+                return
+    finally:
+        # Stoppar pågående chunkar om generatorn stängs i förtid
+        abort.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _merge_sales_totals(totals, chunk_totals):
+    for key, quantity in chunk_totals.items():
+        totals[key] = totals.get(key, 0) + quantity
+
+
 def fetch_sales_data_chunked(api_endpoint, headers,
                              from_date_str, to_date_str,
                              only_shipped=False,
                              limit=100,
-                             chunk_days=7):
+                             chunk_days=7,
+                             max_workers=SALES_CHUNK_WORKERS,
+                             aggregate=False):
+    """
+    Hämtar försäljning chunkat. Med aggregate (se
+    fetch_sales_data_single_range) slås varje chunk ihop med de löpande
+    totalerna så fort den är klar, i stället för att radlistor sparas.
+    """
     date_ranges = _split_date_range(from_date_str, to_date_str, chunk_days=chunk_days)
-    all_sales_data = []
+    chunk_results = [None] * len(date_ranges)
+    totals = {}
 
-    for (start_str, end_str) in date_ranges:
-        logger.info(f"Hämtar orderinfo för intervallet {start_str} - {end_str}")
-        chunk_data = fetch_sales_data_single_range(
+    logger.info(f"Hämtar orderinfo för {len(date_ranges)} intervall med {max_workers} parallella workers")
+    for i, start_str, end_str, chunk_data in _iter_sales_chunks(
             api_endpoint,
             headers,
-            start_str,
-            end_str,
+            date_ranges,
             only_shipped=only_shipped,
-            limit=limit
-        )
+            limit=limit,
+            max_workers=max_workers,
+            aggregate=aggregate):
         if chunk_data is None:
-            logger.warning("Avbryter p.g.a. None i chunk_data.")
+            logger.warning(f"Avbryter p.g.a. None i chunk_data för {start_str} - {end_str}.")
             return None
+        if aggregate:
+            logger.info(f"Hämtade {len(chunk_data)} produkt/storlekar för intervallet {start_str} - {end_str}")
+            _merge_sales_totals(totals, chunk_data)
+        else:
+            logger.info(f"Hämtade {len(chunk_data)} orderrader för intervallet {start_str} - {end_str}")
+            chunk_results[i] = chunk_data
+
+    if aggregate:
+        return totals
+
+    # Slå ihop i datumordning så att resultatet blir detsamma oavsett vilken chunk som blev klar först
+    all_sales_data = []
+    for chunk_data in chunk_results:
         all_sales_data.extend(chunk_data)
 
     return all_sales_data
 
 
+def _cached_sales_days(from_date_str, to_date_str, only_shipped, refresh=False):
+    """
+    Delar upp intervallet i dagar som finns i säljcachen och dagar som
+    måste hämtas. Returnerar ({day_str: totals}, [saknade day_str], antal dagar).
+    """
+    days = [start_str for start_str, _ in _split_date_range(from_date_str, to_date_str, chunk_days=1)]
+    daily = {} if refresh else sales_cache.get_cached_days(only_shipped, days)
+    missing = [d for d in days if d not in daily]
+    logger.info(f"Säljcache: {len(daily)} av {len(days)} dagar cachade, hämtar {len(missing)} från Centra")
+    return daily, missing, len(days)
+
+
+def _iter_missing_sales_days(api_endpoint, headers, missing, only_shipped=False, limit=100,
+                             max_workers=SALES_CHUNK_WORKERS):
+    """
+    Hämtar dagarna i missing från Centra (en dag per chunk), sparar dem i
+    säljcachen och yield:ar (day_str, totals) när de blir klara. Misslyckas
+    en dag yield:as (day_str, None) och generatorn avslutas.
+    """
+    for _, day_str, _, day_totals in _iter_sales_chunks(
+            api_endpoint,
+            headers,
+            [(d, d) for d in missing],
+            only_shipped=only_shipped,
+            limit=limit,
+            max_workers=max_workers,
+            aggregate=True):
+        if day_totals is None:
+            logger.warning(f"Avbryter p.g.a. None i chunk_data för {day_str}.")
+            yield day_str, None
+            return
+        sales_cache.store_day(only_shipped, day_str, day_totals)
+        yield day_str, day_totals
+
+    if missing:
+        sales_cache.enforce_size_limit(only_shipped)
+
+
+def fetch_daily_sales_cached(api_endpoint, headers,
+                             from_date_str, to_date_str,
+                             only_shipped=False,
+                             limit=100,
+                             refresh=False,
+                             max_workers=SALES_CHUNK_WORKERS,
+                             progress_callback=None):
+    """
+    Försäljning per dag för intervallet. Dagar som redan finns i
+    sales_cache läses därifrån och bara saknade (eller ännu inte stängda)
+    dagar hämtas från Centra, en dag per chunk. refresh=True hämtar om alla
+    dagar och skriver över cachen.
+    Returnerar {day_str: {(ProductID, Size): quantity}} eller None vid fel.
+    """
+    daily, missing, num_days = _cached_sales_days(from_date_str, to_date_str, only_shipped, refresh)
+    if progress_callback:
+        progress_callback(f"{len(daily)} av {num_days} dagar fanns i säljcachen, hämtar {len(missing)} från Centra")
+
+    done = 0
+    for day_str, day_totals in _iter_missing_sales_days(api_endpoint, headers, missing,
+                                                        only_shipped=only_shipped, limit=limit,
+                                                        max_workers=max_workers):
+        if day_totals is None:
+            return None
+        daily[day_str] = day_totals
+        done += 1
+        if progress_callback:
+            progress_callback(f"Hämtade försäljning för {day_str} ({done}/{len(missing)})")
+
+    return daily
+
+
+# Senast byggda säljkuben per läge (only_shipped True/False):
+# (kub, byggd enligt time.monotonic(), sista stängda dagen när den byggdes)
+SALES_CUBES = {}
+
+# Hur länge en kub återanvänds för intervall med dagar som inte var stängda
+# när den byggdes. Intervall med bara stängda dagar ändras inte.
+SALES_CUBE_TTL_SECONDS = float(os.environ.get('SALES_CUBE_TTL_SECONDS', 300))
+
+# Max antal dagar som får hämtas från Centra inom en request; fler hämtas
+# av ett bakgrundsjobb (se sales_days_to_fetch). Bör vara större än
+# SALES_CACHE_SHIPPED_SETTLE_DAYS, de dagarna hämtas alltid.
+SALES_CUBE_MAX_SYNC_DAYS = int(os.environ.get('SALES_CUBE_MAX_SYNC_DAYS', 90))
+
+
+def _store_sales_cube(only_shipped, cube):
+    SALES_CUBES[only_shipped] = (cube, time.monotonic(), sales_cache.last_settled_day(only_shipped))
+
+
+def _cached_sales_cube(from_date_str, to_date_str, only_shipped):
+    entry = SALES_CUBES.get(only_shipped)
+    if entry is None:
+        return None
+    cube, built_at, settled_until = entry
+    if not cube.covers(from_date_str, to_date_str):
+        return None
+    if datetime.fromisoformat(to_date_str).date() > settled_until \
+            and time.monotonic() - built_at >= SALES_CUBE_TTL_SECONDS:
+        return None
+    return cube
+
+
+def sales_days_to_fetch(from_date_str, to_date_str, only_shipped=False):
+    """
+    Antal dagar som get_sales_cube skulle behöva hämta från Centra för
+    intervallet (0 om en aktuell kub redan täcker det).
+    """
+    if _cached_sales_cube(from_date_str, to_date_str, only_shipped) is not None:
+        return 0
+    days = [start_str for start_str, _ in _split_date_range(from_date_str, to_date_str, chunk_days=1)]
+    return len(sales_cache.missing_days(only_shipped, days))
+
+
+def get_sales_cube(api_endpoint, api_token, from_date_str, to_date_str, only_shipped=False,
+                   limit=100, refresh=False, progress_callback=None):
+    """
+    Returnerar en SalesCube som täcker intervallet. En redan byggd kub
+    återanvänds om den täcker det och inte är inaktuell (se
+    SALES_CUBE_TTL_SECONDS), annars byggs en ny från säljcachen (och
+    Centra för dagar som saknas). refresh=True hämtar om alla dagar.
+    Returnerar None vid fel.
+    """
+    if not refresh:
+        cube = _cached_sales_cube(from_date_str, to_date_str, only_shipped)
+        if cube is not None:
+            return cube
+
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_token}"
+    }
+    daily = fetch_daily_sales_cached(api_endpoint, headers, from_date_str, to_date_str,
+                                     only_shipped=only_shipped, limit=limit, refresh=refresh,
+                                     progress_callback=progress_callback)
+    if daily is None:
+        return None
+    cube = SalesCube.from_daily_totals(daily, from_date_str, to_date_str)
+    _store_sales_cube(only_shipped, cube)
+    return cube
+
+
 def process_sales_data(sales_data, from_date, to_date):
+    """
+    sales_data är antingen en lista med en dict per orderrad eller redan
+    summerade totaler {(ProductID, Size): quantity}.
+    """
     if not sales_data:
         return pd.DataFrame(columns=["ProductID", "Size", "Quantity Sold", "Avg Daily Sales"])
-    sales_df = pd.DataFrame(sales_data)
-    summ = sales_df.groupby(['ProductID', 'Size']).agg({'Quantity Sold': 'sum'}).reset_index()
+    if isinstance(sales_data, dict):
+        summ = pd.DataFrame(list(sales_data.keys()), columns=['ProductID', 'Size'])
+        summ['Quantity Sold'] = list(sales_data.values())
+        summ = summ.sort_values(['ProductID', 'Size']).reset_index(drop=True)
+    else:
+        sales_df = pd.DataFrame(sales_data)
+        summ = sales_df.groupby(['ProductID', 'Size']).agg({'Quantity Sold': 'sum'}).reset_index()
     days_in_range = (pd.to_datetime(to_date) - pd.to_datetime(from_date)).days + 1
     summ["Avg Daily Sales"] = (summ["Quantity Sold"] / days_in_range).round(1)
     summ["Quantity Sold"] = summ["Quantity Sold"].astype(int)
@@ -769,16 +1326,151 @@ def merge_product_and_sales_data(products_df, sales_summary_df):
     return merged
 
 
-def calculate_reorder_metrics(df, lead_time, safety_stock):
+# Nivåer för överstyrning av leveranstid/säkerhetslager, mest specifik först
+REORDER_OVERRIDE_LEVELS = [['ProductID', 'Size'], ['ProductID'], ['Supplier']]
+
+
+def load_reorder_overrides():
+    """
+    Läser REORDER_OVERRIDES_FILE med kolumnerna Supplier, ProductID, Size,
+    Lead Time och Safety Stock. Tomma nyckelfält betyder "alla", så en rad
+    med bara Supplier gäller hela leverantören och en rad med ProductID men
+    utan Size gäller alla storlekar. Returnerar None om filen saknas.
+    """
+    try:
+        if not os.path.exists(REORDER_OVERRIDES_FILE):
+            return None
+        overrides = pd.read_csv(REORDER_OVERRIDES_FILE, dtype={'Supplier': str, 'ProductID': str, 'Size': str})
+        for column in ['Supplier', 'ProductID', 'Size']:
+            if column not in overrides.columns:
+                overrides[column] = np.nan
+        product_ids = overrides['ProductID']
+        overrides['ProductID'] = product_ids.where(product_ids.isna(), product_ids.astype(str).str.strip().str.upper())
+        return overrides
+    except Exception as e:
+        logger.error(f"Fel vid läsning av beställningsinställningar: {str(e)}")
+        return None
+
+
+def _resolve_reorder_parameter(df, column, default, overrides):
+    """
+    Effektivt värde per rad: egen kolumn i df, sedan överstyrning per
+    SKU, per produkt, per leverantör och sist det globala standardvärdet.
+    """
+    if column in df.columns:
+        values = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=float)
+    else:
+        values = np.full(len(df), np.nan)
+
+    if overrides is not None and column in overrides.columns:
+        for keys in REORDER_OVERRIDE_LEVELS:
+            if not all(k in df.columns for k in keys):
+                continue
+            others = [k for k in ['ProductID', 'Size'] if k not in keys]
+            level = overrides.dropna(subset=keys + [column])
+            level = level[level[others].isna().all(axis=1)] if others else level
+            if level.empty:
+                continue
+            lookup = level.drop_duplicates(keys, keep='last').set_index(keys)[column].astype(float)
+            if len(keys) == 1:
+                index = df[keys[0]].astype(str)
+            else:
+                index = pd.MultiIndex.from_arrays([df[k].astype(str) for k in keys])
+            matched = lookup.reindex(index).to_numpy()
+            values = np.where(np.isnan(values), matched, values)
+
+    return np.where(np.isnan(values), float(default), values)
+
+
+def calculate_reorder_metrics(df, lead_time, safety_stock, overrides=None):
+    """
+    Reorder Level = Avg Daily Sales * leveranstid + säkerhetslager.
+    lead_time och safety_stock är standardvärden; kolumnerna 'Lead Time'
+    och 'Safety Stock' i df eller en overrides-tabell (se
+    load_reorder_overrides) kan sätta egna värden per SKU eller leverantör.
+    """
     if df.empty:
         return df
-    df["Reorder Level"] = (df["Avg Daily Sales"] * lead_time) + safety_stock
-    df["Quantity to Order"] = df["Reorder Level"] - df["Stock Balance"]
-    df["Quantity to Order"] = df["Quantity to Order"].apply(lambda x: max(x, 0))
-    df["Need to Order"] = df["Quantity to Order"].apply(lambda x: "Yes" if x > 0 else "No")
+    per_row = overrides is not None or 'Lead Time' in df.columns or 'Safety Stock' in df.columns
+    lead_times = _resolve_reorder_parameter(df, 'Lead Time', lead_time, overrides)
+    safety_stocks = _resolve_reorder_parameter(df, 'Safety Stock', safety_stock, overrides)
+
+    avg_sales = df["Avg Daily Sales"].to_numpy(dtype=float)
+    stock = df["Stock Balance"].to_numpy(dtype=float)
+    reorder_level = avg_sales * lead_times + safety_stocks
+    quantity = np.maximum(reorder_level - stock, 0)
+
+    if per_row:
+        df["Lead Time"] = lead_times
+        df["Safety Stock"] = safety_stocks
+    df["Reorder Level"] = reorder_level
+    df["Quantity to Order"] = quantity
+    df["Need to Order"] = np.where(quantity > 0, "Yes", "No")
     return df
 
 
+# Max antal scenarier per körning av calculate_reorder_scenarios
+REORDER_MAX_SCENARIOS = int(os.environ.get('REORDER_MAX_SCENARIOS', 50))
+SCENARIO_KEY_COLUMNS = ["ProductID", "Product Name", "Product Number", "Supplier", "Size",
+                        "Stock Balance", "Avg Daily Sales", "Incoming Qty"]
+
+
+def build_scenario_grid(lead_times, safety_stocks):
+    """
+    Alla kombinationer av leveranstider och säkerhetslager, i ordning.
+    """
+    grid = [(float(lt), float(ss)) for lt in lead_times for ss in safety_stocks]
+    if len(grid) > REORDER_MAX_SCENARIOS:
+        raise ValueError(f"För många scenarier ({len(grid)}), max {REORDER_MAX_SCENARIOS}")
+    return grid
+
+
+def scenario_column(lead_time, safety_stock):
+    return f"Quantity to Order (LT {lead_time:g}, SS {safety_stock:g})"
+
+
+def calculate_reorder_scenarios(df, scenarios):
+    """
+    Räknar Quantity to Order för varje (lead_time, safety_stock) i scenarios
+    i ett svep: en matris rader x scenarier i stället för en körning per
+    scenario. Scenariots värden gäller alla rader (överstyrningar per SKU
+    används inte här, så att scenarierna går att jämföra rakt av).
+    Returnerar (DataFrame med nyckelkolumner + en kolumn per scenario,
+    lista med sammanfattning per scenario).
+    """
+    key_columns = [c for c in SCENARIO_KEY_COLUMNS if c in df.columns]
+    if df.empty or not scenarios:
+        return df[key_columns].copy(), []
+
+    lead_times = np.array([lt for lt, _ in scenarios], dtype=float)
+    safety_stocks = np.array([ss for _, ss in scenarios], dtype=float)
+    avg_sales = pd.to_numeric(df["Avg Daily Sales"], errors='coerce').fillna(0).to_numpy(dtype=float)
+    stock = pd.to_numeric(df["Stock Balance"], errors='coerce').fillna(0).to_numpy(dtype=float)
+
+    quantities = np.maximum(
+        avg_sales[:, None] * lead_times[None, :] + safety_stocks[None, :] - stock[:, None],
+        0
+    )
+
+    columns = [scenario_column(lt, ss) for lt, ss in scenarios]
+    out = pd.concat([
+        df[key_columns].reset_index(drop=True),
+        pd.DataFrame(quantities, columns=columns)
+    ], axis=1)
+
+    summary = [
+        {
+            "lead_time": lt,
+            "safety_stock": ss,
+            "column": column,
+            "total_quantity": float(quantities[:, i].sum()),
+            "rows_to_order": int((quantities[:, i] > 0).sum())
+        }
+        for i, ((lt, ss), column) in enumerate(zip(scenarios, columns))
+    ]
+    return out, summary
+
+
 def add_incoming_stock_columns(df):
     if df.empty:
         return df
@@ -789,15 +1481,20 @@ def add_incoming_stock_columns(df):
     if 'Incoming Value' in out.columns:
         out = out.drop(columns=['Incoming Value'])
 
-    active_orders = ALL_ORDERS_DF[ALL_ORDERS_DF['IsActive'] == True].copy()
+    sync_orders()
+    with ORDERS_LOCK.read():
+        active_orders = ORDER_STORE.active_rows(['ProductID', 'Size', 'Quantity ordered'])
     if not active_orders.empty:
-        incoming = active_orders.groupby(['ProductID', 'Size'])['Quantity ordered'].sum().reset_index()
-        for _, row in incoming.iterrows():
-            mask = (
-                (out['ProductID'].astype(str) == str(row['ProductID'])) &
-                (out['Size'].astype(str) == str(row['Size']))
-            )
-            out.loc[mask, 'Incoming Qty'] = row['Quantity ordered']
+        incoming = pd.DataFrame({
+            'ProductID': active_orders['ProductID'].astype(str),
+            'Size': active_orders['Size'].astype(str),
+            'Quantity ordered': pd.to_numeric(active_orders['Quantity ordered'], errors='coerce').fillna(0)
+        }).groupby(['ProductID', 'Size'])['Quantity ordered'].sum()
+
+        keys = pd.MultiIndex.from_arrays([out['ProductID'].astype(str), out['Size'].astype(str)])
+        matched = incoming.reindex(keys).to_numpy()
+        current = pd.to_numeric(out['Incoming Qty'], errors='coerce').to_numpy(dtype=float)
+        out['Incoming Qty'] = np.where(np.isnan(matched), current, matched)
 
     out['Incoming Qty'] = out['Incoming Qty'].fillna(0).astype(int)
     return out
@@ -807,7 +1504,6 @@ def add_incoming_stock_columns(df):
 # 4) Leverans-funktioner
 # -----------------------------------------------------------
 def create_new_delivery(order_name, products_df):
-    global ALL_ORDERS_DF
     required_cols = [
         "ProductID",
         "Product Number",
@@ -840,22 +1536,23 @@ def create_new_delivery(order_name, products_df):
     if 'Quantity to Order' in valid_products.columns:
         valid_products.drop(columns=['Quantity to Order'], inplace=True)
 
-    ALL_ORDERS_DF = pd.concat([ALL_ORDERS_DF, valid_products], ignore_index=True)
-    save_orders_to_file()
+    _record_order_event({
+        'type': CREATE,
+        'order_name': order_name,
+        'rows': records_for_event(valid_products)
+    })
     return True
 
 
 def cancel_delivery(order_name):
-    global ALL_ORDERS_DF
     try:
         logger.info(f"Försöker makulera leverans: {order_name}")
-        order_mask = ALL_ORDERS_DF['OrderName'].astype(str) == str(order_name)
-        if not any(order_mask):
+        sync_orders()
+        if not ORDER_STORE.has_order(order_name):
             logger.warning(f"Hittade ingen leverans med namn: {order_name}")
             return False
 
-        ALL_ORDERS_DF = ALL_ORDERS_DF[~order_mask]
-        save_orders_to_file()
+        _record_order_event({'type': CANCEL, 'order_name': str(order_name)})
         logger.info(f"Leverans {order_name} makulerad")
         return True
     except Exception as e:
@@ -864,89 +1561,102 @@ def cancel_delivery(order_name):
 
 
 def handle_delivery_completion(delivery_df):
-    global ALL_ORDERS_DF
     try:
         order_name = delivery_df['OrderName'].iloc[0]
         logger.info(f"Hanterar färdigställande av leverans: {order_name}")
 
-        order_mask = (ALL_ORDERS_DF['OrderName'].astype(str) == str(order_name))
-        ALL_ORDERS_DF.loc[order_mask, 'IsActive'] = False
-
-        for _, row in delivery_df.iterrows():
-            row_mask = (
-                (ALL_ORDERS_DF['OrderName'].astype(str) == str(order_name)) &
-                (ALL_ORDERS_DF['ProductID'].astype(str) == str(row['ProductID'])) &
-                (ALL_ORDERS_DF['Size'].astype(str) == str(row['Size']))
-            )
-            ALL_ORDERS_DF.loc[row_mask, 'Mottagen mängd'] = row['Mottagen mängd']
-            ALL_ORDERS_DF.loc[row_mask, 'new_avg_cost'] = row['new_avg_cost']
-
-        save_orders_to_file()
+        received_cols = [c for c in ['ProductID', 'Size', 'Mottagen mängd', 'new_avg_cost'] if c in delivery_df.columns]
+        _record_order_event({
+            'type': COMPLETE,
+            'order_name': str(order_name),
+            'received': records_for_event(delivery_df[received_cols])
+        })
         logger.info(f"Leverans {order_name} markerad som inaktiv och sparad")
+
+        # Nya snittkostnader (en per produkt, lager och mottagen mängd för
+        # alla storlekar viktade ihop) sparas i en och samma skrivning
+        costs = avg_costs_by_product(delivery_df)
+        if costs and not update_avg_costs(costs):
+            logger.warning(f"Kunde inte uppdatera snittkostnader för leverans {order_name}")
         return True
     except Exception as e:
         logger.error(f"Fel vid färdigställande av leverans: {str(e)}")
         return False
 
 
-def get_active_deliveries_summary():
-    global ALL_ORDERS_DF
-    if ALL_ORDERS_DF.empty:
-        return []
+def reactivate_delivery(order_name):
+    """
+    Markerar en färdigställd leverans som aktiv igen.
+    Returnerar False om leveransen inte finns.
+    """
+    sync_orders()
+    if not ORDER_STORE.has_order(order_name):
+        # Arkiverad leverans: läggs tillbaka bland ordrarna som aktiv och
+        # tas bort ur arkivet vid nästa komprimering
+        archived = ORDER_ARCHIVE.rows_for_order(order_name)
+        if archived is None or archived.empty:
+            logger.warning(f"Hittade ingen leverans med namn: {order_name}")
+            return False
+        archived['IsActive'] = True
+        _record_order_event({
+            'type': CREATE,
+            'order_name': str(order_name),
+            'rows': records_for_event(archived)
+        })
+        logger.info(f"Leverans {order_name} återaktiverad från arkivet")
+        return True
 
-    active = ALL_ORDERS_DF[ALL_ORDERS_DF['IsActive'] == True].copy()
-    if active.empty:
-        return []
+    _record_order_event({'type': REACTIVATE, 'order_name': str(order_name)})
+    logger.info(f"Leverans {order_name} återaktiverad")
+    return True
 
-    grouped = active.groupby("OrderName").agg({
-        "OrderDate": "first",
-        "Quantity ordered": "sum",
-        "ProductID": "count"
-    }).reset_index()
 
-    grouped.rename(columns={
-        "Quantity ordered": "QuantitySum",
-        "ProductID": "ProductCount"
-    }, inplace=True)
+def get_active_deliveries_summary():
+    sync_orders()
+    with ORDERS_LOCK.read():
+        summaries = ORDER_STORE.summaries(active=True)
 
-    logger.info(f"Aktiva leveranser: {grouped['OrderName'].tolist()}")
-    return grouped.to_dict(orient="records")
+    logger.info(f"Aktiva leveranser: {len(summaries)}")
+    return summaries
 
 
 def get_completed_deliveries_summary():
-    global ALL_ORDERS_DF
-    if ALL_ORDERS_DF.empty:
-        return []
+    sync_orders()
+    with ORDERS_LOCK.read():
+        summaries = ORDER_STORE.summaries(active=False)
+        in_store = set(ORDER_STORE.order_names())
 
-    completed = ALL_ORDERS_DF[ALL_ORDERS_DF['IsActive'] == False].copy()
-    if completed.empty:
-        return []
+    summaries = sorted(summaries + ORDER_ARCHIVE.summaries(exclude=in_store),
+                       key=lambda row: row['OrderName'])
+    logger.info(f"Avklarade leveranser: {len(summaries)}")
+    return summaries
 
-    grouped = completed.groupby("OrderName").agg({
-        "OrderDate": "first",
-        "Quantity ordered": "sum",
-        "ProductID": "count"
-    }).reset_index()
 
-    grouped.rename(columns={
-        "Quantity ordered": "QuantitySum",
-        "ProductID": "ProductCount"
-    }, inplace=True)
-
-    logger.info(f"Avklarade leveranser: {grouped['OrderName'].tolist()}")
-    return grouped.to_dict(orient="records")
+def get_all_orders_df():
+    """
+    Alla orderrader, aktiva och arkiverade. Hämtar samtliga
+    arkivpartitioner, så används bara där hela historiken behövs.
+    """
+    sync_orders()
+    with ORDERS_LOCK.read():
+        current = ORDER_STORE.snapshot(plain=True)
+        in_store = set(ORDER_STORE.order_names())
+    archived = ORDER_ARCHIVE.all_rows()
+    archived = archived[~archived['OrderName'].astype(str).isin(in_store)]
+    return apply_schema(pd.concat([current, archived], ignore_index=True), ORDER_SCHEMA)
 
 
 def get_delivery_details(order_name, only_active=False):
-    global ALL_ORDERS_DF
     order_name = str(order_name)
     logger.info(f"Hämtar leveransdetaljer för: '{order_name}'")
 
-    order_mask = (ALL_ORDERS_DF['OrderName'].astype(str) == order_name)
-    if only_active:
-        order_mask = order_mask & (ALL_ORDERS_DF['IsActive'] == True)
-
-    df = ALL_ORDERS_DF[order_mask].copy()
+    sync_orders()
+    with ORDERS_LOCK.read():
+        df = ORDER_STORE.rows_for_order(order_name, only_active=only_active)
+    if df.empty and not only_active:
+        archived = ORDER_ARCHIVE.rows_for_order(order_name)
+        if archived is not None:
+            df = archived
     if df.empty:
         logger.warning(f"Inga detaljer hittades för leverans: '{order_name}'")
     else:
@@ -957,21 +1667,24 @@ def get_delivery_details(order_name, only_active=False):
 
 
 def verify_active_delivery(order_name):
-    global ALL_ORDERS_DF
     order_name = str(order_name)
 
     logger.info(f"Verifierar leverans: '{order_name}'")
-    logger.info(f"Alla OrderNames i systemet: {ALL_ORDERS_DF['OrderName'].unique().tolist()}")
 
-    if not any(ALL_ORDERS_DF['OrderName'].astype(str) == order_name):
+    sync_orders()
+    with ORDERS_LOCK.read():
+        exists = ORDER_STORE.has_order(order_name)
+        active = exists and ORDER_STORE.is_order_active(order_name)
+
+    if not exists and ORDER_ARCHIVE.has_order(order_name):
+        logger.warning(f"Leverans '{order_name}' är arkiverad och inte aktiv")
+        return False, "Leveransen finns men är inte längre aktiv"
+
+    if not exists:
         logger.warning(f"Leverans '{order_name}' hittades inte i systemet")
         return False, "Leveransen hittades inte i systemet"
 
-    active_mask = (
-        (ALL_ORDERS_DF['OrderName'].astype(str) == order_name) &
-        (ALL_ORDERS_DF['IsActive'] == True)
-    )
-    if not any(active_mask):
+    if not active:
         logger.warning(f"Leverans '{order_name}' finns men är inte aktiv")
         return False, "Leveransen finns men är inte längre aktiv"
 
@@ -1024,7 +1737,7 @@ def get_current_stock_from_centra(api_endpoint, api_token, product_id, size):
         vars_ = {"productId": [product_id_int]}
         logger.info(f"Skickar GraphQL-query med variabler: {vars_}")
 
-        resp = requests.post(
+        resp = get_centra_client().post(
             api_endpoint,
             json={"query": q, "variables": vars_},
             headers=headers,
@@ -1065,6 +1778,140 @@ def get_current_stock_from_centra(api_endpoint, api_token, product_id, size):
         return 0
 
 
+def _normalize_product_id(product_id):
+    """
+    Normaliserar ett produkt-ID så att t.ex. 123, "123", 123.0 och " 123 "
+    blir "123". Returnerar None om ID:t inte är numeriskt.
+    """
+    try:
+        return str(int(float(str(product_id).strip())))
+    except (ValueError, TypeError):
+        return None
+
+
+class StockFetchError(Exception):
+    """
+    Lagersaldot kunde inte hämtas för alla produkter. product_ids är de
+    produkter vars batch misslyckades; de får inte tolkas som lager 0.
+    """
+
+    def __init__(self, message, product_ids):
+        super().__init__(message)
+        self.product_ids = product_ids
+
+
+def _fetch_stock_batch(api_endpoint, headers, product_ids, limit):
+    q = '''
+    query ProductStocksBulk($productId: [Int!]!, $limit: Int!, $page: Int!) {
+        warehouses {
+            stock(where: { productId: $productId }, limit: $limit, page: $page) {
+                productSize {
+                    quantity
+                    size {
+                        name
+                    }
+                    productVariant {
+                        product {
+                            id
+                        }
+                    }
+                }
+            }
+        }
+    }
+    '''
+    stock_map = {}
+    page = 1
+    while True:
+        vars_ = {"productId": product_ids, "limit": limit, "page": page}
+        r = get_centra_client().post(
+            api_endpoint,
+            json={"query": q, "variables": vars_},
+            headers=headers,
+            timeout=REQUESTS_TIMEOUT
+        )
+        r.raise_for_status()
+        data = r.json()
+        if "errors" in data:
+            raise Exception(f"GraphQL error: {data['errors']}")
+
+        warehouses = data.get('data', {}).get('warehouses') or []
+        for warehouse in warehouses:
+            for stock in warehouse.get('stock') or []:
+                product_size = stock.get('productSize') or {}
+                product = ((product_size.get('productVariant') or {}).get('product') or {})
+                pid = _normalize_product_id(product.get('id'))
+                if pid is None:
+                    continue
+                size_name = (product_size.get('size') or {}).get('name')
+                key = (pid, str(size_name))
+                stock_map[key] = stock_map.get(key, 0) + (product_size.get('quantity') or 0)
+
+        # Fortsätt bara om något lager fyllde hela sidan
+        if all(len(w.get('stock') or []) < limit for w in warehouses):
+            break
+        page += 1
+
+    return stock_map
+
+
+def get_current_stock_bulk(api_endpoint, api_token, product_ids,
+                           batch_size=STOCK_BATCH_SIZE, limit=200):
+    """
+    Hämtar lagersaldo för många produkter på en gång, batch_size produkt-ID:n
+    per warehouses-fråga. Returnerar {(ProductID, Size): quantity} med
+    normaliserade produkt-ID:n, använd lookup_stock() för att slå upp en rad.
+    Kastar StockFetchError om någon batch misslyckas.
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_token}"
+    }
+
+    unique_ids = []
+    seen = set()
+    for product_id in product_ids:
+        pid = _normalize_product_id(product_id)
+        if pid is None:
+            logger.error(f"Ogiltigt product_id format: {product_id}")
+            continue
+        if pid not in seen:
+            seen.add(pid)
+            unique_ids.append(int(pid))
+
+    if not unique_ids:
+        return {}
+
+    batches = [unique_ids[i:i + batch_size] for i in range(0, len(unique_ids), batch_size)]
+    logger.info(f"Hämtar lagersaldo för {len(unique_ids)} produkter i {len(batches)} batchar")
+
+    stock_map = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, min(STOCK_FETCH_WORKERS, len(batches)))) as executor:
+        futures = {
+            executor.submit(_fetch_stock_batch, api_endpoint, headers, batch, limit): batch
+            for batch in batches
+        }
+        for fut in as_completed(futures):
+            try:
+                stock_map.update(fut.result())
+            except Exception as e:
+                logger.error(f"Fel vid hämtning av lagersaldo för produkter {futures[fut]}: {str(e)}")
+                failed.extend(str(pid) for pid in futures[fut])
+
+    if failed:
+        raise StockFetchError(f"lagersaldo saknas för {len(failed)} av {len(unique_ids)} produkter", failed)
+    return stock_map
+
+
+def lookup_stock(stock_map, product_id, size):
+    """
+    Slår upp lagersaldo för en (ProductID, Size) i resultatet från
+    get_current_stock_bulk. Saknade kombinationer ger 0.
+    """
+    return stock_map.get((_normalize_product_id(product_id), str(size)), 0)
+
+
 def test_stock_query(api_endpoint, api_token, product_id, size):
     logger.info("=== TEST STOCK QUERY ===")
     logger.info(f"API Endpoint: {api_endpoint}")
@@ -1186,42 +2033,88 @@ def fetch_all_products_with_sales(api_endpoint,
                                   only_shipped=False,
                                   product_limit=200,
                                   orders_limit=100,
-                                  chunk_days=7):
+                                  chunk_days=7,
+                                  use_sales_cache=True,
+                                  refresh_sales_cache=False,
+                                  use_catalog_cache=True,
+                                  progress_callback=None):
     """
     Hämtar produktdata och försäljningsdata chunkat, men returnerar en DF,
-    ingen streaming.
+    ingen streaming. Med use_sales_cache hämtas bara dagar som saknas i
+    säljcachen från Centra, och med use_catalog_cache används den delade
+    katalog-snapshoten i stället för en ny crawl. progress_callback(msg)
+    anropas vid varje steg (används av bakgrundsjobben).
     """
-    products_df = fetch_all_products(api_endpoint, api_token, limit=product_limit)
+    def report(message):
+        if progress_callback:
+            progress_callback(message)
+
+    report("Hämtar produkter...")
+    if use_catalog_cache:
+        products_df = get_catalog_products(api_endpoint, api_token)
+    else:
+        products_df = fetch_all_products(api_endpoint, api_token, limit=product_limit)
     if products_df is None or products_df.empty:
         return None
+    report(f"Hittade {len(products_df)} produkter. Hämtar försäljning...")
 
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_token}"
     }
 
-    sales_data = fetch_sales_data_chunked(
-        api_endpoint,
-        headers,
-        from_date_str,
-        to_date_str,
-        only_shipped=only_shipped,
-        limit=orders_limit,
-        chunk_days=chunk_days
-    )
+    if use_sales_cache:
+        # Kuben sparas så att andra intervall kan räknas ut utan ny hämtning
+        cube = get_sales_cube(api_endpoint, api_token, from_date_str, to_date_str,
+                              only_shipped=only_shipped, limit=orders_limit,
+                              refresh=refresh_sales_cache, progress_callback=progress_callback)
+        if cube is None:
+            return None
+        sales_data = cube.window_dict(from_date_str, to_date_str)
+    else:
+        sales_data = fetch_sales_data_chunked(
+            api_endpoint,
+            headers,
+            from_date_str,
+            to_date_str,
+            only_shipped=only_shipped,
+            limit=orders_limit,
+            chunk_days=chunk_days,
+            aggregate=True
+        )
     if sales_data is None:
         return None
 
+    report("Bearbetar säljdata och beräknar beställningsbehov...")
     sales_summary_df = process_sales_data(sales_data, from_date_str, to_date_str)
     merged_df = merge_product_and_sales_data(products_df, sales_summary_df)
-    merged_df = calculate_reorder_metrics(merged_df, lead_time, safety_stock)
+    merged_df = calculate_reorder_metrics(merged_df, lead_time, safety_stock,
+                                          overrides=load_reorder_overrides())
     merged_df = add_incoming_stock_columns(merged_df)
+    get_centra_client().log_stats()
+    report("KLAR!")
     return merged_df
 
 
 # -----------------------------------------------------------
 # 7) STREAMING-FUNKTION (SSE)
 # -----------------------------------------------------------
+# Kolumner som skickas i "products"- resp. "result"-eventen
+STREAM_PRODUCT_COLUMNS = ["ProductID", "Product Name", "Product Number", "Supplier", "Size", "Stock Balance"]
+STREAM_RESULT_COLUMNS = ["ProductID", "Size", "Quantity Sold", "Avg Daily Sales",
+                         "Reorder Level", "Quantity to Order", "Need to Order", "Incoming Qty"]
+
+
+def _sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def _stream_rows(df, columns):
+    columns = [c for c in columns if c in df.columns]
+    values = df[columns].astype(object).where(df[columns].notna(), None)
+    return {"columns": columns, "rows": values.values.tolist()}
+
+
 def fetch_all_products_with_sales_stream(api_endpoint,
                                          api_token,
                                          from_date_str,
@@ -1231,55 +2124,124 @@ def fetch_all_products_with_sales_stream(api_endpoint,
                                          only_shipped=False,
                                          product_limit=200,
                                          orders_limit=100,
-                                         chunk_days=7):
+                                         chunk_days=7,
+                                         use_sales_cache=True,
+                                         refresh_sales_cache=False,
+                                         use_catalog_cache=True,
+                                         product_filter=None,
+                                         on_complete=None):
     """
     Generator-funktion som YIELD:ar SSE-event steg för steg.
+    Progress skickas som vanliga "data:"-rader. Dessutom skickas:
+    - "products": produktraderna så fort katalogen finns,
+    - "sales": [ProductID, Size, antal] att lägga till, först för allt som
+      fanns i säljkuben/säljcachen och sedan för varje dag som hämtas,
+    - "result": beräknade kolumner när allt är klart.
+    Försäljningen går via samma säljcache och säljkub som
+    fetch_all_products_with_sales, så svaret blir detsamma.
+    product_filter(df) filtrerar katalogen innan något skickas och
+    on_complete(df) får den färdiga DataFramen.
     """
     yield "data: Startar hämtning av produkter...\n\n"
-    products_df = fetch_all_products(api_endpoint, api_token, limit=product_limit)
+    if use_catalog_cache:
+        products_df = get_catalog_products(api_endpoint, api_token)
+    else:
+        products_df = fetch_all_products(api_endpoint, api_token, limit=product_limit)
     if products_df is None or products_df.empty:
         yield "data: Inga produkter funna.\n\n"
         return
 
+    if product_filter is not None:
+        products_df = product_filter(products_df)
+        if products_df.empty:
+            yield "data: Inga produkter matchade dina filterval.\n\n"
+            return
+
     yield f"data: Hittade {len(products_df)} produkter.\n\n"
+    yield _sse_event("products", _stream_rows(products_df, STREAM_PRODUCT_COLUMNS))
+    product_keys = set(zip(products_df["ProductID"], products_df["Size"]))
 
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_token}"
     }
 
-    yield "data: Börjar hämta orderdata i chunkar...\n\n"
-    date_ranges = _split_date_range(from_date_str, to_date_str, chunk_days=chunk_days)
-    all_sales_data = []
-
-    for (start_str, end_str) in date_ranges:
-        yield f"data: Hämta ordrar för intervallet {start_str} - {end_str}\n\n"
-        chunk_data = fetch_sales_data_single_range(api_endpoint,
-                                                   headers,
-                                                   start_str,
-                                                   end_str,
-                                                   only_shipped=only_shipped,
-                                                   limit=orders_limit)
-        if chunk_data is None:
-            yield f"data: Avbryter - fick None för {start_str}-{end_str}\n\n"
-            return
-
-        yield f"data: {len(chunk_data)} rader hittade i {start_str}-{end_str}\n\n"
-        all_sales_data.extend(chunk_data)
-
-    yield f"data: Totalt {len(all_sales_data)} orderrader funna.\n\n"
+    def sales_event(totals):
+        return _sse_event("sales", {
+            "rows": [[pid, size, qty] for (pid, size), qty in totals.items()
+                     if (pid, size) in product_keys]
+        })
+
+    if use_sales_cache:
+        cube = None if refresh_sales_cache else _cached_sales_cube(from_date_str, to_date_str, only_shipped)
+        if cube is not None:
+            yield "data: Försäljningen fanns redan i säljkuben.\n\n"
+            sales_totals = cube.window_dict(from_date_str, to_date_str)
+            yield sales_event(sales_totals)
+        else:
+            daily, missing, num_days = _cached_sales_days(from_date_str, to_date_str, only_shipped,
+                                                          refresh=refresh_sales_cache)
+            yield f"data: {len(daily)} av {num_days} dagar fanns i säljcachen, hämtar {len(missing)} från Centra\n\n"
+            if daily:
+                cached_totals = {}
+                for day_totals in daily.values():
+                    _merge_sales_totals(cached_totals, day_totals)
+                yield sales_event(cached_totals)
+
+            done = 0
+            for day_str, day_totals in _iter_missing_sales_days(api_endpoint, headers, missing,
+                                                                only_shipped=only_shipped,
+                                                                limit=orders_limit):
+                if day_totals is None:
+                    yield f"data: Avbryter - fick None för {day_str}\n\n"
+                    return
+                done += 1
+                daily[day_str] = day_totals
+                yield f"data: {len(day_totals)} produkt/storlekar sålda {day_str} ({done}/{len(missing)})\n\n"
+                yield sales_event(day_totals)
+
+            cube = SalesCube.from_daily_totals(daily, from_date_str, to_date_str)
+            _store_sales_cube(only_shipped, cube)
+            sales_totals = cube.window_dict(from_date_str, to_date_str)
+    else:
+        yield "data: Börjar hämta orderdata i chunkar...\n\n"
+        date_ranges = _split_date_range(from_date_str, to_date_str, chunk_days=chunk_days)
+        sales_totals = {}
+        done = 0
+
+        for i, start_str, end_str, chunk_totals in _iter_sales_chunks(api_endpoint,
+                                                                      headers,
+                                                                      date_ranges,
+                                                                      only_shipped=only_shipped,
+                                                                      limit=orders_limit,
+                                                                      aggregate=True):
+            if chunk_totals is None:
+                yield f"data: Avbryter - fick None för {start_str}-{end_str}\n\n"
+                return
+
+            done += 1
+            yield f"data: {len(chunk_totals)} produkt/storlekar sålda i {start_str}-{end_str} ({done}/{len(date_ranges)})\n\n"
+            _merge_sales_totals(sales_totals, chunk_totals)
+            yield sales_event(chunk_totals)
+
+    yield f"data: Totalt {len(sales_totals)} unika produkt/storlekar sålda.\n\n"
     yield "data: Bearbetar säljdata...\n\n"
 
-    sales_summary_df = process_sales_data(all_sales_data, from_date_str, to_date_str)
+    sales_summary_df = process_sales_data(sales_totals, from_date_str, to_date_str)
 
     yield f"data: Skapar slutgiltig DataFrame med {len(sales_summary_df)} rader (unique product/size)\n\n"
     merged_df = merge_product_and_sales_data(products_df, sales_summary_df)
 
     yield "data: Beräknar Reorder Level & Quantity to Order...\n\n"
-    merged_df = calculate_reorder_metrics(merged_df, lead_time, safety_stock)
+    merged_df = calculate_reorder_metrics(merged_df, lead_time, safety_stock,
+                                          overrides=load_reorder_overrides())
 
     yield "data: Adderar kommande inkommande lager...\n\n"
     merged_df = add_incoming_stock_columns(merged_df)
 
+    get_centra_client().log_stats()
+    yield _sse_event("result", _stream_rows(merged_df, STREAM_RESULT_COLUMNS))
+    if on_complete is not None:
+        on_complete(merged_df)
     yield "data: KLAR!\n\n"
-    logger.info(f"SLUTLIG DF: {merged_df.head(10)}")
\ No newline at end of file
+    logger.info(f"SLUTLIG DF: {len(merged_df)} rader")
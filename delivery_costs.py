@@ -0,0 +1,77 @@
+# delivery_costs.py
+#
+# Sammanställning av nya snittkostnader från en färdigställd leverans.
+# Leveransen har en rad per (ProductID, Size) men product_costs har en
+# kostnad per ProductID, så lager och mottagen mängd för alla storlekar
+# vägs ihop till ett snitt per produkt.
+
+import numpy as np
+import pandas as pd
+
+
+def _column(df, name):
+    if name not in df.columns:
+        return pd.Series(0.0, index=df.index)
+    return pd.to_numeric(df[name], errors='coerce').fillna(0.0)
+
+
+def calculate_delivery_avg_costs(delivery_df):
+    """
+    Räknar fram nytt inköpspris i SEK och nytt viktat snitt för alla rader
+    i en leverans på en gång. Samma formel som leveranssidan:
+      nytt pris SEK = Price * Exchange rate * (1 + Shipping %) * (1 + Customs %)
+      nytt snitt = (lager * PurchasePrice + mottaget * nytt pris) / (lager + mottaget),
+                   eller nytt pris om lager + mottaget <= 0.
+    Saknade eller ogiltiga värden räknas som 0 (växelkurs som 1).
+    Returnerar en kopia med kolumnerna new_price_sek och new_avg_cost.
+    """
+    out = delivery_df.copy()
+
+    def column(name, default=0.0):
+        if name not in out.columns:
+            return np.full(len(out), default, dtype=float)
+        return pd.to_numeric(out[name], errors='coerce').fillna(default).to_numpy(dtype=float)
+
+    price = column('Price')
+    rate = column('Exchange rate', 1.0)
+    shipping = np.clip(column('Shipping'), 0, None)
+    customs = np.clip(column('Customs'), 0, None)
+    stock = column('Current Stock')
+    current_price = column('PurchasePrice')
+    received = column('Mottagen mängd')
+
+    new_price = price * rate * (1 + shipping / 100) * (1 + customs / 100)
+    total_qty = stock + received
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weighted = (stock * current_price + received * new_price) / total_qty
+    new_avg = np.where(total_qty > 0, weighted, new_price)
+
+    out['new_price_sek'] = np.round(new_price, 2)
+    out['new_avg_cost'] = np.round(new_avg, 2)
+    return out
+
+
+def avg_costs_by_product(delivery_df):
+    """
+    Returnerar {ProductID: snittkostnad} för produkter som tagit emot något
+    till ett pris (new_price_sek > 0):
+      Σ(lager * PurchasePrice + mottaget * new_price_sek) / Σ(lager + mottaget)
+    över produktens storlekar. Negativt lager räknas som 0. Rader utan pris
+    bidrar bara med sitt lager, och produkter utan mottagen mängd tas inte med.
+    """
+    if delivery_df.empty or 'new_price_sek' not in delivery_df.columns:
+        return {}
+
+    new_price = _column(delivery_df, 'new_price_sek')
+    received = _column(delivery_df, 'Mottagen mängd').clip(lower=0).where(new_price > 0, 0.0)
+    stock = _column(delivery_df, 'Current Stock').clip(lower=0)
+
+    df = pd.DataFrame({
+        'ProductID': delivery_df['ProductID'].astype(str),
+        'value': stock * _column(delivery_df, 'PurchasePrice') + received * new_price,
+        'quantity': stock + received,
+        'received': received
+    })
+    grouped = df.groupby('ProductID')[['value', 'quantity', 'received']].sum()
+    grouped = grouped[grouped['received'] > 0]
+    return (grouped['value'] / grouped['quantity']).round(2).to_dict()
@@ -1,11 +1,20 @@
 import firebase_admin
 from firebase_admin import credentials, storage
+from google.api_core.exceptions import PreconditionFailed
 import pandas as pd
 import json
 import io
+import os
 from datetime import datetime
 import logging
 
+# Parquet kräver pyarrow. Saknas det sparas tabellerna som CSV som tidigare.
+try:
+    import pyarrow  # noqa: F401
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
 # Konfigurera loggning
 logging.basicConfig(
     level=logging.INFO,
@@ -21,22 +30,210 @@ firebase_admin.initialize_app(cred, {
 
 bucket = storage.bucket()
 
-def upload_dataframe_to_firebase(df, filename, folder='orders'):
+# Lokal cache för hämtade blobs, nyckel = sökväg + generation
+FIREBASE_CACHE_DIR = os.environ.get('FIREBASE_CACHE_DIR', 'firebase_cache')
+
+# Senast skrivna eller lästa generation per blob i den här processen
+_known_generations = {}
+
+# Lagringsformat för ordrar och snittkostnader: 'parquet' eller 'csv'
+STORAGE_FORMAT = os.environ.get('STORAGE_FORMAT', 'parquet')
+
+# Kolumntyper för de tabeller som sparas. Kolumner som inte finns i
+# schemat sparas som text.
+ORDER_SCHEMA = {
+    "OrderDate": "str",
+    "OrderName": "str",
+    "ProductID": "str",
+    "Product Number": "str",
+    "Product Name": "str",
+    "Supplier": "str",
+    "Size": "str",
+    "Quantity ordered": "float",
+    "Mottagen mängd": "float",
+    "PurchasePrice": "float",
+    "Price": "float",
+    "Currency": "str",
+    "Exchange rate": "float",
+    "Shipping": "float",
+    "Customs": "float",
+    "Kommentar": "str",
+    "IsActive": "bool",
+    "new_price_sek": "float",
+    "new_avg_cost": "float"
+}
+
+COST_SCHEMA = {
+    "ProductID": "str",
+    "AvgCost": "float",
+    "LastUpdated": "str"
+}
+
+
+def _use_parquet():
+    return STORAGE_FORMAT == 'parquet' and PARQUET_AVAILABLE
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1', 'yes')
+    return bool(value) if pd.notna(value) else False
+
+
+def apply_schema(df, schema):
+    """
+    Castar kolumnerna enligt schema så att typerna är desamma oavsett
+    om tabellen kommer från CSV eller Parquet.
+    """
+    df = df.copy()
+    for col in df.columns:
+        kind = schema.get(col, "str")
+        if kind == "float":
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+        elif kind == "bool":
+            if df[col].dtype != bool:
+                df[col] = df[col].map(_to_bool).astype(bool)
+        elif df[col].dtype == object or kind == "str":
+            values = df[col]
+            df[col] = values.where(values.isna(), values.astype(str)).astype(object)
+    return df
+
+def _cache_path(path):
+    return os.path.join(FIREBASE_CACHE_DIR, *path.split('/'))
+
+
+def _read_cached_blob(path, generation):
+    """
+    Returnerar (content, metadata) från den lokala cachen om den har
+    exakt denna generation av bloben, annars None.
+    """
+    local = _cache_path(path)
+    try:
+        with open(f"{local}.meta.json", 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('generation') != generation:
+            return None
+        with open(local, 'rb') as f:
+            return f.read(), meta.get('metadata') or {}
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cached_blob(path, content, generation, metadata):
+    if generation is None:
+        return
+    local = _cache_path(path)
+    try:
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        with open(f"{local}.tmp", 'wb') as f:
+            f.write(content)
+        os.replace(f"{local}.tmp", local)
+        with open(f"{local}.meta.json.tmp", 'w', encoding='utf-8') as f:
+            json.dump({'generation': generation, 'metadata': metadata or {}}, f)
+        os.replace(f"{local}.meta.json.tmp", f"{local}.meta.json")
+    except OSError as e:
+        logger.warning(f"Kunde inte cacha {path} lokalt: {str(e)}")
+
+
+def _drop_cached_blob(path):
+    local = _cache_path(path)
+    for filename in (local, f"{local}.meta.json"):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+class GenerationConflict(Exception):
+    """
+    Bloben har ändrats (av en annan process) sedan generationen vi utgick från.
+    """
+
+
+class BlobReadError(Exception):
+    """
+    Bloben finns (eller kunde inte kontrolleras) men gick inte att läsa.
+    Skiljer ett tillfälligt fel från en tabell som saknas, så att den som
+    läst inte sparar över den med ett tomt eller ofullständigt innehåll.
+    """
+
+
+def upload_blob(path, content, content_type, metadata=None, if_generation_match=None):
     """
-    Laddar upp en DataFrame till Firebase Storage som CSV
+    Laddar upp content (bytes/str) till path och lägger samma innehåll i
+    den lokala cachen under den nya generationen. Returnerar generationen.
+    Med if_generation_match skrivs bloben bara om den fortfarande har den
+    generationen (0 = bloben får inte finnas), annars GenerationConflict.
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    blob = bucket.blob(path)
+    if metadata:
+        blob.metadata = {k: str(v) for k, v in metadata.items()}
+    try:
+        blob.upload_from_string(content, content_type=content_type,
+                                if_generation_match=if_generation_match)
+    except PreconditionFailed:
+        raise GenerationConflict(f"{path} har ändrats sedan generation {if_generation_match}")
+    _known_generations[path] = blob.generation
+    _write_cached_blob(path, content, blob.generation, blob.metadata)
+    return blob.generation
+
+
+def download_blob(path):
+    """
+    Hämtar en blob via den lokala cachen. Bara metadata hämtas från
+    Firebase om generationen inte ändrats sedan senast.
+    Returnerar (content, metadata) eller (None, {}) om bloben saknas.
+    """
+    blob = bucket.get_blob(path)
+    if blob is None:
+        return None, {}
+
+    _known_generations[path] = blob.generation
+    cached = _read_cached_blob(path, blob.generation)
+    if cached is not None:
+        logger.debug(f"{path}: generation {blob.generation} finns i lokal cache")
+        return cached
+
+    content = blob.download_as_bytes(if_generation_match=blob.generation)
+    _write_cached_blob(path, content, blob.generation, blob.metadata)
+    return content, blob.metadata or {}
+
+
+def get_blob_state(path):
+    """
+    Hämtar bara metadata: (generation, metadata), eller (0, {}) om bloben
+    saknas. Används för att se om en annan process ändrat bloben.
+    """
+    blob = bucket.get_blob(path)
+    if blob is None:
+        return 0, {}
+    return blob.generation, blob.metadata or {}
+
+
+def known_generation(path):
+    """
+    Generationen av path som den här processen senast skrev eller läste.
+    """
+    return _known_generations.get(path)
+
+
+def upload_dataframe_to_firebase(df, filename, folder='orders', metadata=None, if_generation_match=None):
+    """
+    Laddar upp en DataFrame till Firebase Storage som CSV.
+    metadata (dict) sparas som custom metadata på bloben.
     """
     try:
         # Konvertera DataFrame till CSV
         csv_buffer = io.StringIO()
         df.to_csv(csv_buffer, index=False)
-        csv_content = csv_buffer.getvalue()
 
-        # Skapa en blob och ladda upp
-        blob = bucket.blob(f'{folder}/{filename}')
-        blob.upload_from_string(csv_content, content_type='text/csv')
-        
+        upload_blob(f'{folder}/{filename}', csv_buffer.getvalue(), 'text/csv', metadata=metadata,
+                    if_generation_match=if_generation_match)
+
         logger.info(f"Lyckades ladda upp {filename} till Firebase Storage i mappen {folder}")
         return True
+    except GenerationConflict:
+        raise
     except Exception as e:
         logger.error(f"Fel vid uppladdning till Firebase: {str(e)}")
         return False
@@ -45,60 +242,249 @@ def download_dataframe_from_firebase(filename, folder='orders'):
     """
     Hämtar en CSV-fil från Firebase Storage och returnerar som DataFrame
     """
+    df, _ = download_dataframe_with_metadata(filename, folder)
+    return df
+
+def upload_table_to_firebase(df, name, folder, schema, metadata=None, if_generation_match=None):
+    """
+    Sparar en tabell som {name}.parquet (eller {name}.csv om Parquet inte
+    används) med kolumntyper enligt schema. Kastar GenerationConflict om
+    if_generation_match anges och tabellen har ändrats.
+    """
+    if not _use_parquet():
+        return upload_dataframe_to_firebase(apply_schema(df, schema), f"{name}.csv", folder, metadata=metadata,
+                                            if_generation_match=if_generation_match)
+
+    try:
+        buffer = io.BytesIO()
+        apply_schema(df, schema).to_parquet(buffer, index=False, compression='zstd')
+        upload_blob(f'{folder}/{name}.parquet', buffer.getvalue(),
+                    'application/vnd.apache.parquet', metadata=metadata,
+                    if_generation_match=if_generation_match)
+        logger.info(f"Lyckades ladda upp {name}.parquet till Firebase Storage i mappen {folder}")
+        return True
+    except GenerationConflict:
+        raise
+    except Exception as e:
+        logger.error(f"Fel vid uppladdning till Firebase: {str(e)}")
+        return False
+
+
+def download_table_from_firebase(name, folder, schema, columns=None, raise_on_error=False):
+    """
+    Hämtar en tabell sparad med upload_table_to_firebase och returnerar
+    (df, metadata). columns begränsar vilka kolumner som läses in.
+    Finns bara den gamla CSV-filen läses den och skrivs om som Parquet
+    (CSV-filen lämnas kvar orörd). (None, {}) om tabellen saknas. Kan den
+    inte läsas ges också (None, {}), eller BlobReadError med raise_on_error.
+    """
+    if _use_parquet():
+        try:
+            content, metadata = download_blob(f'{folder}/{name}.parquet')
+            if content is not None:
+                df = pd.read_parquet(io.BytesIO(content), columns=columns)
+                logger.info(f"Lyckades hämta {name}.parquet från Firebase Storage i mappen {folder}")
+                return df, metadata
+        except Exception as e:
+            logger.error(f"Fel vid hämtning av {name}.parquet från Firebase: {str(e)}")
+            if raise_on_error:
+                raise BlobReadError(f"{folder}/{name}.parquet kunde inte läsas: {str(e)}")
+            return None, {}
+
+    df, metadata = download_dataframe_with_metadata(f"{name}.csv", folder, raise_on_error=raise_on_error)
+    if df is None:
+        return None, {}
+    df = apply_schema(df, schema)
+    if _use_parquet():
+        logger.info(f"Migrerar {folder}/{name}.csv till Parquet")
+        upload_table_to_firebase(df, name, folder, schema, metadata=metadata)
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+    return df, metadata
+
+
+def download_dataframe_with_metadata(filename, folder='orders', raise_on_error=False):
+    """
+    Som download_dataframe_from_firebase men returnerar (df, metadata).
+    (None, {}) om filen saknas eller inte kan läsas; med raise_on_error
+    kastas BlobReadError om den inte kan läsas.
+    """
     try:
-        blob = bucket.blob(f'{folder}/{filename}')
-        content = blob.download_as_string().decode('utf-8')
-        df = pd.read_csv(io.StringIO(content))
+        content, metadata = download_blob(f'{folder}/{filename}')
+        if content is None:
+            return None, {}
+        df = pd.read_csv(io.StringIO(content.decode('utf-8')))
         logger.info(f"Lyckades hämta {filename} från Firebase Storage i mappen {folder}")
-        return df
+        return df, metadata
     except Exception as e:
         logger.error(f"Fel vid hämtning från Firebase: {str(e)}")
+        if raise_on_error:
+            raise BlobReadError(f"{folder}/{filename} kunde inte läsas: {str(e)}")
+        return None, {}
+
+def upload_json_to_firebase(payload, filename, folder, if_generation_match=None):
+    """
+    Laddar upp ett JSON-objekt till Firebase Storage. Kastar
+    GenerationConflict om if_generation_match anges och inte stämmer.
+    """
+    try:
+        upload_blob(f'{folder}/{filename}', json.dumps(payload, ensure_ascii=False), 'application/json',
+                    if_generation_match=if_generation_match)
+        return True
+    except GenerationConflict:
+        raise
+    except Exception as e:
+        logger.error(f"Fel vid uppladdning av {filename} till Firebase: {str(e)}")
+        return False
+
+def download_json_from_firebase(filename, folder, raise_on_error=False):
+    """
+    Hämtar ett JSON-objekt från Firebase Storage. None om det saknas eller
+    inte kan läsas; med raise_on_error kastas BlobReadError vid läsfel.
+    """
+    try:
+        content, _ = download_blob(f'{folder}/{filename}')
+        if content is None:
+            return None
+        return json.loads(content.decode('utf-8'))
+    except Exception as e:
+        logger.error(f"Fel vid hämtning av {filename} från Firebase: {str(e)}")
+        if raise_on_error:
+            raise BlobReadError(f"{folder}/{filename} kunde inte läsas: {str(e)}")
         return None
 
-def save_active_orders(df):
+def list_blob_names(prefix):
     """
-    Sparar aktiva ordrar till Firebase
+    Listar namnen (utan prefix) på alla blobs under prefix, sorterade
     """
-    return upload_dataframe_to_firebase(df, 'active_orders.csv', 'orders')
+    try:
+        return sorted(blob.name[len(prefix):] for blob in bucket.list_blobs(prefix=prefix))
+    except Exception as e:
+        logger.error(f"Fel vid listning av {prefix}: {str(e)}")
+        return None
+
+def delete_blobs(names, folder):
+    """
+    Tar bort filerna names i folder. Returnerar antal borttagna.
+    """
+    removed = 0
+    for name in names:
+        try:
+            bucket.blob(f'{folder}/{name}').delete()
+            _drop_cached_blob(f'{folder}/{name}')
+            removed += 1
+        except Exception as e:
+            logger.error(f"Fel vid borttagning av {folder}/{name}: {str(e)}")
+    return removed
+
+def _table_path(name, folder):
+    return f"{folder}/{name}.{'parquet' if _use_parquet() else 'csv'}"
+
+def save_active_orders(df, journal_seq=None, if_generation_match=None):
+    """
+    Sparar aktiva ordrar till Firebase. journal_seq är sista händelsen i
+    orderjournalen som ögonblicksbilden innehåller. Med if_generation_match
+    kastas GenerationConflict om en annan process sparat en nyare.
+    """
+    metadata = {'journal_seq': journal_seq} if journal_seq is not None else None
+    return upload_table_to_firebase(df, 'active_orders', 'orders', ORDER_SCHEMA, metadata=metadata,
+                                    if_generation_match=if_generation_match)
 
-def load_active_orders():
+def load_active_orders(columns=None):
     """
     Hämtar aktiva ordrar från Firebase
     """
-    return download_dataframe_from_firebase('active_orders.csv', 'orders')
+    df, _ = download_table_from_firebase('active_orders', 'orders', ORDER_SCHEMA, columns=columns)
+    return df
+
+def load_active_orders_snapshot():
+    """
+    Hämtar aktiva ordrar och vilken journalhändelse ögonblicksbilden
+    innehåller. Returnerar (df, journal_seq), (None, 0) om den saknas.
+    Kastar BlobReadError om den finns men inte kan läsas.
+    """
+    df, metadata = download_table_from_firebase('active_orders', 'orders', ORDER_SCHEMA, raise_on_error=True)
+    try:
+        journal_seq = int(metadata.get('journal_seq', 0))
+    except (TypeError, ValueError):
+        journal_seq = 0
+    return df, journal_seq
+
+def known_table_generation(name, folder):
+    """
+    Generationen av tabellen som den här processen senast läste eller
+    skrev, 0 om ingen finns. Passar som if_generation_match.
+    """
+    return known_generation(_table_path(name, folder)) or 0
+
+def remote_table_generation(name, folder):
+    """
+    Tabellens nuvarande generation i Firebase (bara metadata), 0 om den saknas.
+    """
+    generation, _ = get_blob_state(_table_path(name, folder))
+    return generation
+
+def active_orders_generation():
+    """
+    Generationen av ögonblicksbilden som den här processen senast läste
+    eller skrev, 0 om ingen finns.
+    """
+    return known_table_generation('active_orders', 'orders')
+
+def get_active_orders_state():
+    """
+    (generation, journal_seq) för ögonblicksbilden i Firebase, utan att
+    hämta innehållet. (0, 0) om den saknas.
+    """
+    generation, metadata = get_blob_state(_table_path('active_orders', 'orders'))
+    try:
+        journal_seq = int(metadata.get('journal_seq', 0))
+    except (TypeError, ValueError):
+        journal_seq = 0
+    return generation, journal_seq
 
 def backup_orders():
     """
-    Skapar en backup av ordrar med tidsstämpel
+    Skapar en backup av ordrar med tidsstämpel. Backupen görs som en
+    kopia på serversidan av den generation som senast sparades, utan
+    att filen hämtas och laddas upp igen.
     """
     try:
-        df = load_active_orders()
-        if df is not None:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f'orders_backup_{timestamp}.csv'
-            
-            csv_buffer = io.StringIO()
-            df.to_csv(csv_buffer, index=False)
-            blob = bucket.blob(f'backup/{filename}')
-            blob.upload_from_string(csv_buffer.getvalue(), content_type='text/csv')
-            
-            logger.info(f"Backup skapad: {filename}")
-            return True
+        path = _table_path('active_orders', 'orders')
+        source = bucket.blob(path)
+        generation = _known_generations.get(path)
+        if generation is None:
+            source = bucket.get_blob(path)
+            if source is None:
+                logger.warning(f"Ingen {path} att ta backup av")
+                return False
+            generation = source.generation
+
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        filename = f"orders_backup_{timestamp}.{path.rsplit('.', 1)[1]}"
+        bucket.copy_blob(source, bucket, f'backup/{filename}', source_generation=generation)
+
+        logger.info(f"Backup skapad: {filename}")
+        return True
     except Exception as e:
         logger.error(f"Fel vid backup: {str(e)}")
     return False
 
-def save_product_costs(df):
+def save_product_costs(df, if_generation_match=None):
     """
-    Sparar product costs till Firebase
+    Sparar product costs till Firebase. Med if_generation_match kastas
+    GenerationConflict om tabellen ändrats sedan dess.
     """
-    return upload_dataframe_to_firebase(df, 'product_costs.csv', 'costs')
+    return upload_table_to_firebase(df, 'product_costs', 'costs', COST_SCHEMA,
+                                    if_generation_match=if_generation_match)
 
-def load_product_costs():
+def load_product_costs(columns=None, raise_on_error=False):
     """
     Hämtar product costs från Firebase
     """
-    return download_dataframe_from_firebase('product_costs.csv', 'costs')
+    df, _ = download_table_from_firebase('product_costs', 'costs', COST_SCHEMA, columns=columns,
+                                         raise_on_error=raise_on_error)
+    return df
 
 def save_price_list(df):
     """
@@ -0,0 +1,288 @@
+# jobs.py
+#
+# Bakgrundsjobb för långa körningar som /stats. Ett jobb får ett ID, körs i
+# en trådpool och kan pollas för progress och hämtas när det är klart.
+# Jobb med samma parametrar som redan körs delar på samma jobb.
+#
+# Status och resultat skrivs också till JOB_STATE_DIR, så att alla
+# WSGI-workers på samma server kan svara på /stats/jobs/<id> oavsett vilken
+# worker som kör jobbet. Sammanslagningen av jobb med samma parametrar
+# gäller bara inom en worker.
+
+import os
+import re
+import json
+import time
+import uuid
+import pickle
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Antal jobb som körs samtidigt
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+
+# Hur länge färdiga jobb (och deras resultat) sparas
+JOB_RESULT_TTL_SECONDS = int(os.environ.get('JOB_RESULT_TTL_SECONDS', 3600))
+JOB_MAX_FINISHED = int(os.environ.get('JOB_MAX_FINISHED', 20))
+
+# Katalog för jobbstatus och resultat, delad mellan workers på servern
+JOB_STATE_DIR = os.environ.get('JOB_STATE_DIR', 'job_state')
+
+# Progress skrivs till disk högst så här ofta (sekunder); statusbyten direkt
+JOB_STATE_WRITE_INTERVAL = float(os.environ.get('JOB_STATE_WRITE_INTERVAL', 0.5))
+
+_JOB_ID_RE = re.compile(r'[0-9a-f]{32}')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def _state_path(job_id, suffix):
+    return os.path.join(JOB_STATE_DIR, f"{job_id}.{suffix}")
+
+
+def _write_atomic(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _elapsed(state):
+    end = state['finished_at'] or time.time()
+    return round(end - (state['started_at'] or state['created_at']), 1)
+
+
+class Job:
+    def __init__(self, key, params, on_change=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.params = params
+        self.status = QUEUED
+        self.progress = []
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._on_change = on_change
+        self._lock = threading.Lock()
+
+    def report(self, message):
+        """
+        Lägger till ett progressmeddelande. Skickas som callback till jobbfunktionen.
+        """
+        with self._lock:
+            self.progress.append(message)
+        logger.info(f"Jobb {self.id[:8]}: {message}")
+        if self._on_change is not None:
+            self._on_change(self)
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def to_dict(self):
+        with self._lock:
+            progress = list(self.progress)
+        state = {
+            'job_id': self.id,
+            'status': self.status,
+            'progress': progress,
+            'message': progress[-1] if progress else None,
+            'error': self.error,
+            'params': self.params,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+        state['elapsed'] = _elapsed(state)
+        return state
+
+
+class StoredJob:
+    """
+    Ett jobb som körs (eller kördes) av en annan worker, inläst från
+    JOB_STATE_DIR. Har samma attribut som Job; resultatet läses först när
+    det efterfrågas.
+    """
+
+    def __init__(self, state):
+        self._state = state
+        self.id = state['job_id']
+        self.status = state['status']
+        self.params = state['params']
+        self.progress = state['progress']
+        self.error = state['error']
+        self.created_at = state['created_at']
+        self.started_at = state['started_at']
+        self.finished_at = state['finished_at']
+        self._result = None
+        self._result_loaded = False
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    @property
+    def result(self):
+        if not self._result_loaded:
+            self._result_loaded = True
+            try:
+                with open(_state_path(self.id, 'pkl'), 'rb') as f:
+                    self._result = pickle.load(f)
+            except FileNotFoundError:
+                self._result = None
+            except Exception as e:
+                logger.error(f"Fel vid läsning av resultat för jobb {self.id[:8]}: {str(e)}")
+                self._result = None
+        return self._result
+
+    def to_dict(self):
+        return dict(self._state, elapsed=_elapsed(self._state))
+
+
+class JobRunner:
+    def __init__(self, max_workers=JOB_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._active_by_key = {}
+        self._state_written_at = {}
+
+    def submit(self, key, fn, params=None):
+        """
+        Köar fn(report) som ett jobb. Finns redan ett ej färdigt jobb med
+        samma key returneras det i stället. Returnerar (job, created).
+        """
+        with self._lock:
+            self._prune()
+            existing = self._active_by_key.get(key)
+            if existing is not None and not existing.finished:
+                logger.info(f"Ansluter till pågående jobb {existing.id[:8]}")
+                return existing, False
+
+            job = Job(key, params or {}, on_change=self._save_progress)
+            self._jobs[job.id] = job
+            self._active_by_key[key] = job
+
+        self._save_state(job)
+        self._executor.submit(self._run, job, fn)
+        return job, True
+
+    def get(self, job_id):
+        """
+        Jobbet med job_id, från den här workern eller JOB_STATE_DIR.
+        None om det inte finns (eller har rensats).
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        return self._load_state(job_id)
+
+    def _run(self, job, fn):
+        job.status = RUNNING
+        job.started_at = time.time()
+        self._save_state(job)
+        try:
+            job.result = fn(job.report)
+            job.status = DONE
+        except Exception as e:
+            logger.error(f"Jobb {job.id[:8]} misslyckades: {str(e)}")
+            job.error = str(e)
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+            if job.status == DONE:
+                self._save_result(job)
+            self._save_state(job)
+            with self._lock:
+                if self._active_by_key.get(job.key) is job:
+                    del self._active_by_key[job.key]
+
+    # ---------------------------------------------------------------
+    # Delad status på disk
+    # ---------------------------------------------------------------
+    def _save_progress(self, job):
+        if time.monotonic() - self._state_written_at.get(job.id, 0.0) >= JOB_STATE_WRITE_INTERVAL:
+            self._save_state(job)
+
+    def _save_state(self, job):
+        self._state_written_at[job.id] = time.monotonic()
+        try:
+            state = json.dumps(job.to_dict(), ensure_ascii=False, default=str)
+            _write_atomic(_state_path(job.id, 'json'), state.encode('utf-8'))
+        except Exception as e:
+            logger.error(f"Fel vid sparning av status för jobb {job.id[:8]}: {str(e)}")
+
+    def _save_result(self, job):
+        try:
+            _write_atomic(_state_path(job.id, 'pkl'), pickle.dumps(job.result))
+        except Exception as e:
+            logger.error(f"Fel vid sparning av resultat för jobb {job.id[:8]}: {str(e)}")
+
+    def _load_state(self, job_id):
+        if not job_id or not _JOB_ID_RE.fullmatch(job_id):
+            return None
+        try:
+            with open(_state_path(job_id, 'json'), 'r', encoding='utf-8') as f:
+                return StoredJob(json.load(f))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Fel vid läsning av status för jobb {job_id[:8]}: {str(e)}")
+            return None
+
+    def _remove_state(self, job_id):
+        self._state_written_at.pop(job_id, None)
+        for suffix in ('json', 'pkl'):
+            try:
+                os.remove(_state_path(job_id, suffix))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"Fel vid borttagning av jobb {job_id[:8]}: {str(e)}")
+
+    def _prune_state_dir(self, now):
+        # Jobb från andra workers (eller en avslutad process) rensas efter
+        # JOB_RESULT_TTL_SECONDS räknat från senaste skrivning
+        if not os.path.isdir(JOB_STATE_DIR):
+            return
+        for filename in os.listdir(JOB_STATE_DIR):
+            path = os.path.join(JOB_STATE_DIR, filename)
+            try:
+                if now - os.path.getmtime(path) > JOB_RESULT_TTL_SECONDS:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"Fel vid rensning av {path}: {str(e)}")
+
+    def _prune(self):
+        # Anropas med self._lock tagen
+        now = time.time()
+        finished = sorted(
+            (j for j in self._jobs.values() if j.finished),
+            key=lambda j: j.finished_at
+        )
+        expired = [j for j in finished if now - j.finished_at > JOB_RESULT_TTL_SECONDS]
+        expired += finished[len(expired):max(len(finished) - JOB_MAX_FINISHED, len(expired))]
+        for job in expired:
+            self._jobs.pop(job.id, None)
+            self._remove_state(job.id)
+        self._prune_state_dir(now)
+
+
+JOB_RUNNER = JobRunner()
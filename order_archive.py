@@ -0,0 +1,186 @@
+# order_archive.py
+#
+# Arkiv för färdigställda leveranser, uppdelat per månad (OrderDate) i
+# orders/archive/<YYYY-MM>.parquet. Ett litet index (orders/archive/index.json)
+# håller sammanfattningen per leverans och vilken månad den ligger i, så att
+# leveranslistan kan visas utan att någon partition hämtas. Partitionerna
+# hämtas först när raderna behövs (visning, export, dashboard).
+
+import logging
+import threading
+
+import pandas as pd
+
+from firebase_storage import (
+    ORDER_SCHEMA,
+    BlobReadError,
+    upload_table_to_firebase,
+    download_table_from_firebase,
+    upload_json_to_firebase,
+    download_json_from_firebase,
+    known_generation,
+    known_table_generation
+)
+
+logger = logging.getLogger(__name__)
+
+ORDER_ARCHIVE_FOLDER = 'orders/archive'
+ORDER_ARCHIVE_INDEX = 'index.json'
+
+# Partition för leveranser utan giltigt OrderDate
+UNKNOWN_MONTH = 'okand'
+
+
+def partition_months(df):
+    """
+    Månaden (YYYY-MM) som varje rad i df hör till.
+    """
+    months = pd.to_datetime(df['OrderDate'].astype(str), errors='coerce').dt.strftime('%Y-%m')
+    return months.fillna(UNKNOWN_MONTH)
+
+
+class OrderArchive:
+    """
+    Indexet läses in vid första behov och partitionerna var för sig.
+    Skrivningar görs med generationsvillkor och kastar GenerationConflict
+    om en annan process har hunnit arkivera samtidigt. Ett index eller en
+    partition som inte kunde läsas sparas inte i minnet; läsningar visar
+    då arkivet utan den, medan archive() kastar BlobReadError.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._partitions = {}
+
+    def invalidate(self):
+        """
+        Glömmer index och partitioner, t.ex. när en annan process har
+        komprimerat ordrarna. De läses in igen vid nästa behov.
+        """
+        with self._lock:
+            self._index = None
+            self._partitions = {}
+
+    def _load_index(self, strict=False):
+        # Anropas med self._lock tagen
+        if self._index is None:
+            try:
+                index = download_json_from_firebase(ORDER_ARCHIVE_INDEX, ORDER_ARCHIVE_FOLDER,
+                                                    raise_on_error=True)
+            except BlobReadError:
+                if strict:
+                    raise
+                return {}
+            self._index = index or {}
+            logger.info(f"Läste arkivindex med {len(self._index)} leveranser")
+        return self._index
+
+    def _load_partition(self, month, strict=False):
+        # Anropas med self._lock tagen
+        if month not in self._partitions:
+            try:
+                df, _ = download_table_from_firebase(month, ORDER_ARCHIVE_FOLDER, ORDER_SCHEMA,
+                                                     raise_on_error=True)
+            except BlobReadError:
+                if strict:
+                    raise
+                return pd.DataFrame(columns=list(ORDER_SCHEMA))
+            self._partitions[month] = df if df is not None else pd.DataFrame(columns=list(ORDER_SCHEMA))
+        return self._partitions[month]
+
+    # ---------------------------------------------------------------
+    # Läsning
+    # ---------------------------------------------------------------
+    def has_order(self, order_name):
+        with self._lock:
+            return str(order_name) in self._load_index()
+
+    def summaries(self, exclude=()):
+        """
+        Sammanfattningar (samma format som OrderStore.summaries) för
+        arkiverade leveranser som inte finns i exclude.
+        """
+        with self._lock:
+            index = self._load_index()
+            return [
+                {k: v for k, v in entry.items() if k != 'month'}
+                for name, entry in index.items()
+                if name not in exclude
+            ]
+
+    def rows_for_order(self, order_name):
+        """
+        Leveransens rader ur arkivet (hämtar bara dess partition), None
+        om den inte är arkiverad.
+        """
+        name = str(order_name)
+        with self._lock:
+            entry = self._load_index().get(name)
+            if entry is None:
+                return None
+            partition = self._load_partition(entry['month'])
+            return partition[partition['OrderName'].astype(str) == name].copy()
+
+    def all_rows(self):
+        """
+        Alla arkiverade rader. Hämtar samtliga partitioner.
+        """
+        with self._lock:
+            months = sorted({entry['month'] for entry in self._load_index().values()})
+            frames = [self._load_partition(month) for month in months]
+        frames = [df for df in frames if not df.empty]
+        if not frames:
+            return pd.DataFrame(columns=list(ORDER_SCHEMA))
+        return pd.concat(frames, ignore_index=True)
+
+    # ---------------------------------------------------------------
+    # Skrivning
+    # ---------------------------------------------------------------
+    def archive(self, rows, summaries, remove=()):
+        """
+        Flyttar in rows (färdigställda leveranser) i sina månadspartitioner
+        och tar bort leveranserna i remove (återaktiverade) ur arkivet.
+        summaries är {OrderName: sammanfattning} för leveranserna i rows.
+        Leveranser som redan finns i en partition skrivs över, så ett
+        avbrutet försök kan göras om. Returnerar True om allt sparades.
+        Kastar BlobReadError om index eller partition inte kunde läsas.
+        """
+        remove = {str(name) for name in remove}
+        with self._lock:
+            index = dict(self._load_index(strict=True))
+
+            changes = {}
+            if not rows.empty:
+                rows = rows.copy()
+                rows['OrderName'] = rows['OrderName'].astype(str)
+                for month, month_rows in rows.groupby(partition_months(rows)):
+                    changes.setdefault(month, []).append(month_rows)
+            for name in remove:
+                if name in index:
+                    changes.setdefault(index[name]['month'], [])
+
+            for month, new_rows in changes.items():
+                partition = self._load_partition(month, strict=True)
+                names = {str(n) for frame in new_rows for n in frame['OrderName'].unique()}
+                keep = ~partition['OrderName'].astype(str).isin(names | remove)
+                updated = pd.concat([partition[keep]] + new_rows, ignore_index=True)
+                if not upload_table_to_firebase(updated, month, ORDER_ARCHIVE_FOLDER, ORDER_SCHEMA,
+                                                if_generation_match=known_table_generation(month, ORDER_ARCHIVE_FOLDER)):
+                    return False
+                self._partitions[month] = updated
+                for name in names:
+                    index[name] = dict(summaries[name], month=month)
+
+            for name in remove:
+                index.pop(name, None)
+
+            path = f"{ORDER_ARCHIVE_FOLDER}/{ORDER_ARCHIVE_INDEX}"
+            if not upload_json_to_firebase(index, ORDER_ARCHIVE_INDEX, ORDER_ARCHIVE_FOLDER,
+                                           if_generation_match=known_generation(path) or 0):
+                return False
+            self._index = index
+
+        logger.info(f"Arkiverade {rows['OrderName'].nunique() if not rows.empty else 0} leveranser "
+                    f"i {len(changes)} partitioner, tog bort {len(remove)} ur arkivet")
+        return True
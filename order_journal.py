@@ -0,0 +1,355 @@
+# order_journal.py
+#
+# Append-only journal över ändringar i ordrarna. Varje ändring (ny leverans,
+# makulering, färdigställande, återaktivering) sparas som en liten JSON-blob
+# i Firebase i stället för att hela orderhistoriken skrivs om. Med jämna
+# mellanrum komprimeras journalen till en ny active_orders-fil och vid start
+# spelas händelserna efter senaste ögonblicksbilden upp igen.
+
+import os
+import time
+import json
+import atexit
+import logging
+import threading
+from datetime import datetime
+
+from firebase_storage import (
+    BlobReadError,
+    GenerationConflict,
+    get_active_orders_state,
+    upload_json_to_firebase,
+    download_json_from_firebase,
+    list_blob_names,
+    delete_blobs
+)
+
+logger = logging.getLogger(__name__)
+
+ORDER_JOURNAL_FOLDER = 'orders/journal'
+
+# Antal händelser i journalen innan den komprimeras till en ny ögonblicksbild
+ORDER_JOURNAL_COMPACT_EVERY = int(os.environ.get('ORDER_JOURNAL_COMPACT_EVERY', 25))
+
+# Write-behind: hur länge skrivaren väntar in fler ändringar innan den
+# skriver, backoff vid fel och hur länge vi väntar på flush vid avslut
+WRITE_BEHIND_DELAY_SECONDS = float(os.environ.get('WRITE_BEHIND_DELAY_SECONDS', 0.5))
+WRITE_BEHIND_RETRY_MAX_SECONDS = float(os.environ.get('WRITE_BEHIND_RETRY_MAX_SECONDS', 30))
+WRITE_BEHIND_SHUTDOWN_TIMEOUT = float(os.environ.get('WRITE_BEHIND_SHUTDOWN_TIMEOUT', 30))
+
+
+def _event_filename(seq):
+    return f"{seq:012d}.json"
+
+
+def records_for_event(df):
+    """
+    Gör om en DataFrame till JSON-säkra rader (NaN blir null).
+    """
+    return json.loads(df.to_json(orient='records', force_ascii=False))
+
+
+class OrderJournal:
+    """
+    Håller reda på nästa löpnummer. Händelser sparas som
+    orders/journal/<löpnummer>.json.
+    """
+
+    def __init__(self, compact_every=ORDER_JOURNAL_COMPACT_EVERY):
+        self.compact_every = compact_every
+        self.last_seq = 0
+        self.snapshot_seq = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        """
+        Antal händelser som inte finns i senaste ögonblicksbilden.
+        """
+        return self.last_seq - self.snapshot_seq
+
+    def should_compact(self):
+        return self.pending >= self.compact_every
+
+    def append(self, event):
+        """
+        Sparar en händelse. Returnerar löpnumret, eller None om det inte
+        gick att spara.
+        """
+        return self.append_batch([event])
+
+    def append_batch(self, events):
+        """
+        Sparar flera händelser i en och samma blob (ett löpnummer).
+        Returnerar löpnumret, eller None om det inte gick att spara.
+        Bloben skapas bara om löpnumret är ledigt; har en annan process
+        redan skrivit det kastas GenerationConflict.
+        """
+        with self._lock:
+            # Har en annan process komprimerat förbi oss kan löpnumret vara
+            # borttaget ur journalen, och då skulle skrivningen lyckas men
+            # hamna före ögonblicksbilden. Läs in på nytt i stället.
+            try:
+                _, snapshot_seq = get_active_orders_state()
+            except Exception as e:
+                logger.error(f"Fel vid kontroll av ögonblicksbild: {str(e)}")
+                return None
+            if snapshot_seq > self.last_seq:
+                raise GenerationConflict(f"Ögonblicksbilden innehåller händelse {snapshot_seq}, "
+                                         f"vi har bara {self.last_seq}")
+
+            seq = self.last_seq + 1
+            payload = {
+                'seq': seq,
+                'recorded_at': datetime.now().isoformat(timespec='seconds'),
+                'events': events
+            }
+            if not upload_json_to_firebase(payload, _event_filename(seq), ORDER_JOURNAL_FOLDER,
+                                           if_generation_match=0):
+                return None
+            self.last_seq = seq
+        logger.info(f"Orderhändelse {seq} sparad: "
+                    f"{', '.join(e['type'] + ' ' + str(e['order_name']) for e in events)}")
+        return seq
+
+    def replay(self, snapshot_seq, apply_fn):
+        """
+        Spelar upp alla händelser efter snapshot_seq genom apply_fn(event),
+        t.ex. OrderStore.apply_event på en store laddad med ögonblicksbilden.
+        Kastar BlobReadError om journalen inte kunde listas eller läsas
+        till slut, eftersom storen då saknar ändringar.
+        """
+        with self._lock:
+            self.snapshot_seq = snapshot_seq
+            self.last_seq = snapshot_seq
+            names = list_blob_names(f"{ORDER_JOURNAL_FOLDER}/")
+            if names is None:
+                raise BlobReadError("Orderjournalen kunde inte listas")
+            seqs = self.seqs_after(snapshot_seq, names)
+            replayed = self._replay_new(apply_fn, seqs)
+            if replayed < len(seqs):
+                raise BlobReadError(f"Orderjournalen kunde bara spelas upp t.o.m. {self.last_seq}")
+        logger.info(f"Spelade upp {replayed} orderhändelser efter ögonblicksbild {snapshot_seq}")
+        return replayed
+
+    def seqs_after(self, seq, names=None):
+        """
+        Löpnummer i journalen som är större än seq, i ordning.
+        """
+        if names is None:
+            names = list_blob_names(f"{ORDER_JOURNAL_FOLDER}/") or []
+        seqs = [int(n.split('.')[0]) for n in names if n.split('.')[0].isdigit()]
+        return sorted(s for s in seqs if s > seq)
+
+    def catch_up(self, apply_fn, seqs=None):
+        """
+        Spelar upp händelser som andra processer skrivit efter last_seq.
+        Returnerar antal uppspelade.
+        """
+        with self._lock:
+            if seqs is None:
+                seqs = self.seqs_after(self.last_seq)
+            replayed = self._replay_new(apply_fn, [s for s in seqs if s > self.last_seq])
+        if replayed:
+            logger.info(f"Hämtade {replayed} orderhändelser från andra processer (t.o.m. {self.last_seq})")
+        return replayed
+
+    def _replay_new(self, apply_fn, seqs):
+        # Anropas med self._lock tagen
+        replayed = 0
+        for seq in seqs:
+            event = download_json_from_firebase(_event_filename(seq), ORDER_JOURNAL_FOLDER)
+            if event is None:
+                logger.error(f"Kunde inte läsa orderhändelse {seq}, avbryter uppspelning")
+                break
+            # Äldre blobs innehåller en enda händelse, nyare en lista
+            for item in event.get('events', [event]):
+                apply_fn(item)
+            self.last_seq = seq
+            replayed += 1
+        return replayed
+
+    def mark_compacted(self, seq):
+        """
+        Anropas när en ögonblicksbild med alla händelser t.o.m. seq är
+        sparad. Tar bort händelserna t.o.m. förra ögonblicksbilden ur
+        journalen; de senaste får ligga kvar ett varv så att en process
+        som ännu inte sett den nya ögonblicksbilden inte kan skriva ett
+        löpnummer som redan använts.
+        """
+        previous = self.snapshot_seq
+        self.snapshot_seq = seq
+        names = list_blob_names(f"{ORDER_JOURNAL_FOLDER}/") or []
+        obsolete = [n for n in names if n.split('.')[0].isdigit() and int(n.split('.')[0]) <= previous]
+        removed = delete_blobs(obsolete, ORDER_JOURNAL_FOLDER)
+        logger.info(f"Komprimerade orderjournalen t.o.m. {seq}, tog bort {removed} händelser "
+                    f"t.o.m. {previous}")
+
+
+class JournalWriter:
+    """
+    Write-behind för orderjournalen. Ändringar läggs i en kö och skrivs av
+    en bakgrundstråd; flera ändringar som kommer tätt slås ihop till en
+    blob. flush() väntar tills allt som köats före anropet är sparat.
+    compact_fn anropas efter en skrivning när journalen bör komprimeras.
+    conflict_fn anropas om en annan process hunnit skriva samma löpnummer;
+    den ska läsa in ordrarna på nytt och applicera unwritten_events() ovanpå,
+    varefter skrivningen görs om med nästa lediga löpnummer.
+    """
+
+    def __init__(self, journal, compact_fn=None, conflict_fn=None, delay=WRITE_BEHIND_DELAY_SECONDS):
+        self.journal = journal
+        self.compact_fn = compact_fn
+        self.conflict_fn = conflict_fn
+        self.delay = delay
+        self._cond = threading.Condition()
+        self._pending = []
+        self._submitted = 0
+        self._written = 0
+        self._in_flight = 0
+        self._in_flight_batch = []
+        self._closed = False
+        self.last_error = None
+        self.last_write_at = None
+        self.conflicts = 0
+        self._thread = threading.Thread(target=self._run, name='order-journal-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, event):
+        """
+        Köar en händelse. Returnerar ett nummer som kan ges till flush().
+        """
+        with self._cond:
+            self._pending.append(event)
+            self._submitted += 1
+            self._cond.notify_all()
+            return self._submitted
+
+    def unwritten_events(self):
+        """
+        Händelser som ännu inte är sparade, i den ordning de köades.
+        """
+        with self._cond:
+            return list(self._in_flight_batch) + list(self._pending)
+
+    def queue_depth(self):
+        """
+        Antal händelser som ännu inte är sparade (köade + under skrivning).
+        """
+        with self._cond:
+            return len(self._pending) + self._in_flight
+
+    def flush(self, timeout=None, ticket=None):
+        """
+        Väntar tills alla händelser t.o.m. ticket (standard: allt som är
+        köat nu) är sparade. Returnerar False vid timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            target = self._submitted if ticket is None else ticket
+            self._cond.notify_all()
+            while self._written < target:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def status(self):
+        with self._cond:
+            return {
+                'queue_depth': len(self._pending) + self._in_flight,
+                'submitted': self._submitted,
+                'written': self._written,
+                'journal_seq': self.journal.last_seq,
+                'journal_pending': self.journal.pending,
+                'last_error': self.last_error,
+                'last_write_at': self.last_write_at,
+                'conflicts': self.conflicts
+            }
+
+    def close(self, timeout=WRITE_BEHIND_SHUTDOWN_TIMEOUT):
+        """
+        Sparar det som ligger i kön och stoppar tråden. Anropas vid avslut.
+        """
+        if self._closed:
+            return
+        if not self.flush(timeout=timeout):
+            logger.error(f"Hann inte spara {self.queue_depth()} orderhändelser vid avslut")
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _run(self):
+        failures = 0
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed and not self._pending:
+                    return
+
+            # Vänta in fler ändringar så att en skur blir en skrivning
+            if self.delay and failures == 0:
+                time.sleep(self.delay)
+
+            with self._cond:
+                batch = self._pending
+                self._pending = []
+                self._in_flight = len(batch)
+                self._in_flight_batch = batch
+
+            try:
+                seq = self.journal.append_batch(batch)
+            except GenerationConflict:
+                self._handle_conflict()
+                continue
+
+            with self._cond:
+                self._in_flight = 0
+                self._in_flight_batch = []
+                if seq is None:
+                    # Lägg tillbaka först i kön och försök igen med backoff
+                    self._pending = batch + self._pending
+                    failures += 1
+                    self.last_error = f"Kunde inte spara {len(batch)} orderhändelser"
+                else:
+                    self._written += len(batch)
+                    failures = 0
+                    self.last_error = None
+                    self.last_write_at = datetime.now().isoformat(timespec='seconds')
+                self._cond.notify_all()
+
+            if seq is None:
+                delay = min(WRITE_BEHIND_RETRY_MAX_SECONDS, 2 ** failures)
+                logger.error(f"Kunde inte skriva orderjournalen, försöker igen om {delay:.0f} s")
+                time.sleep(delay)
+                continue
+
+            if self.compact_fn is not None and self.journal.should_compact():
+                try:
+                    self.compact_fn()
+                except Exception as e:
+                    logger.error(f"Fel vid komprimering av orderjournalen: {str(e)}")
+
+    def _handle_conflict(self):
+        # En annan process har skrivit löpnumret. Läs in deras ändringar
+        # (conflict_fn), lägg tillbaka batchen först i kön och försök igen.
+        logger.warning(f"Löpnummer {self.journal.last_seq + 1} i orderjournalen är upptaget, läser in på nytt")
+        self.conflicts += 1
+        try:
+            if self.conflict_fn is not None:
+                self.conflict_fn()
+            else:
+                # Ingen att läsa in till, flytta bara fram löpnumret
+                self.journal.catch_up(lambda event: None)
+        except Exception as e:
+            logger.error(f"Fel vid omläsning efter konflikt i orderjournalen: {str(e)}")
+            time.sleep(min(WRITE_BEHIND_RETRY_MAX_SECONDS, 1))
+        finally:
+            with self._cond:
+                self._pending = self._in_flight_batch + self._pending
+                self._in_flight = 0
+                self._in_flight_batch = []
+                self._cond.notify_all()
@@ -0,0 +1,311 @@
+# order_store.py
+#
+# Orderraderna i minnet med hashindex på OrderName och
+# (OrderName, ProductID, Size), så att uppslag per leverans inte behöver
+# jämföra en strängkopia av hela orderhistoriken. Upprepade strängar
+# (leveransnamn, produkt-ID, storlek, valuta ...) lagras som category.
+
+import logging
+import threading
+from contextlib import contextmanager
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Orderhändelser, se apply_event
+CREATE = 'create'
+CANCEL = 'cancel'
+COMPLETE = 'complete'
+REACTIVATE = 'reactivate'
+
+CATEGORY_COLUMNS = ["OrderDate", "OrderName", "ProductID", "Size", "Currency", "Supplier"]
+
+# Kolumner som uppdateras per rad när en leverans färdigställs
+RECEIVED_COLUMNS = ['Mottagen mängd', 'new_avg_cost']
+
+
+class ReadWriteLock:
+    """
+    Många samtidiga läsare eller en skrivare. Skrivare som väntar går före
+    nya läsare så att de inte svälts ut. Skrivlåset är återinträdbart och
+    tråden som håller det får också läsa.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            yield
+            return
+        with self._cond:
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._waiting_writers += 1
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._waiting_writers -= 1
+                self._writer = me
+            self._writer_depth += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer_depth -= 1
+                if not self._writer_depth:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+def _as_categories(df):
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            values = df[col]
+            df[col] = values.where(values.isna(), values.astype(str)).astype('category')
+    return df
+
+
+def _plain(rows):
+    for col in CATEGORY_COLUMNS:
+        if col in rows.columns:
+            rows[col] = rows[col].astype(object)
+    return rows
+
+
+class OrderStore:
+    """
+    Håller orderramen och dess index. Alla ändringar ska gå via
+    metoderna här (i praktiken apply_event) så att indexen hålls i synk.
+    Radetiketterna är unika heltal som aldrig återanvänds.
+
+    Dessutom hålls en sammanfattning per leverans (datum, summa beställt,
+    antal rader, aktiv) som uppdateras av samma ändringar, så att
+    leveranslistorna inte behöver gruppera hela orderhistoriken.
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.load(pd.DataFrame(columns=self.columns))
+
+    def load(self, df):
+        """
+        Ersätter allt innehåll och bygger om indexen.
+        """
+        df = _as_categories(df.reset_index(drop=True))
+        self._df = df
+        self._next_label = len(df)
+        self._by_order = {}
+        self._by_line = {}
+        self._summaries = {}
+        self._index_rows(df)
+        self._summarize_rows(df)
+
+    def _index_rows(self, rows):
+        names = rows['OrderName'].astype(str).to_numpy()
+        pids = rows['ProductID'].astype(str).to_numpy()
+        sizes = rows['Size'].astype(str).to_numpy()
+        for label, name, pid, size in zip(rows.index, names, pids, sizes):
+            self._by_order.setdefault(name, []).append(label)
+            self._by_line.setdefault(name, {}).setdefault((pid, size), []).append(label)
+
+    def _summarize_rows(self, rows):
+        """
+        Lägger till rows i sammanfattningarna. Leveranser som redan finns
+        behåller sitt datum (första raden).
+        """
+        if rows.empty:
+            return
+        quantities = pd.to_numeric(rows['Quantity ordered'], errors='coerce').fillna(0).to_numpy()
+        for name, date, pid, active, quantity in zip(
+            rows['OrderName'].astype(str).to_numpy(),
+            rows['OrderDate'].to_numpy(),
+            rows['ProductID'].to_numpy(),
+            rows['IsActive'].to_numpy(),
+            quantities
+        ):
+            summary = self._summaries.get(name)
+            if summary is None:
+                summary = self._summaries[name] = {
+                    'OrderName': name,
+                    'OrderDate': date,
+                    'QuantitySum': 0,
+                    'ProductCount': 0,
+                    'IsActive': False
+                }
+            summary['QuantitySum'] += quantity
+            summary['ProductCount'] += int(not pd.isna(pid))
+            summary['IsActive'] = summary['IsActive'] or bool(active)
+
+    # ---------------------------------------------------------------
+    # Läsning
+    # ---------------------------------------------------------------
+    @property
+    def df(self):
+        """
+        Den underliggande ramen. Får bara läsas, inte ändras.
+        """
+        return self._df
+
+    def __len__(self):
+        return len(self._df)
+
+    def order_names(self):
+        return list(self._by_order)
+
+    def has_order(self, order_name):
+        return str(order_name) in self._by_order
+
+    def order_labels(self, order_name):
+        return self._by_order.get(str(order_name), [])
+
+    def is_order_active(self, order_name):
+        labels = self.order_labels(order_name)
+        return bool(labels) and bool(self._df.loc[labels, 'IsActive'].any())
+
+    def rows_for_order(self, order_name, only_active=False):
+        """
+        Kopia av leveransens rader, med vanliga strängkolumner.
+        """
+        rows = self._df.loc[self.order_labels(order_name)]
+        if only_active:
+            rows = rows[rows['IsActive'] == True]
+        return _plain(rows.copy())
+
+    def active_rows(self, columns=None):
+        rows = self._df[self._df['IsActive'] == True]
+        return rows[columns] if columns is not None else rows
+
+    def snapshot(self, plain=False):
+        """
+        Kopia av ramen; med plain=True som vanliga strängkolumner.
+        """
+        return _plain(self._df.copy()) if plain else self._df.copy()
+
+    def summaries(self, active):
+        """
+        Sammanfattningar för aktiva (active=True) eller färdigställda
+        leveranser, sorterade på namn.
+        """
+        return [
+            self.summary(name)
+            for name, summary in sorted(self._summaries.items())
+            if summary['IsActive'] == active
+        ]
+
+    def summary(self, order_name):
+        """
+        Sammanfattningen för en leverans (utan aktivflagga), None om den saknas.
+        """
+        summary = self._summaries.get(str(order_name))
+        if summary is None:
+            return None
+        quantity = float(summary['QuantitySum'])
+        return {
+            'OrderName': summary['OrderName'],
+            'OrderDate': summary['OrderDate'],
+            'QuantitySum': int(quantity) if quantity.is_integer() else quantity,
+            'ProductCount': summary['ProductCount']
+        }
+
+    # ---------------------------------------------------------------
+    # Ändringar
+    # ---------------------------------------------------------------
+    def append_rows(self, rows):
+        rows = _as_categories(pd.DataFrame(rows).reset_index(drop=True))
+        rows.index = pd.RangeIndex(self._next_label, self._next_label + len(rows))
+        self._next_label += len(rows)
+
+        # Samma kategorier på båda sidor så att concat behåller category
+        for col in CATEGORY_COLUMNS:
+            if col not in rows.columns or col not in self._df.columns:
+                continue
+            if not isinstance(self._df[col].dtype, pd.CategoricalDtype):
+                self._df[col] = self._df[col].astype('category')
+            missing = rows[col].cat.categories.difference(self._df[col].cat.categories)
+            if len(missing):
+                self._df[col] = self._df[col].cat.add_categories(missing)
+            rows[col] = rows[col].astype(self._df[col].dtype)
+
+        self._df = pd.concat([self._df, rows])
+        self._index_rows(rows)
+        self._summarize_rows(rows)
+
+    def remove_order(self, order_name):
+        name = str(order_name)
+        labels = self._by_order.pop(name, [])
+        self._by_line.pop(name, None)
+        self._summaries.pop(name, None)
+        if labels:
+            self._df = self._df.drop(index=labels)
+
+    def set_active(self, order_name, active):
+        labels = self.order_labels(order_name)
+        if labels:
+            self._df.loc[labels, 'IsActive'] = bool(active)
+            self._df['IsActive'] = self._df['IsActive'].astype(bool)
+            self._summaries[str(order_name)]['IsActive'] = bool(active)
+
+    def update_lines(self, order_name, received, columns=RECEIVED_COLUMNS):
+        """
+        Sätter columns för leveransens rader utifrån received (lista med
+        dicts med ProductID, Size och kolumnerna). Ett uppslag per rad i
+        received via indexet, sedan en samlad skrivning per kolumn.
+        """
+        lines = self._by_line.get(str(order_name), {})
+        for column in columns:
+            labels, values = [], []
+            for row in received:
+                value = row.get(column)
+                if value is None or pd.isna(value):
+                    continue
+                for label in lines.get((str(row['ProductID']), str(row['Size'])), []):
+                    labels.append(label)
+                    values.append(value)
+            if labels:
+                self._df.loc[labels, column] = values
+
+    def coerce_numeric(self, columns):
+        for col in columns:
+            if col in self._df.columns:
+                self._df[col] = pd.to_numeric(self._df[col], errors='coerce').fillna(0)
+
+    def apply_event(self, event):
+        """
+        Applicerar en orderhändelse. Används både när ändringen görs och
+        vid uppspelning av journalen, så att de alltid ger samma resultat.
+        """
+        kind = event['type']
+        order_name = event['order_name']
+
+        if kind == CREATE:
+            self.append_rows(event['rows'])
+        elif kind == CANCEL:
+            self.remove_order(order_name)
+        elif kind == REACTIVATE:
+            self.set_active(order_name, True)
+        elif kind == COMPLETE:
+            self.set_active(order_name, False)
+            self.update_lines(order_name, event.get('received', []))
+        else:
+            logger.error(f"Okänd orderhändelse: {kind}")
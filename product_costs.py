@@ -0,0 +1,153 @@
+# product_costs.py
+#
+# Snittkostnaderna (product_costs) i minnet, indexerade på ProductID. Tabellen
+# hämtas en gång och läses sedan om bara när blobens generation i Firebase
+# har ändrats (kontrolleras med ett metadataanrop högst var
+# PRODUCT_COST_CHECK_SECONDS). Uppdateringar görs i klump och sparas med
+# en enda uppladdning.
+
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+
+import pandas as pd
+
+from firebase_storage import (
+    BlobReadError,
+    GenerationConflict,
+    save_product_costs,
+    load_product_costs,
+    known_table_generation,
+    remote_table_generation
+)
+
+logger = logging.getLogger(__name__)
+
+COST_COLUMNS = ["ProductID", "AvgCost", "LastUpdated"]
+
+# Hur ofta generationen i Firebase kontrolleras (sekunder)
+PRODUCT_COST_CHECK_SECONDS = float(os.environ.get('PRODUCT_COST_CHECK_SECONDS', 5))
+
+# Antal försök om en annan process sparar samtidigt
+PRODUCT_COST_MAX_CONFLICTS = int(os.environ.get('PRODUCT_COST_MAX_CONFLICTS', 3))
+
+
+def _empty_costs():
+    return pd.DataFrame(columns=COST_COLUMNS).set_index("ProductID")
+
+
+class ProductCostTable:
+    """
+    Ramen är indexerad på ProductID (str) med kolumnerna AvgCost och
+    LastUpdated.
+    """
+
+    def __init__(self, check_interval=PRODUCT_COST_CHECK_SECONDS):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._df = None
+        self._generation = None
+        self._checked_at = 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._df = None
+
+    def _load(self):
+        # Anropas med self._lock tagen
+        try:
+            df = load_product_costs(raise_on_error=True)
+        except BlobReadError:
+            # Bloben finns men kunde inte läsas; spara inte över den
+            logger.error("Kunde inte läsa product_costs, försöker igen vid nästa anrop")
+            self._df = _empty_costs()
+            self._generation = None
+            self._checked_at = 0.0
+            return
+        generation = known_table_generation('product_costs', 'costs')
+        if df is None:
+            df = pd.DataFrame(columns=COST_COLUMNS)
+        for col in COST_COLUMNS:
+            if col not in df.columns:
+                df[col] = 0.0 if col == "AvgCost" else ""
+        df["ProductID"] = df["ProductID"].astype(str)
+        df["AvgCost"] = pd.to_numeric(df["AvgCost"], errors='coerce').fillna(0.0)
+        self._df = df.drop_duplicates("ProductID", keep="last").set_index("ProductID")[["AvgCost", "LastUpdated"]]
+        self._generation = generation
+        self._checked_at = time.monotonic()
+        logger.info(f"Läste {len(self._df)} snittkostnader (generation {self._generation})")
+
+    def _ensure_fresh(self):
+        # Anropas med self._lock tagen
+        if self._df is None:
+            self._load()
+            return
+        if time.monotonic() - self._checked_at < self.check_interval:
+            return
+        self._checked_at = time.monotonic()
+        if remote_table_generation('product_costs', 'costs') != self._generation:
+            logger.info("product_costs har ändrats i Firebase, läser om")
+            self._load()
+
+    def frame(self, columns=None):
+        """
+        Kopia av tabellen som vanlig DataFrame (ProductID som kolumn).
+        """
+        with self._lock:
+            self._ensure_fresh()
+            df = self._df.reset_index()
+        return df[[c for c in columns if c in df.columns]] if columns is not None else df
+
+    def get(self, product_id, default=0.0):
+        with self._lock:
+            self._ensure_fresh()
+            try:
+                return float(self._df.at[str(product_id), "AvgCost"])
+            except KeyError:
+                return default
+
+    def update_many(self, mapping):
+        """
+        Sätter AvgCost för alla ProductID i mapping ({ProductID: kostnad})
+        och sparar tabellen en gång. Har en annan process sparat under
+        tiden läses tabellen om och ändringen görs om. Returnerar True om
+        den sparades.
+        """
+        if not mapping:
+            return True
+        updates = pd.Series({str(pid): float(cost) for pid, cost in mapping.items()}, dtype=float)
+
+        with self._lock:
+            for attempt in range(PRODUCT_COST_MAX_CONFLICTS):
+                self._ensure_fresh()
+                if self._generation is None:
+                    return False
+                now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                new_df = self._df.copy()
+                new_ids = updates.index.difference(new_df.index)
+                if len(new_ids):
+                    new_df = pd.concat([new_df, pd.DataFrame(index=new_ids, columns=new_df.columns)])
+                    new_df.index.name = "ProductID"
+                new_df.loc[updates.index, "AvgCost"] = updates
+                new_df.loc[updates.index, "LastUpdated"] = now_str
+                new_df["AvgCost"] = new_df["AvgCost"].astype(float)
+
+                try:
+                    saved = save_product_costs(new_df.reset_index(), if_generation_match=self._generation or 0)
+                except GenerationConflict:
+                    logger.warning(f"product_costs ändrades av en annan process, försök {attempt + 1}")
+                    self._df = None
+                    continue
+
+                if not saved:
+                    return False
+                self._df = new_df
+                self._generation = known_table_generation('product_costs', 'costs')
+                self._checked_at = time.monotonic()
+                logger.info(f"Uppdaterade snittkostnad för {len(updates)} produkter")
+                return True
+
+        logger.error(f"Kunde inte spara snittkostnader efter {PRODUCT_COST_MAX_CONFLICTS} konflikter")
+        return False
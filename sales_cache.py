@@ -0,0 +1,177 @@
+# sales_cache.py
+#
+# Lokal diskcache för såld kvantitet per dag och (ProductID, Size).
+# En CSV-fil per dag och läge (endast SHIPPED eller alla ordrar), så att
+# /stats bara behöver hämta dagar från Centra som inte redan finns här.
+
+import os
+import csv
+import logging
+import tempfile
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+SALES_CACHE_DIR = os.environ.get('SALES_CACHE_DIR', 'sales_cache')
+
+# Max antal dagar som sparas per läge, äldsta dagarna rensas först
+SALES_CACHE_MAX_DAYS = int(os.environ.get('SALES_CACHE_MAX_DAYS', 730))
+
+# Dagar närmast idag cachas inte eftersom ordrar fortfarande kan
+# ändra status (t.ex. skeppas) efter orderdatumet
+SALES_CACHE_SETTLE_DAYS = int(os.environ.get('SALES_CACHE_SETTLE_DAYS', 3))
+
+# Läget "endast SHIPPED" räknar ordrar per orderdatum som har skeppats, så en
+# dags siffror växer så länge äldre ordrar skeppas. Den dagen cachas därför
+# först när den är betydligt äldre.
+SALES_CACHE_SHIPPED_SETTLE_DAYS = int(os.environ.get('SALES_CACHE_SHIPPED_SETTLE_DAYS', 60))
+
+CSV_COLUMNS = ["ProductID", "Size", "Quantity Sold"]
+
+
+def _mode_dir(only_shipped):
+    return os.path.join(SALES_CACHE_DIR, 'shipped' if only_shipped else 'all')
+
+
+def _day_path(only_shipped, day_str):
+    return os.path.join(_mode_dir(only_shipped), f"{day_str}.csv")
+
+
+def settle_days(only_shipped):
+    return SALES_CACHE_SHIPPED_SETTLE_DAYS if only_shipped else SALES_CACHE_SETTLE_DAYS
+
+
+def is_cacheable_day(day_str, only_shipped=False, today=None):
+    """
+    En dag får cachas först när den är äldre än settle_days(only_shipped).
+    """
+    day = datetime.fromisoformat(day_str).date()
+    return day <= last_settled_day(only_shipped, today)
+
+
+def last_settled_day(only_shipped, today=None):
+    """
+    Senaste dagen vars försäljning inte längre ändras (och får cachas).
+    """
+    today = today or datetime.now().date()
+    return today - timedelta(days=settle_days(only_shipped) + 1)
+
+
+def missing_days(only_shipped, days):
+    """
+    De dagar i `days` som måste hämtas från Centra: de som inte finns i
+    cachen eller ännu inte får cachas. Läser inga filer.
+    """
+    return [day_str for day_str in days
+            if not is_cacheable_day(day_str, only_shipped)
+            or not os.path.exists(_day_path(only_shipped, day_str))]
+
+
+def get_cached_days(only_shipped, days):
+    """
+    Läser in de dagar i `days` som finns i cachen.
+    Returnerar {day_str: {(ProductID, Size): quantity}}; saknade dagar är inte med.
+    Filer för dagar som ännu inte får cachas (sparade med ett kortare
+    fönster) tas bort så att dagen hämtas på nytt.
+    """
+    result = {}
+    for day_str in days:
+        path = _day_path(only_shipped, day_str)
+        if not os.path.exists(path):
+            continue
+        if not is_cacheable_day(day_str, only_shipped):
+            os.remove(path)
+            continue
+        try:
+            totals = {}
+            with open(path, 'r', encoding='utf-8', newline='') as f:
+                for row in csv.DictReader(f):
+                    totals[(row["ProductID"], row["Size"])] = int(row["Quantity Sold"])
+            result[day_str] = totals
+        except Exception as e:
+            logger.error(f"Fel vid läsning av säljcache för {day_str}: {str(e)}")
+    return result
+
+
+def store_day(only_shipped, day_str, totals):
+    """
+    Sparar en dags försäljning. Dagar som inte är stängda ännu hoppas över.
+    Returnerar True om dagen sparades.
+    """
+    if not is_cacheable_day(day_str, only_shipped):
+        return False
+
+    path = _day_path(only_shipped, day_str)
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unik temporärfil, så att två workers som sparar samma dag
+        # inte skriver i samma fil
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_COLUMNS)
+            for (product_id, size), quantity in totals.items():
+                writer.writerow([product_id, size, quantity])
+        os.replace(tmp_path, path)
+        return True
+    except Exception as e:
+        logger.error(f"Fel vid sparning av säljcache för {day_str}: {str(e)}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+def _cached_day_files(only_shipped):
+    mode_dir = _mode_dir(only_shipped)
+    if not os.path.isdir(mode_dir):
+        return []
+    return sorted(f for f in os.listdir(mode_dir) if f.endswith('.csv'))
+
+
+def invalidate(only_shipped=None, from_date_str=None, to_date_str=None):
+    """
+    Tar bort cachade dagar. only_shipped=None gäller båda lägena, och utan
+    datum töms hela cachen för läget. Returnerar antal borttagna dagar.
+    """
+    modes = [True, False] if only_shipped is None else [only_shipped]
+    removed = 0
+    for mode in modes:
+        for filename in _cached_day_files(mode):
+            day_str = filename[:-len('.csv')]
+            if from_date_str and day_str < from_date_str:
+                continue
+            if to_date_str and day_str > to_date_str:
+                continue
+            os.remove(os.path.join(_mode_dir(mode), filename))
+            removed += 1
+    logger.info(f"Tog bort {removed} dagar ur säljcachen")
+    return removed
+
+
+def enforce_size_limit(only_shipped, max_days=SALES_CACHE_MAX_DAYS):
+    """
+    Rensar de äldsta dagarna så att högst max_days dagar finns kvar.
+    """
+    files = _cached_day_files(only_shipped)
+    excess = len(files) - max_days
+    for filename in files[:max(excess, 0)]:
+        os.remove(os.path.join(_mode_dir(only_shipped), filename))
+    if excess > 0:
+        logger.info(f"Rensade {excess} gamla dagar ur säljcachen")
+
+
+def cache_info():
+    """
+    Sammanfattning per läge: antal dagar, storlek och datumintervall.
+    """
+    info = {}
+    for mode, label in ((True, 'shipped'), (False, 'all')):
+        files = _cached_day_files(mode)
+        info[label] = {
+            "days": len(files),
+            "bytes": sum(os.path.getsize(os.path.join(_mode_dir(mode), f)) for f in files),
+            "oldest": files[0][:-len('.csv')] if files else None,
+            "newest": files[-1][:-len('.csv')] if files else None
+        }
+    return info
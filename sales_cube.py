@@ -0,0 +1,125 @@
+# sales_cube.py
+#
+# Försäljning per SKU (ProductID, Size) och dag som en NumPy-matris med
+# kumulativa summor längs dagaxeln. Summan för valfritt datumintervall blir
+# då cumulative[:, to + 1] - cumulative[:, from], dvs. O(antal SKU:er),
+# utan att gå tillbaka till Centra.
+
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def _to_date(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value).date()
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+class SalesCube:
+    """
+    keys är en lista med (ProductID, Size) och cumulative en int32-matris
+    med formen (len(keys), antal dagar + 1) där kolumn 0 är noll.
+    """
+
+    def __init__(self, keys, first_day, cumulative):
+        self.keys = keys
+        self.first_day = _to_date(first_day)
+        self.cumulative = cumulative
+        self._key_df = pd.DataFrame(keys, columns=['ProductID', 'Size'])
+
+    @classmethod
+    def from_daily_totals(cls, daily_totals, from_date_str, to_date_str):
+        """
+        daily_totals: {day_str: {(ProductID, Size): quantity}} för dagarna
+        i [from_date_str, to_date_str]. Dagar som saknas räknas som noll.
+        """
+        first_day = _to_date(from_date_str)
+        num_days = (_to_date(to_date_str) - first_day).days + 1
+
+        key_index = {}
+        rows, cols, quantities = [], [], []
+        for day_str, totals in daily_totals.items():
+            col = (_to_date(day_str) - first_day).days
+            if col < 0 or col >= num_days:
+                continue
+            for key, quantity in totals.items():
+                rows.append(key_index.setdefault(key, len(key_index)))
+                cols.append(col)
+                quantities.append(quantity)
+
+        daily = np.zeros((len(key_index), num_days), dtype=np.int32)
+        if quantities:
+            np.add.at(daily, (np.array(rows), np.array(cols)), np.array(quantities, dtype=np.int32))
+
+        cumulative = np.zeros((len(key_index), num_days + 1), dtype=np.int32)
+        np.cumsum(daily, axis=1, out=cumulative[:, 1:])
+
+        logger.info(f"Säljkub: {len(key_index)} SKU:er x {num_days} dagar "
+                    f"({cumulative.nbytes / 1024 / 1024:.1f} MB)")
+        return cls(list(key_index), first_day, cumulative)
+
+    @property
+    def num_days(self):
+        return self.cumulative.shape[1] - 1
+
+    @property
+    def last_day(self):
+        return self.first_day + timedelta(days=self.num_days - 1)
+
+    def covers(self, from_date_str, to_date_str):
+        return (_to_date(from_date_str) >= self.first_day
+                and _to_date(to_date_str) <= self.last_day)
+
+    def window_totals(self, from_date_str, to_date_str):
+        """
+        Såld kvantitet per SKU (samma ordning som self.keys) för intervallet.
+        """
+        if not self.covers(from_date_str, to_date_str):
+            raise ValueError(f"Intervallet {from_date_str}-{to_date_str} ligger utanför kuben "
+                             f"({self.first_day}-{self.last_day})")
+        start = (_to_date(from_date_str) - self.first_day).days
+        end = (_to_date(to_date_str) - self.first_day).days + 1
+        return self.cumulative[:, end] - self.cumulative[:, start]
+
+    def window_df(self, from_date_str, to_date_str):
+        """
+        Samma format som process_sales_data: ProductID, Size, Quantity Sold
+        och Avg Daily Sales, bara SKU:er som sålt i intervallet.
+        """
+        totals = self.window_totals(from_date_str, to_date_str)
+        days = (_to_date(to_date_str) - _to_date(from_date_str)).days + 1
+        sold = totals > 0
+        out = self._key_df[sold].copy()
+        out['Quantity Sold'] = totals[sold].astype(int)
+        out['Avg Daily Sales'] = (out['Quantity Sold'] / days).round(1)
+        return out.sort_values(['ProductID', 'Size']).reset_index(drop=True)
+
+    def window_dict(self, from_date_str, to_date_str):
+        """
+        {(ProductID, Size): quantity} för intervallet, för process_sales_data.
+        """
+        totals = self.window_totals(from_date_str, to_date_str)
+        return {key: int(q) for key, q in zip(self.keys, totals) if q}
+
+    def trailing_df(self, windows=(7, 30, 90), end_date_str=None):
+        """
+        Jämför de senaste N dagarna för varje N i windows, t.ex. 7 mot 30
+        mot 90. Ger kolumnerna 'Sold Nd' och 'Avg Nd' per fönster.
+        Fönster som är längre än kuben kapas till kubens början.
+        """
+        end_day = _to_date(end_date_str) if end_date_str else self.last_day
+        out = self._key_df.copy()
+        for window in windows:
+            start_day = max(end_day - timedelta(days=int(window) - 1), self.first_day)
+            totals = self.window_totals(start_day.isoformat(), end_day.isoformat())
+            days = (end_day - start_day).days + 1
+            out[f'Sold {window}d'] = totals.astype(int)
+            out[f'Avg {window}d'] = np.round(totals / days, 2)
+        return out.sort_values(['ProductID', 'Size']).reset_index(drop=True)
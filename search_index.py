@@ -0,0 +1,170 @@
+# search_index.py
+#
+# Förbyggt sökindex över produktkatalogen för /search_products.
+# Indexerar ProductID, Product Name och Product Number en gång per
+# katalog-snapshot i stället för att köra str.contains per tangenttryckning.
+
+import os
+import heapq
+import logging
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Högsta antal kandidater som rankas per sökning. Korta sökningar ("pr",
+# "10") matchar annars en stor del av katalogen.
+SEARCH_MAX_CANDIDATES = int(os.environ.get('SEARCH_MAX_CANDIDATES', 2000))
+
+
+def _ngrams(text, n):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _trigrams(text):
+    return _ngrams(text, 3)
+
+
+class ProductSearchIndex:
+    """
+    Ett dokument per unik ProductID (med dess storlekar), ett trigramindex
+    för delsträngssökning, ett bigramindex för sökningar på två tecken och
+    en sorterad tokenlista för prefixsökning. Prefix på två tecken slås upp
+    i en egen tabell där produkterna redan är ordnade efter kortast token.
+    """
+
+    def __init__(self, products_df):
+        self._products = []      # (ProductID, Product Name, Product Number)
+        self._fields = []        # gemener: (pid, name, number)
+        self._sizes = []         # storlekar per produkt
+        self._trigram_map = {}   # trigram -> lista med produktindex
+        self._bigram_map = {}    # bigram -> lista med produktindex
+        self._short_prefix_map = {}  # tokenprefix (2 tecken) -> produktindex, kortast token först
+        self._tokens = []        # sorterad lista med (token, produktindex)
+
+        doc_by_pid = {}
+        for pid, name, number, size in zip(
+                products_df['ProductID'].astype(str),
+                products_df['Product Name'].astype(str),
+                products_df['Product Number'].astype(str),
+                products_df['Size'].astype(str)):
+            doc = doc_by_pid.get(pid)
+            if doc is None:
+                doc = len(self._products)
+                doc_by_pid[pid] = doc
+                self._products.append((pid, name, number))
+                self._fields.append((pid.lower(), name.lower(), number.lower()))
+                self._sizes.append([])
+            if size not in self._sizes[doc]:
+                self._sizes[doc].append(size)
+
+        for doc, fields in enumerate(self._fields):
+            grams = set()
+            bigrams = set()
+            for field in fields:
+                grams |= _trigrams(field)
+                bigrams |= _ngrams(field, 2)
+                for token in field.split():
+                    self._tokens.append((token, doc))
+            for gram in grams:
+                self._trigram_map.setdefault(gram, []).append(doc)
+            for gram in bigrams:
+                self._bigram_map.setdefault(gram, []).append(doc)
+        self._tokens.sort()
+
+        seen = {}
+        for token, doc in sorted(self._tokens, key=lambda item: len(item[0])):
+            prefix = token[:2]
+            if len(prefix) == 2 and doc not in seen.setdefault(prefix, set()):
+                seen[prefix].add(doc)
+                self._short_prefix_map.setdefault(prefix, []).append(doc)
+
+    def __len__(self):
+        return len(self._products)
+
+    def _prefix_matches(self, q, cap):
+        if len(q) == 2:
+            return set(self._short_prefix_map.get(q, [])[:cap])
+        start = bisect_left(self._tokens, (q, -1))
+        end = bisect_left(self._tokens, (q + '\uffff', -1), start)
+        tokens = self._tokens[start:end]
+        if len({doc for _, doc in tokens}) > cap:
+            # Kortast token först, det är de som rankas högst
+            tokens = sorted(tokens, key=lambda item: len(item[0]))
+        docs = set()
+        for _, doc in tokens:
+            docs.add(doc)
+            if len(docs) >= cap:
+                break
+        return docs
+
+    def _substring_matches(self, q, cap):
+        if len(q) == 2:
+            # Bigrammet är hela söksträngen, så listan behöver inte kontrolleras
+            return set(self._bigram_map.get(q, [])[:cap])
+
+        posting_lists = []
+        for gram in _trigrams(q):
+            docs = self._trigram_map.get(gram)
+            if not docs:
+                return set()
+            posting_lists.append(docs)
+        posting_lists.sort(key=len)
+        candidates = set(posting_lists[0])
+        for docs in posting_lists[1:]:
+            candidates.intersection_update(docs)
+            if not candidates:
+                return candidates
+        matches = set()
+        for doc in candidates:
+            if any(q in f for f in self._fields[doc]):
+                matches.add(doc)
+                if len(matches) >= cap:
+                    break
+        return matches
+
+    def _rank(self, doc, q):
+        pid, name, number = self._fields[doc]
+        if pid == q or number == q:
+            tier = 0
+        elif pid.startswith(q) or number.startswith(q):
+            tier = 1
+        elif name.startswith(q):
+            tier = 2
+        elif any(token.startswith(q) for token in name.split()):
+            tier = 3
+        else:
+            tier = 4
+        # ID-träffar sorteras på artikelnummer, namnträffar på kortast namn
+        key = (len(number), number) if tier <= 1 else (len(name), name)
+        return (tier, key, doc)
+
+    def search(self, query, limit=10):
+        """
+        Returnerar högst `limit` träffar, rankade: exakt ID/artikelnummer,
+        prefix på ID/artikelnummer, prefix på namn/ord i namnet, övriga delsträngar.
+        En rad per (ProductID, Size).
+        """
+        q = query.strip().lower()
+        if len(q) < 2:
+            return []
+
+        docs = self._prefix_matches(q, SEARCH_MAX_CANDIDATES)
+        ranks = [self._rank(doc, q) for doc in docs]
+        if sum(1 for rank in ranks if rank[0] < 4) < limit:
+            # Prefixträffar rankas före rena delsträngsträffar, så
+            # delsträngarna behövs bara om prefixträffarna inte räcker
+            ranks += [self._rank(doc, q) for doc in self._substring_matches(q, SEARCH_MAX_CANDIDATES)
+                      if doc not in docs]
+        results = []
+        for rank in heapq.nsmallest(limit, ranks):
+            doc = rank[-1]
+            pid, name, _ = self._products[doc]
+            for size in self._sizes[doc]:
+                results.append({
+                    'ProductID': pid,
+                    'Product_Name': name,
+                    'Size': size
+                })
+                if len(results) >= limit:
+                    return results
+        return results
@@ -0,0 +1,93 @@
+import pytest
+import requests
+
+import centra_client
+from centra_client import CentraClient, CENTRA_BACKOFF_BASE
+
+QUERY = {"query": "query Orders { orders { id } }"}
+MUTATION = {"query": "mutation UpdateStock { updateStock { id } }"}
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeSession:
+    """
+    Ger svaren i tur och ordning; ett undantag i listan kastas i stället.
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def post(self, url, json=None, headers=None, timeout=None):
+        self.calls += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    waited = []
+    monkeypatch.setattr(centra_client.time, 'sleep', waited.append)
+    # Ingen jitter: backoff blir taket för varje försök
+    monkeypatch.setattr(centra_client.random, 'uniform', lambda low, high: high)
+    return waited
+
+
+def _client(responses, max_retries=4):
+    client = CentraClient(rate_limit=0, max_retries=max_retries)
+    client.session = FakeSession(responses)
+    return client
+
+
+def test_query_is_retried_on_429_and_5xx_with_exponential_backoff(sleeps):
+    client = _client([FakeResponse(429), FakeResponse(503), FakeResponse(500), FakeResponse(200)])
+
+    resp = client.post('https://centra.test/graphql', json=QUERY)
+
+    assert resp.status_code == 200
+    assert client.session.calls == 4
+    assert sleeps == [CENTRA_BACKOFF_BASE, CENTRA_BACKOFF_BASE * 2, CENTRA_BACKOFF_BASE * 4]
+    assert client.get_stats()['Orders']['retries'] == 3
+
+
+def test_retry_after_sets_minimum_wait(sleeps):
+    client = _client([FakeResponse(429, {'Retry-After': '7'}), FakeResponse(200)])
+
+    client.post('https://centra.test/graphql', json=QUERY)
+
+    assert sleeps == [7.0]
+
+
+def test_gives_up_after_max_retries(sleeps):
+    client = _client([FakeResponse(502)] * 3, max_retries=2)
+
+    resp = client.post('https://centra.test/graphql', json=QUERY)
+
+    assert resp.status_code == 502
+    assert client.session.calls == 3
+    assert len(sleeps) == 2
+
+
+def test_mutation_and_client_errors_are_not_retried(sleeps):
+    client = _client([FakeResponse(503), FakeResponse(400)])
+
+    assert client.post('https://centra.test/graphql', json=MUTATION).status_code == 503
+    assert client.post('https://centra.test/graphql', json=QUERY).status_code == 400
+    assert client.session.calls == 2
+    assert sleeps == []
+
+
+def test_connection_errors_are_retried_then_raised(sleeps):
+    client = _client([requests.ConnectionError('reset'), requests.ConnectionError('reset')], max_retries=1)
+
+    with pytest.raises(requests.ConnectionError):
+        client.post('https://centra.test/graphql', json=QUERY)
+    assert client.session.calls == 2
+    assert len(sleeps) == 1
@@ -0,0 +1,104 @@
+import pandas as pd
+
+from delivery_costs import avg_costs_by_product, calculate_delivery_avg_costs
+
+
+def test_stock_of_all_sizes_is_weighted_in():
+    delivery_df = pd.DataFrame({
+        'ProductID': ['100', '100'],
+        'Size': ['S', 'M'],
+        'Current Stock': [100, 0],
+        'PurchasePrice': [10.0, 10.0],
+        'Mottagen mängd': [1, 1],
+        'new_price_sek': [20.0, 20.0]
+    })
+
+    # (100 * 10 + 1 * 20 + 1 * 20) / 102
+    assert avg_costs_by_product(delivery_df) == {'100': 10.2}
+
+
+def test_sizes_without_received_quantity_still_count_their_stock():
+    delivery_df = pd.DataFrame({
+        'ProductID': ['100', '100', '100', '200'],
+        'Size': ['S', 'M', 'L', 'One'],
+        'Current Stock': [2, 0, 4, 5],
+        'PurchasePrice': [12.0, 12.0, 12.0, 40.0],
+        'Mottagen mängd': [1, 3, 0, 5],
+        'new_price_sek': [10.0, 20.0, 99.0, 50.0]
+    })
+
+    # (6 * 12 + 1 * 10 + 3 * 20) / 10 och (5 * 40 + 5 * 50) / 10
+    assert avg_costs_by_product(delivery_df) == {'100': 14.2, '200': 45.0}
+
+
+def test_order_of_sizes_does_not_matter():
+    delivery_df = pd.DataFrame({
+        'ProductID': [100, 100],
+        'Size': ['S', 'M'],
+        'Current Stock': ['3', None],
+        'PurchasePrice': ['15', '15'],
+        'Mottagen mängd': [2, 2],
+        'new_price_sek': [10.0, 30.0]
+    })
+
+    expected = {'100': round((3 * 15 + 2 * 10 + 2 * 30) / 7, 2)}
+    assert avg_costs_by_product(delivery_df) == avg_costs_by_product(delivery_df.iloc[::-1]) == expected
+
+
+def test_products_without_priced_receipts_are_skipped():
+    delivery_df = pd.DataFrame({
+        'ProductID': ['100', '100', '300', '400'],
+        'Size': ['S', 'M', 'S', 'S'],
+        'Current Stock': [5, 5, 5, -3],
+        'PurchasePrice': [10.0, 10.0, 10.0, 10.0],
+        'Mottagen mängd': [0, 0, 4, 2],
+        'new_price_sek': [20.0, 20.0, 0.0, 30.0]
+    })
+
+    # Negativt lager räknas som 0
+    assert avg_costs_by_product(delivery_df) == {'400': 30.0}
+
+
+def test_missing_price_column_gives_no_updates():
+    delivery_df = pd.DataFrame({'ProductID': ['100'], 'Size': ['S'], 'Mottagen mängd': [1]})
+
+    assert avg_costs_by_product(delivery_df) == {}
+
+
+def test_new_avg_cost_per_size_with_mixed_stock():
+    delivery_df = pd.DataFrame({
+        'ProductID': ['100', '100', '100'],
+        'Size': ['S', 'M', 'L'],
+        'Price': [10.0, 10.0, 10.0],
+        'Exchange rate': [10.0, 10.0, 10.0],
+        'Shipping': [10.0, 10.0, 10.0],
+        'Customs': [20.0, 20.0, 20.0],
+        'Current Stock': [10, 0, 4],
+        'PurchasePrice': [50.0, 50.0, 50.0],
+        'Mottagen mängd': [5, 5, 0]
+    })
+
+    result = calculate_delivery_avg_costs(delivery_df)
+
+    # 10 * 10 * 1.1 * 1.2 = 132
+    assert result['new_price_sek'].tolist() == [132.0, 132.0, 132.0]
+    # (10 * 50 + 5 * 132) / 15, bara nytt pris utan lager, bara lager utan mottaget
+    assert result['new_avg_cost'].tolist() == [77.33, 132.0, 50.0]
+    # Per produkt: (14 * 50 + 10 * 132) / 24
+    assert avg_costs_by_product(result) == {'100': 84.17}
+
+
+def test_missing_values_default_to_zero_and_rate_one():
+    delivery_df = pd.DataFrame({
+        'ProductID': ['100', '200'],
+        'Size': ['S', 'S'],
+        'Price': ['25', None],
+        'Current Stock': [0, 0],
+        'Mottagen mängd': [2, 0]
+    })
+
+    result = calculate_delivery_avg_costs(delivery_df)
+
+    assert result['new_price_sek'].tolist() == [25.0, 0.0]
+    assert result['new_avg_cost'].tolist() == [25.0, 0.0]
+    assert 'new_price_sek' not in delivery_df.columns
@@ -0,0 +1,93 @@
+from order_store import OrderStore, CREATE, CANCEL, COMPLETE, REACTIVATE
+
+COLUMNS = ['OrderDate', 'OrderName', 'ProductID', 'Size', 'Quantity ordered', 'Mottagen mängd', 'IsActive']
+
+
+def _rows(order_name, lines):
+    return [
+        {
+            'OrderDate': '2024-05-01',
+            'OrderName': order_name,
+            'ProductID': pid,
+            'Size': size,
+            'Quantity ordered': quantity,
+            'Mottagen mängd': 0,
+            'IsActive': True
+        }
+        for pid, size, quantity in lines
+    ]
+
+
+def _store():
+    store = OrderStore(COLUMNS)
+    store.apply_event({'type': CREATE, 'order_name': 'A', 'rows': _rows('A', [('100', 'S', 5), ('100', 'M', 3)])})
+    store.apply_event({'type': CREATE, 'order_name': 'B', 'rows': _rows('B', [('200', 'One', 10)])})
+    return store
+
+
+def test_create_adds_rows_and_summary():
+    store = _store()
+
+    assert len(store) == 3
+    assert store.has_order('A') and store.is_order_active('A')
+    assert store.rows_for_order('A')['Size'].tolist() == ['S', 'M']
+    assert store.summaries(True) == [
+        {'OrderName': 'A', 'OrderDate': '2024-05-01', 'QuantitySum': 8, 'ProductCount': 2},
+        {'OrderName': 'B', 'OrderDate': '2024-05-01', 'QuantitySum': 10, 'ProductCount': 1}
+    ]
+
+
+def test_complete_sets_received_per_line_and_deactivates():
+    store = _store()
+
+    store.apply_event({
+        'type': COMPLETE,
+        'order_name': 'A',
+        'received': [{'ProductID': '100', 'Size': 'M', 'Mottagen mängd': 2, 'new_avg_cost': 41.5}]
+    })
+
+    rows = store.rows_for_order('A').set_index('Size')
+    assert rows.loc['M', 'Mottagen mängd'] == 2
+    assert rows.loc['M', 'new_avg_cost'] == 41.5
+    # Raden som inte fanns i received lämnas orörd
+    assert rows.loc['S', 'Mottagen mängd'] == 0
+    assert not store.is_order_active('A')
+    assert [s['OrderName'] for s in store.summaries(False)] == ['A']
+    assert [s['OrderName'] for s in store.summaries(True)] == ['B']
+
+
+def test_cancel_removes_order_and_its_index():
+    store = _store()
+
+    store.apply_event({'type': CANCEL, 'order_name': 'A'})
+
+    assert len(store) == 1
+    assert not store.has_order('A')
+    assert store.rows_for_order('A').empty
+    assert store.summary('A') is None
+    assert store.rows_for_order('B')['Quantity ordered'].tolist() == [10]
+
+    # Samma namn kan skapas igen och får nya radetiketter
+    store.apply_event({'type': CREATE, 'order_name': 'A', 'rows': _rows('A', [('300', 'L', 1)])})
+    assert store.rows_for_order('A')['ProductID'].tolist() == ['300']
+    assert len(set(store.df.index)) == len(store) == 2
+
+
+def test_replaying_events_gives_same_result():
+    events = [
+        {'type': CREATE, 'order_name': 'A', 'rows': _rows('A', [('100', 'S', 5)])},
+        {'type': COMPLETE, 'order_name': 'A', 'received': [{'ProductID': '100', 'Size': 'S', 'Mottagen mängd': 5}]},
+        {'type': REACTIVATE, 'order_name': 'A'},
+        {'type': CREATE, 'order_name': 'B', 'rows': _rows('B', [('200', 'One', 1)])},
+        {'type': CANCEL, 'order_name': 'B'}
+    ]
+    first, second = OrderStore(COLUMNS), OrderStore(COLUMNS)
+    for event in events:
+        first.apply_event(event)
+    for event in events:
+        second.apply_event(event)
+
+    assert first.snapshot(plain=True).equals(second.snapshot(plain=True))
+    assert first.is_order_active('A')
+    assert first.rows_for_order('A')['Mottagen mängd'].tolist() == [5]
+    assert first.order_names() == ['A']
@@ -0,0 +1,53 @@
+import pytest
+
+from sales_cube import SalesCube
+
+DAILY = {
+    '2024-03-01': {('100', 'S'): 2, ('100', 'M'): 1},
+    '2024-03-02': {('100', 'S'): 3},
+    '2024-03-05': {('200', 'One'): 4, ('100', 'S'): 1},
+    '2024-03-10': {('200', 'One'): 6},
+    # Utanför intervallet, ska inte räknas
+    '2024-02-28': {('100', 'S'): 99}
+}
+
+
+def _cube():
+    return SalesCube.from_daily_totals(DAILY, '2024-03-01', '2024-03-10')
+
+
+def test_window_sums_match_daily_totals():
+    cube = _cube()
+
+    assert cube.num_days == 10
+    assert cube.window_dict('2024-03-01', '2024-03-10') == {('100', 'S'): 6, ('100', 'M'): 1, ('200', 'One'): 10}
+    assert cube.window_dict('2024-03-02', '2024-03-05') == {('100', 'S'): 4, ('200', 'One'): 4}
+    # Dagar utan försäljning räknas som noll
+    assert cube.window_dict('2024-03-06', '2024-03-09') == {}
+    assert cube.window_dict('2024-03-10', '2024-03-10') == {('200', 'One'): 6}
+
+
+def test_window_df_has_quantity_and_daily_average():
+    df = _cube().window_df('2024-03-01', '2024-03-05')
+
+    assert df[['ProductID', 'Size']].values.tolist() == [['100', 'M'], ['100', 'S'], ['200', 'One']]
+    assert df['Quantity Sold'].tolist() == [1, 6, 4]
+    assert df['Avg Daily Sales'].tolist() == [0.2, 1.2, 0.8]
+
+
+def test_trailing_windows_are_capped_at_cube_start():
+    df = _cube().trailing_df(windows=(3, 30)).set_index(['ProductID', 'Size'])
+
+    assert df.loc[('200', 'One'), 'Sold 3d'] == 6
+    assert df.loc[('100', 'S'), 'Sold 3d'] == 0
+    # 30 dagar kapas till kubens 10 dagar
+    assert df.loc[('100', 'S'), 'Sold 30d'] == 6
+    assert df.loc[('200', 'One'), 'Avg 30d'] == 1.0
+
+
+def test_window_outside_cube_raises():
+    cube = _cube()
+
+    assert not cube.covers('2024-02-29', '2024-03-10')
+    with pytest.raises(ValueError):
+        cube.window_totals('2024-03-05', '2024-03-11')
@@ -0,0 +1,72 @@
+import pandas as pd
+
+import search_index
+from search_index import ProductSearchIndex
+
+
+def _index(products):
+    rows = [
+        {'ProductID': pid, 'Product Name': name, 'Product Number': number, 'Size': size}
+        for pid, name, number, sizes in products
+        for size in sizes
+    ]
+    return ProductSearchIndex(pd.DataFrame(rows))
+
+
+def _names(results):
+    return [r['Product_Name'] for r in results]
+
+
+def test_ranking_order():
+    index = _index([
+        ('1', 'Basic tee', 'BT-1', ['S']),
+        ('2', 'Long sleeve tee', 'LS-2', ['S']),
+        ('3', 'Pattee', 'P-3', ['S']),
+        ('4', 'Teeshirt', 'TS-4', ['S']),
+        ('5', 'Tee bag', 'TEE-5', ['S']),
+        ('6', 'Tee', 'TEE', ['S']),
+        ('7', 'Hat', 'H-7', ['S'])
+    ])
+
+    # Exakt artikelnummer, prefix på artikelnummer, prefix på namn,
+    # ord i namnet (kortast namn först), övriga delsträngar
+    assert _names(index.search('TEE')) == [
+        'Tee', 'Tee bag', 'Teeshirt', 'Basic tee', 'Long sleeve tee', 'Pattee'
+    ]
+
+
+def test_product_id_matches_rank_first():
+    index = _index([
+        ('1200', 'Cap 12', 'C-1', ['One']),
+        ('120', 'Scarf', 'S-2', ['One']),
+        ('9', 'Bag', '12-9', ['One']),
+        ('50', '12 pack socks', 'P-50', ['One'])
+    ])
+
+    assert [r['ProductID'] for r in index.search('120')] == ['120', '1200']
+    # ID-träffar sorteras på artikelnummer och kommer före namnträffar
+    assert [r['ProductID'] for r in index.search('12')] == ['1200', '120', '9', '50']
+
+
+def test_one_row_per_size_up_to_limit():
+    index = _index([
+        ('1', 'Jeans', 'J-1', ['28', '30', '32']),
+        ('2', 'Jeans wide', 'J-2', ['30'])
+    ])
+
+    results = index.search('jeans', limit=4)
+    assert [(r['ProductID'], r['Size']) for r in results] == [('1', '28'), ('1', '30'), ('1', '32'), ('2', '30')]
+    assert len(index.search('jeans', limit=2)) == 2
+    assert index.search('j') == []
+
+
+def test_two_letter_query_keeps_shortest_tokens_under_candidate_cap(monkeypatch):
+    monkeypatch.setattr(search_index, 'SEARCH_MAX_CANDIDATES', 5)
+    products = [(str(i), f'Shirt long {i:03d}', f'X-{i}', ['M']) for i in range(50)]
+    products.append(('99', 'Shoe', 'X-99', ['42']))
+    index = _index(products)
+
+    # "shirt" kommer före "shoe" i bokstavsordning men "shoe" är kortare
+    # och ska inte falla bort när kandidaterna kapas
+    assert _names(index.search('sh', limit=1)) == ['Shoe']
+    assert _names(index.search('sh', limit=3)) == ['Shoe', 'Shirt long 000', 'Shirt long 001']